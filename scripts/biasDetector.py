@@ -23,6 +23,8 @@ from toil.job import Job
 
 from toillib import *
 
+from collateStatistics import load_stats_cache
+
 def parse_args(args):
     """
     Takes in the command-line arguments list (args), and returns a nice argparse
@@ -160,52 +162,55 @@ def scan_region(job, options, region, pop_by_sample, sample_whitelist):
     in_store = IOStore.get(options.in_store)
     out_store = IOStore.get(options.out_store)
     
-    # This holds a dict from graph name, then sample name, then stat name to
-    # actual stat value.
-    stats_cache = collections.defaultdict(lambda: collections.defaultdict(dict))
+    # This is the cache file for this region, in the columnar format that
+    # collateStatistics.py writes
+    cache_npz_key = "plots/cache/{}.npz".format(region)
     
-    # This is the cache file for this region, in
+    # This is the old cache file for this region, in
     # <graph>\t<sample>\t<stat>\t<value> format
     cache_tsv_key = "plots/cache/{}.tsv".format(region)
     
-    # What name will it have locally for us?
-    local_filename = os.path.join(job.fileStore.getLocalTempDir(), "temp.tsv")
+    # We only look at these stats
+    wanted_stats = {"substitution_rate", "indel_rate", "portion_perfect"}
     
-    if out_store.exists(cache_tsv_key):
-        # Just read in from that TSV
+    if out_store.exists(cache_npz_key):
+        # Just read in from the columnar cache
         
         RealTimeLogger.get().info("Loading cached region {}".format(region))
         
+        # What name will it have locally for us?
+        local_filename = os.path.join(job.fileStore.getLocalTempDir(),
+            "temp.npz")
+        
         # Grab the cached results
-        out_store.read_input_file(cache_tsv_key, local_filename)
+        out_store.read_input_file(cache_npz_key, local_filename)
         
-        # Read all the pop, value pairs from the TSV
-        reader = tsv.TsvReader(open(local_filename))
+    elif out_store.exists(cache_tsv_key):
+        # Read in from the TSV that older collateStatistics.py runs left
         
-        # Which samples are going to be skipped?
-        skipped_samples = set()
+        RealTimeLogger.get().info("Loading cached region {} from TSV".format(
+            region))
         
-        for graph, sample, stat, value in reader:
-            # Read every line from the cache and pull out what value for what
-            # stat it gives for what sample.
-            
-            if sample_whitelist is not None and sample not in sample_whitelist:
-                # Skip this sample that's not on the list
-                skipped_samples.add(sample)
-                continue
+        # What name will it have locally for us?
+        local_filename = os.path.join(job.fileStore.getLocalTempDir(),
+            "temp.tsv")
         
-            # Populate our cache dict
-            stats_cache[graph][sample][stat] = float(
-                value)
-                
-        RealTimeLogger.get().info("Skipped {} samples".format(
-            len(skipped_samples)))
+        # Grab the cached results
+        out_store.read_input_file(cache_tsv_key, local_filename)
             
     else:
         # Stats haven't been collated
         raise RuntimeError(
             "No graph stats for {}; run collateStatistics.py".format(region))
             
+    # Load a dict from graph name, then sample name, then stat name to actual
+    # stat value, for just the samples and stats we want.
+    stats_cache, skipped_samples = load_stats_cache(local_filename,
+        sample_whitelist=sample_whitelist, stat_whitelist=wanted_stats)
+            
+    RealTimeLogger.get().info("Skipped {} samples".format(
+        len(skipped_samples)))
+            
     # We want normalized and un-normalized versions of the stats cache
     stats_by_mode = {"absolute": stats_cache}
     
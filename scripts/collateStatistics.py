@@ -8,6 +8,9 @@ import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
 import doctest, re, json, collections, time, timeit
 import tempfile
 import copy
+import threading
+import multiprocessing.pool
+import datetime
 
 import numpy
 import tsv
@@ -45,7 +48,12 @@ def parse_args(args):
     parser.add_argument("--blacklist", action="append", default=[],
         help="ignore the specified regions, graphs, or region:graph pairs")
     parser.add_argument("--overwrite", action="store_true",
-        help="replace cached per-sample statistics with recalculated ones")
+        help="recalculate all cached per-sample statistics, not just changed "
+        "ones")
+    parser.add_argument("--fetch_threads", type=int, default=16,
+        help="number of stats files to download at once in each region")
+    parser.add_argument("--metrics_run", default=None,
+        help="name to save stage timing metrics under (default: start time)")
     
     # The command line arguments start with the program name, which we don't
     # want to treat as an argument for argparse. So we remove it.
@@ -106,275 +114,559 @@ def concatenate_results(job, options, inputs, output_key):
     
     
             
-def collate_region(job, options, region):
+def histogram_arrays(histogram):
     """
-    Collate all the stats files in a region. Returns a dict from graph and
-    sample and stat name to stat value, which may be cached.
+    Convert a histogram from a stats JSON (a dict from value string to count)
+    into a numpy array of values as floats and a numpy array of counts.
     
     """
     
-    # Set up the IO stores.
-    in_store = IOStore.get(options.in_store)
-    out_store = IOStore.get(options.out_store)
+    values = numpy.fromiter((float(x) for x in histogram.iterkeys()),
+        dtype=numpy.float64, count=len(histogram))
+    counts = numpy.fromiter(histogram.itervalues(), dtype=numpy.int64,
+        count=len(histogram))
+        
+    return values, counts
     
-    # This holds a dict from graph name, then sample name, then stat name to
-    # actual stst value.
-    stats_cache = collections.defaultdict(lambda: collections.defaultdict(dict))
+def summarize_stats(stats):
+    """
+    Given a loaded stats JSON dict for a sample, compute the stats we actually
+    care about. Returns a dict from stat name to value, or None if the sample
+    has no reads.
     
-    # This is the cache file for this region, in
-    # <graph>\t<sample>\t<stat>\t<value> format
-    cache_tsv_key = "plots/cache/{}.tsv".format(region)
+    Each histogram is converted to arrays once, and everything we want from it
+    is computed with array operations.
+    
+    """
+    
+    # How many reads are there overall for this sample?
+    total_reads = stats["total_reads"]
+    
+    if total_reads == 0:
+        return None
+    
+    # Convert all the histograms we use
+    matches_values, matches_counts = histogram_arrays(
+        stats["primary_matches_per_column"])
+    secondary_matches_values, secondary_matches_counts = histogram_arrays(
+        stats["secondary_matches_per_column"])
+    indels_values, indels_counts = histogram_arrays(stats["primary_indels"])
+    substitutions_values, substitutions_counts = histogram_arrays(
+        stats["primary_substitutions"])
+    mismatches_values, mismatches_counts = histogram_arrays(
+        stats["primary_mismatches"])
+    scores_values, scores_counts = histogram_arrays(stats["primary_scores"])
+    
+    # How many reads are mapped well enough?
+    total_mapped_well = int(matches_counts[matches_values >= 0.95].sum())
+    
+    # How many reads are multimapped well enough?
+    total_multimapped_well = int(secondary_matches_counts[
+        secondary_matches_values >= 0.95].sum())
+    # How many reads multimapped at all?
+    total_multimapped_at_all = int(secondary_matches_counts.sum())
+    
+    # How many reads are perfect?
+    total_perfect = int(matches_counts[matches_values == 1.0].sum())
+    
+    # How many reads have no indels?
+    total_no_indels = int(indels_counts[indels_values == 0].sum())
     
-    # What name will it have locally for us?
-    local_filename = os.path.join(job.fileStore.getLocalTempDir(), "temp.tsv")
+    # How many have any? This has always counted every bucket, so keep doing
+    # that.
+    total_with_indels = int(indels_counts.sum())
     
-    if out_store.exists(cache_tsv_key) and not options.overwrite:
-        # Just read in from that TSV
+    # How many have one? We'll guess these aren't terrible mappings.
+    total_one_indel = int(indels_counts[indels_values == 1].sum())
+    
+    # How many total substitution bases are there?
+    substitution_bases = float(numpy.dot(substitutions_counts,
+        substitutions_values))
+    
+    # How many total mismatches (substitutions + indels) are there?
+    mismatch_bases = float(numpy.dot(mismatches_counts, mismatches_values))
+    
+    # How many total indels are there?
+    indel_instances = float(numpy.dot(indels_counts, indels_values))
+    
+    # How many reads are mapped with no substitutions?
+    total_no_substitutions = int(substitutions_counts[
+        substitutions_values == 0].sum())
         
-        RealTimeLogger.get().info("Loading cached region {}".format(region))
+    # What's the total matches per column for primary mappings
+    total_matches_per_column = float(numpy.dot(matches_counts, matches_values))
+    
+    # What's the total score?
+    total_score = float(numpy.dot(scores_counts, scores_values))
+    
+    # How many reads are mapped at all for this sample (not just good enough)?
+    total_mapped_at_all = stats["total_mapped"]
+    
+    # How many reads do we know are sufficiently unique?
+    observed_unique = stats.get("total_sufficiently_unique", 0)
+    
+    # How many could we have seen if they were sufficiently unique?
+    observable = stats.get("total_secondary_visible", 0)
+    
+    # What was the runtime?
+    runtime = stats.get("run_time", None)
+    if runtime is None:
+        # We need NaN floats if there's no runtime
+        runtime = float("nan")
+    else:
+        # Convert to time per read aligned
+        runtime /= total_reads
+        
+    # Compute the stats we actually care about and save them
+    
+    # Make the dict we want to put the computed stats in
+    sample_stats = {}
+    
+    # How many reads are mapped well, single-mapped well, and existing at all?
+    # We need these for computing an overall perfect vs unique plot.
+    sample_stats["perfect"] = total_perfect
+    sample_stats["single_mapped_well"] = (total_mapped_well -
+        total_multimapped_well)
+    sample_stats["total_reads"] = total_reads
+    
+    # What portion have one good mapping?
+    sample_stats["portion_single_mapped_well"] = \
+        ((total_mapped_well - total_multimapped_well) / float(total_reads))
+    # What portion only have one mapping at all?
+    sample_stats["portion_single_mapped_at_all"] = \
+        ((total_mapped_at_all - total_multimapped_at_all) / float(total_reads))
+    # What portion of reads have a mapping that thinks it's unique by MAPQ?
+    sample_stats["portion_unique"] = (observed_unique / float(observable))
+    # What portion are mapped well?
+    sample_stats["portion_mapped_well"] = (total_mapped_well /
+        float(total_reads))
+    # What portion are perfect?
+    sample_stats["portion_perfect"] = (total_perfect / float(total_reads))
+    # What portion are mapped at all?
+    sample_stats["portion_mapped_at_all"] = (total_mapped_at_all / 
+        float(total_reads))
+    # What was the portion with no indels?
+    sample_stats["portion_no_indels"] = (total_no_indels / float(total_reads))
+    # And the potion mapped with indels (as opposed to unmapped)
+    # TODO: what part of this is horrible mappings with tiny scores overall?
+    sample_stats["portion_with_indels"] = (total_with_indels / 
+        float(total_reads))
+    # How many have one indel exactly?
+    sample_stats["portion_one_indel"] = (total_one_indel / float(total_reads))
+    # And the portion with no substitutions
+    sample_stats["portion_no_substitutions"] = \
+        (total_no_substitutions / float(total_reads))
+    
+    if total_mapped_at_all > 0:
+        # Some things we want to divide by the mapped reads
+    
+        # What's the average matches per column for primary alignments for
+        # reads that actually aligned?
+        sample_stats["mean_matches_per_column"] = \
+            (total_matches_per_column / float(total_mapped_at_all))
+        # What's the average score for primary alignments of reads that
+        # actually aligned?
+        sample_stats["mean_score"] = \
+            (total_score / float(total_mapped_at_all))
+    else:
+        # If no reads actually mapped we can just put 0
         
-        # Grab the cached results
-        out_store.read_input_file(cache_tsv_key, local_filename)
+        sample_stats["mean_matches_per_column"] = 0
+        sample_stats["mean_score"] = 0
         
-        # Read all the pop, value pairs from the TSV
-        reader = tsv.TsvReader(open(local_filename))
+    # What was the runtime?
+    sample_stats["runtime"] = runtime
+    
+    try:
+        # See if we have access to these extra stats
         
-        for graph, sample, stat, value in reader:
-            # Read in and place all the values
+        # How many total bases of reads have primary alignments (to non-Ns)?
+        aligned_values, aligned_counts = histogram_arrays(
+            stats["aligned_lengths"])
+        total_aligned = float(numpy.dot(aligned_counts, aligned_values))
+            
+        # The aligned bases are the ones that aren't in indels or
+        # leading/trailing softclips.
+        
+        # Calculate portion of aligned bases that are substitutions. Doesn't
+        # count indels at all.
+        sample_stats["substitution_rate"] = (substitution_bases /
+            total_aligned)
+            
+        # Calculate indels per base
+        sample_stats["indel_rate"] = (indel_instances / total_aligned)
+            
+    except:
+        # Sometimes we just won't have these stats available
+        pass
+        
+    return sample_stats
+
+def save_stats_cache(stats_cache, filename):
+    """
+    Save a dict from graph name, then sample name, then stat name to stat value
+    to the given file in columnar .npz format.
+
+    The file holds sorted tables of graph, sample, and stat names, plus one row
+    per value: a graph code, a sample code, and a stat code (each an index into
+    the appropriate name table, in the smallest integer type that fits), and
+    the float64 value itself.
+
+    """
+
+    # Assign each name a code
+    graph_names = sorted(stats_cache.iterkeys())
+    sample_names = sorted(set(sample for stats_by_sample in
+        stats_cache.itervalues() for sample in stats_by_sample.iterkeys()))
+    stat_names = sorted(set(stat for stats_by_sample in
+        stats_cache.itervalues() for stats_by_name in
+        stats_by_sample.itervalues() for stat in stats_by_name.iterkeys()))
+
+    sample_codes_by_name = {name: i for i, name in enumerate(sample_names)}
+    stat_codes_by_name = {name: i for i, name in enumerate(stat_names)}
+
+    # Collect the columns
+    graph_codes = []
+    sample_codes = []
+    stat_codes = []
+    values = []
+
+    for graph_code, graph in enumerate(graph_names):
+        # For each graph and all the stats for that graph
+        for sample, stats_by_name in stats_cache[graph].iteritems():
+            # For each sample and all the stats for that sample
+            for stat_name, stat_value in stats_by_name.iteritems():
+                # For each stat, add a row
+                graph_codes.append(graph_code)
+                sample_codes.append(sample_codes_by_name[sample])
+                stat_codes.append(stat_codes_by_name[stat_name])
+                values.append(stat_value)
+
+    def code_array(codes, names):
+        # Pack codes for the given names as small as they can go
+        return numpy.array(codes, dtype=numpy.min_scalar_type(
+            max(len(names) - 1, 0)))
+
+    # Pass a file object so numpy doesn't add its own extension
+    with open(filename, "wb") as npz_file:
+        numpy.savez_compressed(npz_file,
+            graphs=numpy.array(graph_names, dtype=str),
+            samples=numpy.array(sample_names, dtype=str),
+            stats=numpy.array(stat_names, dtype=str),
+            graph_codes=code_array(graph_codes, graph_names),
+            sample_codes=code_array(sample_codes, sample_names),
+            stat_codes=code_array(stat_codes, stat_names),
+            values=numpy.array(values, dtype=numpy.float64))
+
+def load_stats_cache(filename, sample_whitelist=None, stat_whitelist=None):
+    """
+    Load a region stats cache saved by save_stats_cache, or, if the filename
+    ends in ".tsv", an old-style <graph>\t<sample>\t<stat>\t<value> cache TSV.
+
+    If sample_whitelist or stat_whitelist is not None, ignores samples or stats
+    not in that set.
+
+    Returns a dict from graph name, then sample name, then stat name to stat
+    value, and a set of the sample names that were skipped.
+
+    """
+
+    # This holds a dict from graph name, then sample name, then stat name to
+    # actual stat value.
+    stats_cache = collections.defaultdict(lambda: collections.defaultdict(dict))
+
+    # Which samples are going to be skipped?
+    skipped_samples = set()
+
+    if filename.endswith(".tsv"):
+        # Read all the graph, sample, stat, value lines from the TSV
+        for graph, sample, stat, value in tsv.TsvReader(open(filename)):
+
+            if sample_whitelist is not None and sample not in sample_whitelist:
+                # Skip this sample that's not on the list
+                skipped_samples.add(sample)
+                continue
+
+            if stat_whitelist is not None and stat not in stat_whitelist:
+                # Skip this stat that we don't want
+                continue
+
+            # Populate our cache dict
             stats_cache[graph][sample][stat] = float(value)
+
+        return stats_cache, skipped_samples
+
+    with numpy.load(filename) as columns:
+        # Pull out the name tables and the columns
+        graph_names = columns["graphs"].tolist()
+        sample_names = columns["samples"].tolist()
+        stat_names = columns["stats"].tolist()
+        graph_codes = columns["graph_codes"]
+        sample_codes = columns["sample_codes"]
+        stat_codes = columns["stat_codes"]
+        values = columns["values"]
+
+    # Work out which rows we want
+    keep = numpy.ones(len(values), dtype=bool)
+
+    if sample_whitelist is not None:
+        # Decide on each sample once, and then look up each row's decision
+        sample_wanted = numpy.array([name in sample_whitelist
+            for name in sample_names], dtype=bool)
+        skipped_samples.update(name for name, wanted in
+            itertools.izip(sample_names, sample_wanted) if not wanted)
+        keep &= sample_wanted[sample_codes]
+
+    if stat_whitelist is not None:
+        # Same for stats
+        stat_wanted = numpy.array([name in stat_whitelist
+            for name in stat_names], dtype=bool)
+        keep &= stat_wanted[stat_codes]
+
+    for graph_code, sample_code, stat_code, value in itertools.izip(
+        graph_codes[keep].tolist(), sample_codes[keep].tolist(),
+        stat_codes[keep].tolist(), values[keep].tolist()):
+
+        # Populate our cache dict
+        stats_cache[graph_names[graph_code]][sample_names[sample_code]][
+            stat_names[stat_code]] = value
+
+    return stats_cache, skipped_samples
+
+# Stats fetching threads each keep their own IOStores in here, by store string,
+# so they don't share connections.
+fetch_thread_state = threading.local()
+    
+def fetch_sample_stats(store_string, key, temp_dir):
+    """
+    Download the stats JSON at the given key in the IOStore with the given
+    store string, and return its summary from summarize_stats. Uses a temporary
+    file in the given directory.
+    
+    Can be called from several threads at once.
+    
+    """
+    
+    if not hasattr(fetch_thread_state, "stores"):
+        # This is a new thread
+        fetch_thread_state.stores = {}
         
-    else:
+    if not fetch_thread_state.stores.has_key(store_string):
+        # Set up the IO store for this thread.
+        fetch_thread_state.stores[store_string] = IOStore.get(store_string)
+    
+    store = fetch_thread_state.stores[store_string]
+    
+    # Get a unique file to download to
+    handle, json_filename = tempfile.mkstemp(dir=temp_dir, suffix=".json")
+    os.close(handle)
     
-        # We need to populate the stats cache ourselves.
-        for graph in in_store.list_input_directory("stats/{}".format(region)):
-            # For each graph
+    try:
+        # Grab the file
+        store.read_input_file(key, json_filename)
+        # Read the JSON
+        with open(json_filename) as json_file:
+            stats = json.load(json_file)
+    finally:
+        os.unlink(json_filename)
         
-            if ("{}:{}".format(region, graph) in options.blacklist or 
-                region in options.blacklist or
-                graph in options.blacklist):
-                
-                # We don't want to process this region/graph pair.
-                RealTimeLogger.get().info("Skipping {} graph {}".format(region,
-                    graph))
-                continue
+    return summarize_stats(stats)
+    
+def collate_region(job, options, region):
+    """
+    Collate all the stats files in a region. Returns a dict from graph and
+    sample and stat name to stat value, which may be cached.
+    
+    Saves how long it took to the run's metrics.
+    
+    """
+    
+    # Measure how long each part of the job takes
+    monitor = ResourceMonitor(region=region, graph="all", sample="all")
+    
+    with monitor.stage("collate"):
+        stats_cache = collate_region_stats(job, options, region, monitor)
+        
+    # Save how long everything took
+    monitor.save(IOStore.get(options.out_store),
+        "metrics/{}/collate/{}.tsv".format(options.metrics_run, region))
+        
+    return stats_cache
+    
+def collate_region_stats(job, options, region, monitor):
+    """
+    Do the work of collate_region, measuring stages with the given
+    ResourceMonitor.
+    
+    """
+    
+    # Set up the IO stores.
+    in_store = IOStore.get(options.in_store)
+    out_store = IOStore.get(options.out_store)
+    
+    # This is the cache file for this region, in the columnar format that
+    # save_stats_cache writes
+    cache_npz_key = "plots/cache/{}.npz".format(region)
+    
+    # This is the old cache file for this region, in
+    # <graph>\t<sample>\t<stat>\t<value> format, which we still write for
+    # people to look at and read if we have nothing better
+    cache_tsv_key = "plots/cache/{}.tsv".format(region)
+    
+    # This records the modification time of the stats file that each cached
+    # sample's stats came from, in <graph>\t<sample>\t<mtime> format. Samples
+    # that had no reads are in here even though they aren't in the cache.
+    sources_tsv_key = "plots/cache/{}.sources.tsv".format(region)
+    
+    # This holds the ISO-format mtime string of the stats file that we have
+    # cached stats from, by (graph, sample) pair.
+    cached_mtimes = {}
+    
+    # What names will things have locally for us? Files we read may be symlinks
+    # into the store, so we write to different files.
+    local_dir = job.fileStore.getLocalTempDir()
+    local_filename = os.path.join(local_dir, "temp.tsv")
+    local_npz_filename = os.path.join(local_dir, "temp.npz")
+    output_filename = os.path.join(local_dir, "output.tsv")
+    output_npz_filename = os.path.join(local_dir, "output.npz")
+    
+    # Do we need to write out the columnar cache even if nothing changed?
+    need_npz = True
+    
+    if out_store.exists(sources_tsv_key) and not options.overwrite:
+        
+        if out_store.exists(cache_npz_key):
+            # Start from what we have in the cache
+            RealTimeLogger.get().info("Loading cached region {}".format(
+                region))
+            out_store.read_input_file(cache_npz_key, local_npz_filename)
+            stats_cache, _ = load_stats_cache(local_npz_filename)
+            need_npz = False
+        elif out_store.exists(cache_tsv_key):
+            # Start from the old-style cache, and upgrade it
+            RealTimeLogger.get().info("Loading cached region {} from "
+                "TSV".format(region))
+            out_store.read_input_file(cache_tsv_key, local_filename)
+            stats_cache, _ = load_stats_cache(local_filename)
+        else:
+            # We have sources but no cache to go with them
+            stats_cache = None
+        
+        if stats_cache is not None:
+            # Grab where they came from
+            out_store.read_input_file(sources_tsv_key, local_filename)
             
-            RealTimeLogger.get().info("Processing {} graph {}".format(region,
+            for graph, sample, mtime in tsv.TsvReader(open(local_filename)):
+                cached_mtimes[(graph, sample)] = mtime
+    else:
+        stats_cache = None
+        
+    if stats_cache is None:
+        # This holds a dict from graph name, then sample name, then stat name
+        # to actual stat value.
+        stats_cache = collections.defaultdict(
+            lambda: collections.defaultdict(dict))
+        
+    # Now work out all the (graph, sample name, stats key) fetches we have to
+    # do, for stats files that are new or changed since we cached them. This
+    # holds the mtime strings of all the current stats files by (graph, sample).
+    current_mtimes = {}
+    to_fetch = []
+    
+    for graph in in_store.list_input_directory("stats/{}".format(region)):
+        # For each graph
+    
+        if ("{}:{}".format(region, graph) in options.blacklist or 
+            region in options.blacklist or
+            graph in options.blacklist):
+            
+            # We don't want to process this region/graph pair.
+            RealTimeLogger.get().info("Skipping {} graph {}".format(region,
                 graph))
-            for result in in_store.list_input_directory("stats/{}/{}".format(
-                region, graph)):
+            continue
+        
+        RealTimeLogger.get().info("Processing {} graph {}".format(region,
+            graph))
+        for result, mtime in in_store.list_input_directory(
+            "stats/{}/{}".format(region, graph), with_times=True):
+        
+            # For every sample
             
-                # For every sample
-                
-                # Pull sample name from filename
-                sample_name = re.match("(.*)\.json$", result).group(1)
+            # Pull sample name from filename
+            sample_name = re.match("(.*)\.json$", result).group(1)
             
-                # Grab file
-                json_filename = os.path.join(job.fileStore.getLocalTempDir(),
-                    "temp.json")
-                in_store.read_input_file("stats/{}/{}/{}".format(region, graph,
-                    result), json_filename)
-                # Read the JSON
-                stats = json.load(open(json_filename))
-                
-                # Compute the answers for this sample
-                
-                # How many reads are mapped well enough?
-                total_mapped_well = sum((
-                    stats["primary_matches_per_column"].get(x)
-                    for x in stats["primary_matches_per_column"].iterkeys()
-                    if float(x) >= 0.95))
-                    
-                # How many reads are multimapped well enough?
-                total_multimapped_well = sum((
-                    stats["secondary_matches_per_column"].get(x)
-                    for x in stats["secondary_matches_per_column"].iterkeys()
-                    if float(x) >= 0.95))
-                # How many reads multimapped at all?
-                total_multimapped_at_all = sum((
-                    stats["secondary_matches_per_column"].get(x)
-                    for x in stats["secondary_matches_per_column"].iterkeys()))
-                    
-                # How many primary reads have MAPQs making them sufficiently
-                # unique?
-                total_unique = sum((
-                    stats["primary_mapqs"].get(x)
-                    for x in stats["primary_mapqs"].iterkeys()
-                    if float(x) >= 30))
-                    
-                # How many reads are perfect?
-                total_perfect = sum((
-                    stats["primary_matches_per_column"].get(x)
-                    for x in stats["primary_matches_per_column"].iterkeys()
-                    if float(x) == 1.0))
-                    
-                # How many reads have no indels?
-                total_no_indels = sum((stats["primary_indels"].get(str(x), 0)
-                    for x in xrange(1)))
-                
-                # How many have any?    
-                total_with_indels = sum((count for indels, count in 
-                    stats["primary_indels"].iteritems() if count != "0"))
-                    
-                # How many have one? We'll guess these aren't terrible mappings.
-                total_one_indel = stats["primary_indels"].get("1", 0)
-                    
-                # How many total substitution bases are there?
-                substitution_bases = sum((count * float(weight)
-                    for weight, count in 
-                    stats["primary_substitutions"].iteritems()))
-                    
-                # How many total mismatches (substitutions + indels) are there?
-                mismatch_bases = sum((count * float(weight)
-                    for weight, count in 
-                    stats["primary_mismatches"].iteritems()))
-                    
-                # How many total indels are there?
-                indel_instances = sum((count * float(weight)
-                    for weight, count in 
-                    stats["primary_indels"].iteritems()))
-                    
-                # How many reads are mapped with no substitutions?
-                total_no_substitutions = sum(
-                    (stats["primary_substitutions"].get(str(x), 0)
-                    for x in xrange(1)))
-                    
-                # What's the total matches per column for primary mappings
-                total_matches_per_column = sum((count * float(weight)
-                    for weight, count in 
-                    stats["primary_matches_per_column"].iteritems()))
+            # Remember the stats file version
+            mtime = mtime.isoformat() if mtime is not None else ""
+            current_mtimes[(graph, sample_name)] = mtime
+            
+            if (mtime == "" or
+                cached_mtimes.get((graph, sample_name), None) != mtime):
+                # We have no cached stats for this version of the file
+                to_fetch.append((graph, sample_name, "stats/{}/{}/{}".format(
+                    region, graph, result)))
                     
-                # What's the total score?
-                total_score = sum((count * float(weight)
-                    for weight, count in 
-                    stats["primary_scores"].iteritems()))
-                
-                # How many reads are there overall for this sample?
-                total_reads = stats["total_reads"]
+    # Which cached samples don't have stats files anymore (or are blacklisted
+    # now)?
+    to_drop = [pair for pair in cached_mtimes.iterkeys()
+        if not current_mtimes.has_key(pair)]
+        
+    for graph, sample_name in to_drop:
+        # Drop them from the cache
+        if stats_cache[graph].has_key(sample_name):
+            del stats_cache[graph][sample_name]
+        if len(stats_cache[graph]) == 0:
+            del stats_cache[graph]
                 
-                # If no reads got aligned, the sample is broken and we want to
-                # skip it (and make the user fix it).
-                if total_reads == 0:
+    RealTimeLogger.get().info("Fetching {} new or changed stats files with {} "
+        "threads, and dropping {}".format(len(to_fetch), options.fetch_threads,
+        len(to_drop)))
+        
+    # Download, parse, and summarize the files on a pool of threads, so we
+    # aren't waiting on one download at a time.
+    pool = multiprocessing.pool.ThreadPool(options.fetch_threads)
+    
+    def fetch(task):
+        graph, sample_name, key = task
+        # Each fetch downloads to its own unique file in the job's directory
+        return graph, sample_name, fetch_sample_stats(options.in_store,
+            key, local_dir)
+    
+    with monitor.stage("download"):
+        try:
+            for graph, sample_name, sample_stats in pool.imap_unordered(fetch,
+                to_fetch):
+            
+                if stats_cache[graph].has_key(sample_name):
+                    # Throw out the old version
+                    del stats_cache[graph][sample_name]
+            
+                if sample_stats is None:
+                    # If no reads got aligned, the sample is broken and we want
+                    # to skip it (and make the user fix it).
                     RealTimeLogger.get().warning(
                         "No reads available for {} {} {}".format(
                         region, graph, sample_name))
                     continue
                 
-                # How many reads are mapped at all for this sample (not just
-                # good enough)?
-                total_mapped_at_all = stats["total_mapped"]
-                
-                # How many reads do we know are sufficiently unique?
-                observed_unique = stats.get("total_sufficiently_unique", 0)
-                
-                # How many could we have seen if they were sufficiently unique?
-                observable = stats.get("total_secondary_visible", 0)
-                
-                # What was the runtime?
-                runtime = stats.get("run_time", None)
-                if runtime is None:
-                    # We need NaN floats if there's no runtime
-                    runtime = float("nan")
-                else:
-                    # Convert to time per read aligned
-                    runtime /= total_reads
-                    
-                # Compute the stats we actually care about and save them
-                
-                # Get the dict we want to put the computed stats in
-                sample_stats = stats_cache[graph][sample_name]
-                
-                # How many reads are mapped well, single-mapped well, and
-                # existing at all? We need these for computing an overall
-                # perfect vs unique plot.
-                sample_stats["perfect"] = total_perfect
-                sample_stats["single_mapped_well"] = (total_mapped_well -
-                    total_multimapped_well)
-                sample_stats["total_reads"] = total_reads
-                
-                # What portion have one good mapping?
-                sample_stats["portion_single_mapped_well"] = \
-                    ((total_mapped_well - total_multimapped_well) / 
-                    float(total_reads))
-                # What portion only have one mapping at all?
-                sample_stats["portion_single_mapped_at_all"] = \
-                    ((total_mapped_at_all - total_multimapped_at_all) / 
-                    float(total_reads))
-                # What portion of reads have a mapping that thinks it's unique
-                # by MAPQ?
-                sample_stats["portion_unique"] = \
-                    (observed_unique / float(observable))
-                # What portion are mapped well?
-                sample_stats["portion_mapped_well"] = (total_mapped_well /
-                    float(total_reads))
-                # What portion are perfect?
-                sample_stats["portion_perfect"] = (total_perfect /
-                    float(total_reads))
-                # What portion are mapped at all?
-                sample_stats["portion_mapped_at_all"] = (total_mapped_at_all / 
-                    float(total_reads))
-                # What was the portion with no indels?
-                sample_stats["portion_no_indels"] = (total_no_indels / 
-                    float(total_reads))
-                # And the potion mapped with indels (as opposed to unmapped)
-                # TODO: what part of this is horrible mappings with tiny scores
-                # overall?
-                sample_stats["portion_with_indels"] = (total_with_indels / 
-                    float(total_reads))
-                # How many have one indel exactly?
-                sample_stats["portion_one_indel"] = (total_one_indel / 
-                    float(total_reads))    
-                # And the portion with no substitutions
-                sample_stats["portion_no_substitutions"] = \
-                    (total_no_substitutions / float(total_reads))
-                
-                if total_mapped_at_all > 0:
-                    # Some things we want to divide by the mapped reads
-                
-                    # What's the average matches per column for primary alignments
-                    # for reads that actually aligned?
-                    sample_stats["mean_matches_per_column"] = \
-                        (total_matches_per_column / float(total_mapped_at_all))
-                    # What's the average score for primary alignments of reads that
-                    # actually aligned?
-                    sample_stats["mean_score"] = \
-                        (total_score / float(total_mapped_at_all))
-                else:
-                    # If no reads actually mapped we can just put 0
-                    
-                    sample_stats["mean_matches_per_column"] = 0
-                    sample_stats["mean_score"] = 0
-                    
-                # What was the runtime?
-                sample_stats["runtime"] = runtime
-                
-                try:
-                    # See if we have access to these extra stats
-                    
-                    # How many total bases of reads have primary alignments (to
-                    # non-Ns)?
-                    total_aligned = sum((count * float(weight)
-                        for weight, count in 
-                        stats["aligned_lengths"].iteritems()))
-                        
-                    # The aligned bases are the ones that aren't in indels or
-                    # leading/trailing softclips.
-                    
-                    # Calculate portion of aligned bases that are substitutions.
-                    # Doesn't count indels at all.
-                    sample_stats["substitution_rate"] = (substitution_bases /
-                        float(total_aligned))
-                        
-                    # Calculate indels per base
-                    sample_stats["indel_rate"] = (indel_instances /
-                        float(total_aligned))
-                        
-                except:
-                    # Sometimes we just won't have these stats available
-                    pass
-                    
-        
-        # Now save all these portion stats we extracted back to the cache
-        writer = tsv.TsvWriter(open(local_filename, "w"))
+                # Save the computed stats
+                stats_cache[graph][sample_name] = sample_stats
+        finally:
+            pool.close()
+            pool.join()
+        
+    for graph in list(stats_cache.iterkeys()):
+        if len(stats_cache[graph]) == 0:
+            # Don't keep graphs that have no usable samples left
+            del stats_cache[graph]
+    
+    if len(to_fetch) > 0 or len(to_drop) > 0 or need_npz:
+        # Now save all these portion stats we extracted back to the cache, in
+        # columnar form for loading quickly
+        save_stats_cache(stats_cache, output_npz_filename)
+        out_store.write_output_file(output_npz_filename, cache_npz_key)
+        
+        # And as a TSV for people to read
+        writer = tsv.TsvWriter(open(output_filename, "w"))
         
         for graph, stats_by_sample in stats_cache.iteritems():
             # For each graph and all the stats for that graph
@@ -388,7 +680,14 @@ def collate_region(job, options, region):
                 
         # Close the file and save the results for the next run
         writer.close()
-        out_store.write_output_file(local_filename, cache_tsv_key)        
+        out_store.write_output_file(output_filename, cache_tsv_key)
+        
+        # Save where they all came from, so we can tell what changes next time
+        writer = tsv.TsvWriter(open(output_filename, "w"))
+        for (graph, sample), mtime in current_mtimes.iteritems():
+            writer.line(graph, sample, mtime)
+        writer.close()
+        out_store.write_output_file(output_filename, sources_tsv_key)
     
     # We want normalized and un-normalized versions of the stats cache
     stats_by_mode = {"absolute": stats_cache}
@@ -626,6 +925,11 @@ def main(args):
     
     options = parse_args(args) # This holds the nicely-parsed options object
     
+    if options.metrics_run is None:
+        # Name this run's metrics after when it started
+        options.metrics_run = datetime.datetime.utcnow().strftime(
+            "%Y%m%d-%H%M%S")
+    
     RealTimeLogger.start_master()
     
     # Make a root job
@@ -635,6 +939,10 @@ def main(args):
     # Run it and see how many jobs fail
     failed_jobs = Job.Runner.startToil(root_job,  options)
     
+    # Put together the metrics from all the jobs that got that far
+    ResourceMonitor.merge(IOStore.get(options.out_store), "metrics/{}".format(
+        options.metrics_run), "metrics/{}.tsv".format(options.metrics_run))
+    
     if failed_jobs > 0:
         raise Exception("{} jobs failed!".format(failed_jobs))
         
@@ -7,7 +7,8 @@ depends on callVariants.py output directory structure. Can do:
 """
 
 import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
-import doctest, re, json, collections, time, timeit, string, math, copy
+import doctest, re, json, collections, time, timeit, string, math, copy, gzip
+import multiprocessing
 from collections import defaultdict
 from Bio.Phylo.TreeConstruction import _DistanceMatrix, DistanceTreeConstructor
 from Bio import Phylo
@@ -21,7 +22,9 @@ from toillib import RealTimeLogger, robust_makedirs
 from callVariants import alignment_sample_tag, alignment_region_tag, alignment_graph_tag, run
 from callVariants import graph_path, sample_vg_path, g1k_vg_path, graph_path, sample_txt_path
 from evaluateVariantCalls import defaultdict_set
-from vcfQualStats import vcf_qual_stats, balance_tables
+from vcfQualStats import vcf_qual_stats_parallel, balance_tables
+from vcfQualStats import read_bed_regions, overlaps_bed_regions
+import vcfFilterQuality
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description=__doc__, 
@@ -105,8 +108,15 @@ def parse_args(args):
                         help="used for vcfFilter for curves (when not --new): {xaad, ad, ll, xl}")
     parser.add_argument("--dedupe", action="store_true", default=False,
                         help="use --dedupe option in vcfFilterQuality.py")
+    parser.add_argument("--native_preprocess", action="store_true", default=False,
+                        help="preprocess vcfs in one pass in python instead of with shell tools"
+                        " (not used with --normalize)")
     parser.add_argument("--vroc", action="store_true", default=False,
                         help="use vcfevals roc logic (only gives total, not indel snp breakdown) and wont work with clipping")
+    parser.add_argument("--tsv_processes", type=int, default=multiprocessing.cpu_count(),
+                        help="number of processes to make output tables with")
+    parser.add_argument("--no_dist_cache", action="store_true", default=False,
+                        help="don't remember distances between runs in <comp_dir>/dist_cache.json")
     parser.add_argument("--cwd", default=os.getcwd(),
                         help="set Toil job working directory")
     parser.add_argument("--combine_samples", type=str, default=None,
@@ -145,6 +155,9 @@ def compute_kmer_index(job, graph, options):
         os.system("rm -rf {}".format(out_index_path))
         run("vg index {} {}".format(index_opts, graph), timeout_sec=options.timeout,
             timeout_dep=out_index_path)
+
+    # load the graph stats once here, so the comparisons don't have to
+    vg_stats(graph, options)
     
 def comp_path(graph1, graph2, options):
     """ get the path for json output of vg compare
@@ -289,18 +302,58 @@ def out_tsv_path(options, region, category, distance, sample = None):
     return os.path.join(options.comp_dir, "comp_tables",
                         category + "-" + distance + "-" + rtag + ".tsv")
 
-def vg_length(vg, options):
-    """ get sequence length out of vg stats
+def graph_stats_path(graph, options):
+    """ get the path of the cached vg stats (length, nodes, edges) for a graph
     """
-    if not os.path.exists(vg):
-        return -1
-    cmd = "vg stats -l {}".format(vg)
+    return graph + ".stats.json"
+
+def vg_stats(vg, options, cache=True):
+    """ get sequence length, node count and edge count out of vg stats. these
+    are saved next to the graph, and only recomputed if the graph's mtime changes
+    """
+    mtime = os.path.getmtime(vg)
+    stats_path = graph_stats_path(vg, options)
+    if cache and os.path.isfile(stats_path):
+        try:
+            with open(stats_path) as f:
+                stats = json.load(f)
+            if stats["mtime"] == mtime:
+                return stats
+        except Exception as e:
+            RealTimeLogger.get().warning("Ignoring bad stats cache {} because {}".format(stats_path, e))
+    cmd = "vg stats -z -l {}".format(vg)
     p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
                          stderr=sys.stderr, bufsize=-1)
     output, _ = p.communicate()
     assert p.wait() == 0
-    length = int(output.split()[1])
-    return length    
+    stats = {"mtime" : mtime}
+    for line in output.split("\n"):
+        toks = line.split()
+        if len(toks) == 2:
+            stats[toks[0]] = int(toks[1])
+    if cache:
+        # write atomically, as comparison jobs may be reading it
+        temp_path = stats_path + ".tmp.{}".format(os.getpid())
+        with open(temp_path, "w") as f:
+            json.dump(stats, f)
+        os.rename(temp_path, stats_path)
+    return stats
+
+def have_vg_stats(vg, options):
+    """ check if a graph's stats are cached and up to date
+    """
+    try:
+        with open(graph_stats_path(vg, options)) as f:
+            return json.load(f)["mtime"] == os.path.getmtime(vg)
+    except:
+        return False
+
+def vg_length(vg, options, cache=True):
+    """ get sequence length out of vg stats
+    """
+    if not os.path.exists(vg):
+        return -1
+    return vg_stats(vg, options, cache)["length"]
 
 def raw_tsv_path(options, region, category, distance, sample = None):
     """ get the output tsv path for "raw" tables (ie with nones for missing data)
@@ -564,9 +617,9 @@ def vcfeval_dist_fn(graph1, graph2, options):
     ## use vcfevals roc
     if options.vroc is True:
         roc_path = os.path.join(out_dir, "weighted_roc.tsv")
-        run("gzip -dc {} > {}".format(roc_path + ".gz", roc_path))
         ret = []
-        with open(roc_path) as f:
+        # read it compressed, rather than writing out a new uncompressed copy every time
+        with gzip.open(roc_path + ".gz") as f:
             for line in f:
                 if line[0] != "#" and len(line) > 0:
                     toks = line.split("\t")
@@ -614,6 +667,91 @@ def vcfeval_dist_fn(graph1, graph2, options):
 
     return ret
     
+def dist_fn_sources(dist_fn, graph1, graph2, options):
+    """ get the list of files a distance function reads for a pair of graphs, 
+    or None if we don't know them """
+    if dist_fn in [jaccard_dist_fn, recall_dist_fn, precision_dist_fn]:
+        return [comp_path(graph1, graph2, options)]
+    elif dist_fn == corg_dist_fn:
+        return [corg_path(min(graph1, graph2), max(graph1, graph2), options)]
+    elif dist_fn == vcf_dist_fn:
+        return [comp_path_vcf(graph1, graph2, options)]
+    elif dist_fn == sompy_dist_fn:
+        return [comp_path_sompy(graph1, graph2, options)]
+    elif dist_fn == happy_dist_fn:
+        jpath = comp_path_happy(graph1, graph2, options)
+        return [jpath, jpath.replace("summary.csv", "roc.snp.all.tsv")]
+    elif dist_fn == vcfeval_dist_fn:
+        out_dir = comp_path_vcfeval(graph1, graph2, options)
+        if options.vroc is True:
+            return [os.path.join(out_dir, "weighted_roc.tsv.gz")]
+        return [os.path.join(out_dir, "comp_counts_{}.tsv".format(name))
+                for name in ["fn", "fp", "tp"]]
+    return None
+
+class DistanceCache(object):
+    """ remember what distance functions return for pairs of graphs, in a json file
+    on disk, so that each comparison is only loaded once no matter how many tables
+    it goes in.  a result is thrown out if the files it came from change 
+    """
+    def __init__(self, cache_path, options):
+        self.cache_path = cache_path
+        self.options = options
+        # map key string -> [file mtimes, result]
+        self.entries = dict()
+        # keys added or changed since loading
+        self.updated = set()
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                with open(cache_path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                RealTimeLogger.get().warning("Ignoring corrupt distance cache {}".format(cache_path))
+
+    def key(self, dist_fn, graph1, graph2):
+        """ key for a result. includes the options that change how files are read """
+        return "\t".join([dist_fn.__name__, graph1, graph2, self.options.comp_type,
+                          str(self.options.roc), str(self.options.vroc)])
+
+    def signature(self, dist_fn, graph1, graph2):
+        """ get the mtimes of the files the result depends on (None if missing) """
+        sources = dist_fn_sources(dist_fn, graph1, graph2, self.options)
+        if sources is None:
+            return None
+        return [[path, os.path.getmtime(path) if os.path.exists(path) else None]
+                for path in sources]
+
+    def get(self, dist_fn, graph1, graph2):
+        """ get the result of the distance function, computing it if we don't have it """
+        key = self.key(dist_fn, graph1, graph2)
+        signature = self.signature(dist_fn, graph1, graph2)
+        if signature is not None and key in self.entries and self.entries[key][0] == signature:
+            # callers modify the rows, so don't give out our copy
+            return copy.deepcopy(self.entries[key][1])
+        result = dist_fn(graph1, graph2, self.options)
+        if signature is not None:
+            self.entries[key] = [signature, copy.deepcopy(result)]
+            self.updated.add(key)
+        return result
+
+    def wrap(self, dist_fn):
+        """ make a version of the distance function that goes through the cache """
+        def cached_dist_fn(graph1, graph2, options):
+            return self.get(dist_fn, graph1, graph2)
+        cached_dist_fn.__name__ = dist_fn.__name__
+        return cached_dist_fn
+
+    def save(self):
+        """ write the cache back to disk (atomically) if anything changed """
+        if self.cache_path is None or len(self.updated) == 0:
+            return
+        robust_makedirs(os.path.dirname(os.path.abspath(self.cache_path)))
+        temp_path = self.cache_path + ".tmp.{}".format(os.getpid())
+        with open(temp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.rename(temp_path, self.cache_path)
+        self.updated = set()
+
 def make_mat(options, row_graphs, column_graphs, dist_fns):
     """ make a distance matix """
     mat = []
@@ -711,9 +849,10 @@ def generate_combined_vcfeval_sample(region, method, baseline_method, graphs, ba
 
             # generate the roc tables. 
             # this is slow if clipping enabled, and would ideally get moved under toil
-            fn_table = vcf_qual_stats(out_vcfs[0] + ".gz", options.clip, ignore_keywords = ["OverlapConflict"])
-            fp_table = vcf_qual_stats(out_vcfs[1] + ".gz", options.clip_fp if options.clip_fp else options.clip)
-            tp_table = vcf_qual_stats(out_vcfs[2] + ".gz", options.clip)
+            fn_table, fp_table, tp_table = vcf_qual_stats_parallel([
+                (out_vcfs[0] + ".gz", options.clip, ["OverlapConflict"]),
+                (out_vcfs[1] + ".gz", options.clip_fp if options.clip_fp else options.clip, []),
+                (out_vcfs[2] + ".gz", options.clip, [])])
             save_vcfeval_stats(out_vcfeval_dir, fn_table, fp_table, tp_table)
 
         # now we stick a new entry back in options tables so COMBINED gets iterated over
@@ -733,10 +872,9 @@ def generate_combined_vcfeval_sample(region, method, baseline_method, graphs, ba
         RealTimeLogger.get().warning("{}".format(str(in_vcfs)))
 
                     
-def make_tsvs(options):
-    """ make some tsv files in the output dir
+def get_dist_fns(options):
+    """ get the distance column names and functions for the comparison type
     """
-
     if options.comp_type == "kmer":
         dist_names = ["Jaccard-Dist", "Precision", "Recall"]
         dist_fns = [jaccard_dist_fn, precision_dist_fn, recall_dist_fn]
@@ -757,165 +895,182 @@ def make_tsvs(options):
         dist_fns = [vcfeval_dist_fn]
     else:
         assert False
-        
-    # break apart by region
-    for region in options.sample_graphs.keys():
+    return dist_names, dist_fns
 
-        # do the baseline tsvs.  this is one row per graph,
-        # with one column per comparison type with truth
+def make_baseline_tsv(options, dist_names, dist_fns, region, sample, baseline):
+    """ do the baseline tsv for a region and sample.  this is one row per graph,
+    with one column per comparison type with truth
+    """
+    header = dist_names
+    RealTimeLogger.get().info("Making {} baseline tsv for {} {}".format(baseline, region, sample))
+    mat = []
+    row_labels = []
+    for truth in options.baseline_graphs[region][sample]:
+        if options.tags[truth][2] == baseline:
+            for graph in options.sample_graphs[region][sample]:
+                rows = []
+                for d in dist_fns:
+                    try:
+                        dist_res = d(graph, truth, options)
+                    except Exception as e:
+                        RealTimeLogger.get().warning("Unable to retrieve distance between {} and {} because {}".format(graph, truth, e))
+                        dist_res = [[None] * len(header)]
+                    for ri, r in enumerate(dist_res):
+                        if d == dist_fns[0]:
+                            rows.append(r)
+                            row_labels.append(options.tags[graph][2])
+                        else:
+                            rows[ri] += r
+                for row in rows:
+                    mat.append(row)
+            break # shoud not be necessary
+    # write the baseline matrix (with None for missing data) to file 
+    tsv_path = raw_tsv_path(options, region, baseline, options.comp_type, sample)
+    write_tsv(tsv_path, mat, header, row_labels, "Graph")
+
+    # remove Nones and write tsv again
+    clean_mat, clean_header, clean_row_labels = remove_nones(mat, header, row_labels)
+    tsv_path = out_tsv_path(options, region, baseline, options.comp_type, sample)
+    write_tsv(tsv_path, clean_mat, clean_header, clean_row_labels, "Graph")
+
+def make_heatmap_tsv(options, dist_names, di, d, region, category):
+    """ make a graph vs graph heatmap tsv for one distance in a region.  category
+    is hm-sample (sample vs sample), hm-orig (original vs original), or 
+    hm-orig_and_sample (sample + original vs sample + original)
+    """
+    header = dist_names
+    RealTimeLogger.get().info("Making {} {} tsv for {}".format(dist_names[di], category, region))
+    heatmap = defaultdict(lambda : defaultdict(list))
+    if category == "hm-orig":
+        # one set of graphs, no averaging needed
+        graph_sets = [(None, options.orig_graphs[region])]
+    elif category == "hm-sample":
+        graph_sets = [(options.sample_graphs[region][sample], options.sample_graphs[region][sample])
+                      for sample in options.sample_graphs[region].keys()]
+    else:
+        assert category == "hm-orig_and_sample"
+        graph_sets = [(options.sample_graphs[region][sample],
+                       options.sample_graphs[region][sample].union(options.orig_graphs[region]))
+                      for sample in options.sample_graphs[region].keys()]
+    for sample_graphs, graph_set in graph_sets:
+        for graph1 in graph_set:
+            for graph2 in graph_set:
+                try:
+                    dist_res = d(graph1, graph2, options)
+                except Exception as e:
+                    RealTimeLogger.get().warning("Unable to retrieve distance between {} and {} because {}".format(graph1, graph2, e))
+                    dist_res = [[None] * len(header)]
+                    # only ever deal with 1 row here
+                assert len(dist_res) == 1
+                name_1 = options.tags[graph1][2]
+                name_2 = options.tags[graph2][2]
+                if category == "hm-orig_and_sample":
+                    name_1 = ("sample-" if graph1 in sample_graphs else "base-") + name_1
+                    name_2 = ("sample-" if graph2 in sample_graphs else "base-") + name_2
+                if category == "hm-orig":
+                    heatmap[name_1][name_2] = dist_res[0][0]
+                else:
+                    heatmap[name_1][name_2].append(dist_res[0][0])
+    if category != "hm-orig":
+        #average over samples
+        for x in heatmap.keys():
+            for y in heatmap.keys():
+                heatmap[x][y] = n_avg(heatmap[x][y])
+    # make matrix
+    mat = []
+    header = heatmap.keys()
+    row_labels = heatmap.keys()
+    for x in row_labels:
+        row = []
+        for y in header:
+            row.append(heatmap[x][y])
+        mat.append(row)
+    # write the heatmap matrix (with None for missing data) to file 
+    tsv_path = raw_tsv_path(options, region, category, dist_names[di])
+    write_tsv(tsv_path, mat, header, row_labels, "Graph")
+
+    # remove Nones and write tsv again
+    clean_mat, clean_header, clean_row_labels = remove_nones(mat, header, row_labels)
+    tsv_path = out_tsv_path(options, region, category, dist_names[di])
+    write_tsv(tsv_path, clean_mat, clean_header, clean_row_labels, "Graph")
+
+# table making processes get the options (which may not pickle) and the distance
+# cache by forking from make_tsvs, which sets these first
+tsv_options = None
+tsv_dist_cache = None
+
+def make_tsv_task(task):
+    """ make the table(s) for a task tuple from make_tsvs, returning the new
+    distance cache entries it computed
+    """
+    options = tsv_options
+    dist_names, dist_fns = get_dist_fns(options)
+    tsv_dist_cache.updated = set()
+    dist_fns = [tsv_dist_cache.wrap(d) for d in dist_fns]
+
+    try:
+        if task[0] == "baseline":
+            _, region, sample, baseline = task
+            make_baseline_tsv(options, dist_names, dist_fns, region, sample, baseline)
+        else:
+            category, region, di = task
+            make_heatmap_tsv(options, dist_names, di, dist_fns[di], region, category)
+    finally:
+        # pool workers exit without shutting down logging, so send our warnings now
+        RealTimeLogger.flush()
+
+    return dict((key, tsv_dist_cache.entries[key]) for key in tsv_dist_cache.updated)
+
+def make_tsvs(options):
+    """ make some tsv files in the output dir.  each region and sample's baseline
+    table, and each region's heatmaps, are made in parallel processes
+    """
+    global tsv_options, tsv_dist_cache
+
+    dist_names, dist_fns = get_dist_fns(options)
+
+    # load each comparison only once, even across runs
+    dist_cache = DistanceCache(None if options.no_dist_cache else
+                               os.path.join(options.comp_dir, "dist_cache.json"), options)
+
+    # one task per table (or set of baseline tables)
+    tasks = []
+    # break apart by region
+    for region in sorted(options.sample_graphs.keys()):
         #for baseline in ["g1kvcf", "platvcf"]:
         for baseline in ["platvcf"]:
-            for sample in options.sample_graphs[region].keys():
-                header = dist_names
-                RealTimeLogger.get().info("Making {} baseline tsv for {} {}".format(baseline, region, sample))
-                mat = []
-                row_labels = []
-                for truth in options.baseline_graphs[region][sample]:
-                    if options.tags[truth][2] == baseline:
-                        for graph in options.sample_graphs[region][sample]:
-                            rows = []
-                            for d in dist_fns:
-                                try:
-                                    dist_res = d(graph, truth, options)
-                                except Exception as e:
-                                    RealTimeLogger.get().warning("Unable to retrieve distance between {} and {} because {}".format(graph, truth, e))
-                                    dist_res = [[None] * len(header)]
-                                for ri, r in enumerate(dist_res):
-                                    if d == dist_fns[0]:
-                                        rows.append(r)
-                                        row_labels.append(options.tags[graph][2])
-                                    else:
-                                        rows[ri] += r
-                            for row in rows:
-                                mat.append(row)
-                        break # shoud not be necessary
-                # write the baseline matrix (with None for missing data) to file 
-                tsv_path = raw_tsv_path(options, region, baseline, options.comp_type, sample)
-                write_tsv(tsv_path, mat, header, row_labels, "Graph")
-
-                # remove Nones and write tsv again
-                clean_mat, clean_header, clean_row_labels = remove_nones(mat, header, row_labels)
-                tsv_path = out_tsv_path(options, region, baseline, options.comp_type, sample)
-                write_tsv(tsv_path, clean_mat, clean_header, clean_row_labels, "Graph")
-
+            for sample in sorted(options.sample_graphs[region].keys()):
+                tasks.append(("baseline", region, sample, baseline))
         # sample vs sample heatmap
         if options.sample:
-            for di, d in enumerate(dist_fns):
-                RealTimeLogger.get().info("Making {} sample tsv for {}".format(dist_names[di], region))
-                sample_vs_sample = defaultdict(lambda : defaultdict(list))
-                for sample in options.sample_graphs[region].keys():
-                    for graph1 in options.sample_graphs[region][sample]:
-                        for graph2 in options.sample_graphs[region][sample]:
-                            try:
-                                dist_res = d(graph1, graph2, options)
-                            except Exception as e:
-                                RealTimeLogger.get().warning("Unable to retrieve distance between {} and {} because {}".format(graph1, graph2, e))
-                                dist_res = [[None] * len(header)]
-                                # only ever deal with 1 row here
-                            assert len(dist_res) == 1
-                            sample_vs_sample[options.tags[graph1][2]][options.tags[graph2][2]].append(dist_res[0][0])
-                #average over samples
-                for x in sample_vs_sample.keys():
-                    for y in sample_vs_sample.keys():
-                        sample_vs_sample[x][y] = n_avg(sample_vs_sample[x][y])
-                # make matrix
-                mat = []
-                header = sample_vs_sample.keys()
-                row_labels = sample_vs_sample.keys()
-                for x in row_labels:
-                    row = []
-                    for y in header:
-                        row.append(sample_vs_sample[x][y])
-                    mat.append(row)
-                # write the heatmap matrix (with None for missing data) to file 
-                tsv_path = raw_tsv_path(options, region, "hm-sample", dist_names[di])
-                write_tsv(tsv_path, mat, header, row_labels, "Graph")
-
-                # remove Nones and write tsv again
-                clean_mat, clean_header, clean_row_labels = remove_nones(mat, header, row_labels)
-                tsv_path = out_tsv_path(options, region, "hm-sample", dist_names[di])
-                write_tsv(tsv_path, clean_mat, clean_header, clean_row_labels, "Graph")
-
+            tasks += [("hm-sample", region, di) for di in range(len(dist_fns))]
         # original vs original heatmap
         if options.orig:
-            RealTimeLogger.get().info("Making {} orig tsv for {}".format(dist_names[di], region))
-            for di, d in enumerate(dist_fns):
-                orig_vs_orig = defaultdict(lambda : defaultdict(list))
-                for graph1 in options.orig_graphs[region]:
-                    for graph2 in options.orig_graphs[region]:
-                        try:
-                            dist_res = d(graph1, graph2, options)
-                        except Exception as e:
-                            RealTimeLogger.get().warning("Unable to retrieve distance between {} and {} because {}".format(graph1, graph2, e))
-                            dist_res = [[None] * len(header)]
-                            # only ever deal with 1 row here
-                        assert len(dist_res) == 1
-                        orig_vs_orig[options.tags[graph1][2]][options.tags[graph2][2]] = dist_res[0][0]
-                # make matrix
-                mat = []
-                header = orig_vs_orig.keys()
-                row_labels = orig_vs_orig.keys()
-                for x in row_labels:
-                    row = []
-                    for y in header:
-                        row.append(orig_vs_orig[x][y])
-                    mat.append(row)
-                # write the heatmap matrix (with None for missing data) to file 
-                tsv_path = raw_tsv_path(options, region, "hm-orig", dist_names[di])
-                write_tsv(tsv_path, mat, header, row_labels, "Graph")
-
-                # remove Nones and write tsv again
-                clean_mat, clean_header, clean_row_labels = remove_nones(mat, header, row_labels)
-                tsv_path = out_tsv_path(options, region, "hm-orig", dist_names[di])
-                write_tsv(tsv_path, clean_mat, clean_header, clean_row_labels, "Graph")
-
+            tasks += [("hm-orig", region, di) for di in range(len(dist_fns))]
         # sample vs original heatmap
         if options.orig_and_sample:
-            for di, d in enumerate(dist_fns):
-                RealTimeLogger.get().info("Making {} sample tsv for {}".format(dist_names[di], region))
-                sample_vs_orig = defaultdict(lambda : defaultdict(list))
-                for sample in options.sample_graphs[region].keys():
-                    for graph1 in options.sample_graphs[region][sample].union(options.orig_graphs[region]):
-                        for graph2 in options.sample_graphs[region][sample].union(options.orig_graphs[region]):
-                            try:
-                                dist_res = d(graph1, graph2, options)
-                            except Exception as e:
-                                RealTimeLogger.get().warning("Unable to retrieve distance between {} and {} because {}".format(graph1, graph2, e))
-                                dist_res = [[None] * len(header)]
-                                # only ever deal with 1 row here
-                            assert len(dist_res) == 1
-                            name_1 = options.tags[graph1][2]
-                            if graph1 in options.sample_graphs[region][sample]:
-                                name_1 = "sample-" + name_1
-                            else:
-                                name_1 = "base-" + name_1
-                            name_2 = options.tags[graph2][2]
-                            if graph2 in options.sample_graphs[region][sample]:
-                                name_2 = "sample-" + name_2
-                            else:
-                                name_2 = "base-" + name_2
-                            sample_vs_orig[name_1][name_2].append(dist_res[0][0])
-                #average over samples                            
-                for x in sample_vs_orig.keys():
-                    for y in sample_vs_orig.keys():
-                        sample_vs_orig[x][y] = n_avg(sample_vs_orig[x][y])
-                # make matrix
-                mat = []
-                header = sample_vs_orig.keys()
-                row_labels = sample_vs_orig.keys()
-                for x in row_labels:
-                    row = []
-                    for y in header:
-                        row.append(sample_vs_orig[x][y])
-                    mat.append(row)
-                # write the heatmap matrix (with None for missing data) to file 
-                tsv_path = raw_tsv_path(options, region, "hm-orig_and_sample", dist_names[di])
-                write_tsv(tsv_path, mat, header, row_labels, "Graph")
-
-                # remove Nones and write tsv again
-                clean_mat, clean_header, clean_row_labels = remove_nones(mat, header, row_labels)
-                tsv_path = out_tsv_path(options, region, "hm-orig_and_sample", dist_names[di])
-                write_tsv(tsv_path, clean_mat, clean_header, clean_row_labels, "Graph")
+            tasks += [("hm-orig_and_sample", region, di) for di in range(len(dist_fns))]
+
+    tsv_options = options
+    tsv_dist_cache = dist_cache
+    processes = min(options.tsv_processes, len(tasks))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(make_tsv_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(make_tsv_task, tasks)
+
+    # merge the new cache entries in task order, so the result is the same
+    # however the tasks were scheduled
+    for new_entries in results:
+        for key in sorted(new_entries.keys()):
+            dist_cache.entries[key] = new_entries[key]
+            dist_cache.updated.add(key)
+    dist_cache.save()
                 
         
 def write_tsv(out_path, mat, col_names, row_names, row_label):
@@ -1035,7 +1190,7 @@ def compute_corg_comparison(job, graph1, graph2, options):
             timeout_dep=out_path)
         len1 = vg_length(graph1, options)
         len2 = vg_length(graph2, options)
-        lenC = vg_length(corg_vg, options)
+        lenC = vg_length(corg_vg, options, cache=False)
         # corg screwing up will leave an empty vg which gives length 0
         if lenC == 0:
             corg_val = "error: corg graph not computed. see .log"
@@ -1045,6 +1200,103 @@ def compute_corg_comparison(job, graph1, graph2, options):
         with open(out_path, "w") as f:
             f.write("{}\n".format(corg_val))
 
+def quality_filter_opts(graph, options):
+    """ get the extra vcfFilterQuality.py options to apply to a graph's vcf, 
+    or None if it isn't quality filtered
+    """
+    if options.qpct is not None and (options.tags[graph][2] in ["gatk3", "platypus", "freebayes", "samtools"] or
+                                     (options.tags[graph][2] == "g1kvcf" and options.baseline != "g1kvcf") or
+                                     options.qgraph is True):
+        # g1kvcf has no quality info.  proxy with read depth to at least get a curve
+        #filter_opts = "--info DP" if options.tags[graph][2] == "g1kvcf" else ""
+        if "platvcf" not in options.tags[graph][2]:
+            filter_opts = []
+            if options.tags[graph][2] not in ["gatk3", "platypus", "freebayes", "samtools", "g1kvcf", "platvcf", "platvcf-baseline"]:
+                #filter_opts += " --info DP"
+                filter_opts.append("--{}".format(options.filter_type) if not options.new else "--ad")
+                if options.dedupe:
+                    filter_opts.append("--dedupe")
+            return filter_opts
+    return None
+
+def preprocess_vcf_native(graph, input_vcf, output_vcf, options):
+    """ do the sort, quality filter, bed clip, keyword filter, genotype stripping
+    and dedupe of preprocess_vcf's shell pipeline in one pass, writing the vcf and
+    its bgzipped copy together (ignore keywords are matched as plain strings) """
+
+    # vcfsort: headers, then records by contig and position
+    headers = []
+    records = []
+    with open(input_vcf) as vcf_file:
+        for line in vcf_file:
+            if not line.strip():
+                continue
+            # the last line may be missing its newline but can sort anywhere
+            line = line.rstrip("\n") + "\n"
+            if line[0] == "#":
+                headers.append(line)
+            else:
+                toks = line.split("\t", 2)
+                records.append((toks[0], int(toks[1]), line))
+    records.sort()
+    lines = headers + [record[2] for record in records]
+    records = None
+
+    filter_opts = quality_filter_opts(graph, options)
+    if filter_opts is not None:
+        filter_options = vcfFilterQuality.parse_args(["vcfFilterQuality.py", "-", str(options.qpct),
+                                                      "--pct", "--set_qual"] + filter_opts)
+        lines = vcfFilterQuality.filter_vcf_lines(lines, filter_options)
+
+    regions = None
+    if options.clip is not None and options.comp_type != "vcfeval":
+        clip_bed = clip_bed_path(graph, options)        
+        if not os.path.isfile(clip_bed):
+            RealTimeLogger.get().warning("Clip bed file not found {}".format(clip_bed))
+        else:
+            regions = read_bed_regions(clip_bed)
+
+    set_gt = not options.gt and options.comp_type != "vcfeval"
+
+    # need compressed index for vcfeval
+    with open(output_vcf + ".gz", "w") as gz_file:
+        bgzip = subprocess.Popen(["bgzip", "-c"], stdin=subprocess.PIPE, stdout=gz_file,
+                                 bufsize=-1)
+    try:
+        last_key = None
+        with open(output_vcf, "w") as out_file:
+            for line in lines:
+                if any(ignore_keyword in line for ignore_keyword in options.ignore):
+                    continue
+                if line[0] != "#":
+                    toks = line.split("\t")
+                    pos = int(toks[1])
+                    # bcftools view -R keeps records whose reference overlaps the bed
+                    if regions is not None and not overlaps_bed_regions(regions, toks[0], pos - 1,
+                                                                        pos - 1 + len(toks[3])):
+                        continue
+                    # vcfuniq
+                    key = (toks[0], pos, toks[3], toks[4])
+                    if key == last_key:
+                        continue
+                    last_key = key
+                    # strip genotypes
+                    if set_gt:
+                        toks[-1] = "0/1\n"
+                        line = "\t".join(toks)
+                out_file.write(line)
+                bgzip.stdin.write(line)
+        bgzip.stdin.close()
+    except:
+        # don't leave bgzip behind on a half written file
+        bgzip.kill()
+        bgzip.stdin.close()
+        bgzip.wait()
+        raise
+    if bgzip.wait() != 0:
+        raise RuntimeError("bgzip failed on {}".format(output_vcf))
+    run("tabix -f -p vcf {}".format(output_vcf + ".gz"), fail_hard=True)
+
 def preprocess_vcf(job, graph, options):
     """ run vt normalize and bed clip"""
     
@@ -1055,27 +1307,24 @@ def preprocess_vcf(job, graph, options):
     output_vcf = preprocessed_vcf_path(graph, options)
     robust_makedirs(os.path.dirname(output_vcf))
 
-    run("scripts/vcfsort {} > {}".format(input_vcf, output_vcf), fail_hard=True)
+    if options.native_preprocess:
+        if options.normalize is True:
+            RealTimeLogger.get().info("Using shell preprocessing for {} as vt normalization is required".format(
+                input_vcf))
+        else:
+            preprocess_vcf_native(graph, input_vcf, output_vcf, options)
+            return
 
-    if options.qpct is not None and (options.tags[graph][2] in ["gatk3", "platypus", "freebayes", "samtools"] or
-                                     (options.tags[graph][2] == "g1kvcf" and options.baseline != "g1kvcf") or
-                                     options.qgraph is True):
-        # g1kvcf has no quality info.  proxy with read depth to at least get a curve
-        #filter_opts = "--info DP" if options.tags[graph][2] == "g1kvcf" else ""
-        if "platvcf" not in options.tags[graph][2]:
-            filter_opts = ""
-            vcfFQcmd = "cat {} | ".format(output_vcf)
-            if options.tags[graph][2] not in ["gatk3", "platypus", "freebayes", "samtools", "g1kvcf", "platvcf", "platvcf-baseline"]:
-                #filter_opts += " --info DP"
-                filter_opts += " --{}".format(options.filter_type) if not options.new else " --ad"
-                if options.dedupe:
-                    filter_opts += " --dedupe"
+    run("scripts/vcfsort {} > {}".format(input_vcf, output_vcf), fail_hard=True)
 
-            vcfFQcmd += "scripts/vcfFilterQuality.py - {} --pct {} --set_qual > {}".format(options.qpct,
-                                                                                           filter_opts,
-                                                                                           output_vcf + ".qpct")
-            run(vcfFQcmd)
-            run("cp {} {}".format(output_vcf + ".qpct", output_vcf))
+    filter_opts = quality_filter_opts(graph, options)
+    if filter_opts is not None:
+        vcfFQcmd = "cat {} | ".format(output_vcf)
+        vcfFQcmd += "scripts/vcfFilterQuality.py - {} --pct {} --set_qual > {}".format(options.qpct,
+                                                                                       " ".join(filter_opts),
+                                                                                       output_vcf + ".qpct")
+        run(vcfFQcmd)
+        run("cp {} {}".format(output_vcf + ".qpct", output_vcf))
     
 
     if options.normalize is True:# and options.tags[graph][2] not in ["gatk3", "platypus", "freebayes", "samtools", "g1kvcf", "platvcf", "platvcf-baseline"]:
@@ -1210,9 +1459,11 @@ def compute_vcf_comparison(job, graph1, graph2, options):
             tp_path = os.path.join(out_path, "{}.vcf.gz".format(tp_name))
 
             try:
-                fn_table = vcf_qual_stats(fn_path, options.clip, ignore_keywords = ["OverlapConflict"])
-                fp_table = vcf_qual_stats(fp_path, options.clip_fp if options.clip_fp else options.clip)
-                tp_table = vcf_qual_stats(tp_path, options.clip)
+                # compute all three tables at once, if we have the cores for it
+                fn_table, fp_table, tp_table = vcf_qual_stats_parallel([
+                    (fn_path, options.clip, ["OverlapConflict"]),
+                    (fp_path, options.clip_fp if options.clip_fp else options.clip, []),
+                    (tp_path, options.clip, [])], processes=int(job.cores))
                 save_vcfeval_stats(out_path, fn_table, fp_table, tp_table)
             except:
                 pass
@@ -1265,7 +1516,13 @@ def compute_vcf_comparisons(job, options):
         graph1, graph2 = pair_comp[0], pair_comp[1]
         out_path = comp_path_vcf(graph1, graph2, options)
         if options.overwrite or not os.path.exists(out_path):
-            cores = options.vg_cores if options.comp_type == "happy" else 1
+            if options.comp_type == "happy":
+                cores = options.vg_cores
+            elif options.comp_type == "vcfeval":
+                # one process for each of the fn, fp and tp tables
+                cores = 3
+            else:
+                cores = 1
             job.addChildJobFn(compute_vcf_comparison, graph1, graph2, options,
                                           cores=cores)
         
@@ -1288,7 +1545,8 @@ def compute_kmer_indexes(job, options):
     if options.comp_type in ["kmer", "corg"]:
         RealTimeLogger.get().info("Computing indexes for {} input graphs".format(len(input_set)))
         for graph in input_set:
-            if options.overwrite or not os.path.exists(index_path(graph, options)):
+            if (options.overwrite or not os.path.exists(index_path(graph, options)) or
+                not have_vg_stats(graph, options)):
                 job.addChildJobFn(compute_kmer_index, graph, options, cores=options.vg_cores)
 
     if options.comp_type in ["vcf", "sompy", "happy", "vcfeval"]:
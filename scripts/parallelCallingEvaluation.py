@@ -16,6 +16,7 @@ import logging, logging.handlers, SocketServer, struct, socket, threading
 import string
 import urlparse
 import ntpath
+import tempfile
 import pdb
 
 import dateutil.parser
@@ -23,6 +24,7 @@ import dateutil.parser
 from toil.job import Job
 
 from toillib import *
+from vglib import *
 
 def parse_args(args):
     """
@@ -77,6 +79,11 @@ def parse_args(args):
         help="use the pruned graph in the index")
     parser.add_argument("--include_primary", action="store_true",
         help="use the primary path in the index")
+    parser.add_argument("--parallel_prune", action="store_true",
+        help="prune and find kmers in each graph component in parallel")
+    parser.add_argument("--index_cache", type=str, default=None,
+        help="directory to keep built indexes in, by graph contents and "
+        "index settings, for reuse")
     parser.add_argument("--pileup_opts", type=str,
         default="-w 40 -m 10 -q 10",
         help="options to pass to vg pileup. wrap in \"\"")
@@ -142,6 +149,24 @@ def run_indexing(options, job_cores):
 
     graph_filename = ntpath.basename(options.vg_graph)
 
+    # These are the index files we make, in out_dir
+    if options.index_mode == "rocksdb":
+        index_files = [graph_filename + ".index"]
+    else:
+        index_files = [graph_filename + ".gcsa", graph_filename + ".xg"]
+
+    if options.index_cache is not None:
+        # Look for an index built from the same graph with the same settings
+        cache_dir = os.path.join(options.index_cache, index_cache_key(
+            options.vg_graph, options.kmer_size, options.edge_max,
+            options.index_mode, options.include_pruned,
+            options.include_primary, parallel_prune=options.parallel_prune,
+            vg_binary="vg"))
+
+        if not options.reindex and os.path.exists(cache_dir):
+            print("Reusing cached index in {}".format(cache_dir))
+            copy_index_files(cache_dir, options.out_dir, index_files)
+            return
 
 
     # Now run the indexer.
@@ -166,129 +191,69 @@ def run_indexing(options, job_cores):
         kmers_filename = "{}/index.graph".format(
             options.out_dir)
 
-        with open(to_index_filename, "w") as to_index_file:
-
-            if options.include_pruned:
-
-                print("Pruning {} to {}".format(
-                    graph_filename, to_index_filename))
-
-                # Prune out hard bits of the graph
-                tasks = []
-
-                # Prune out complex regions
-                tasks.append(subprocess.Popen(["vg", "mod",
-                    "-p", "-l", str(options.kmer_size), "-t", str(job_cores),
-                    "-e", str(options.edge_max), options.vg_graph],
-                    stdout=subprocess.PIPE))
-
-                # Throw out short disconnected chunks
-                tasks.append(subprocess.Popen(["vg", "mod",
-                    "-S", "-l", str(options.kmer_size * 2),
-                    "-t", str(job_cores), "-"], stdin=tasks[-1].stdout,
-                    stdout=to_index_file))
-
-                # Did we make it through all the tasks OK?
-                for task in tasks:
-                    if task.wait() != 0:
-                        raise RuntimeError("Pipeline step returned {}".format(
-                            task.returncode))
-
-                time.sleep(1)
-
-            if options.include_primary:
-
-                # Then append in the primary path. Since we don't knoiw what
-                # "it's called, we retain "ref" and all the 19", "6", etc paths
-                # "from 1KG.
-
-                print(
-                    "Adding primary path to {}".format(to_index_filename))
+        if options.include_pruned and options.parallel_prune:
+            # Prune each connected component (and add back its part of the
+            # primary path) and find its kmers on its own, in parallel. This
+            # makes a kmers file per component.
+            print("Splitting {} into components".format(graph_filename))
+            components = explode_graph("", options.vg_graph,
+                "{}/components".format(options.out_dir))
 
-                # See
-                # https://github.com/vgteam/vg/issues/318#issuecomment-215102199
+            print("Pruning {} components of {} on {} cores".format(
+                len(components), graph_filename, job_cores))
+            kmer_filenames = prune_and_find_kmers_by_component(options, "",
+                components, to_index_filename, job_cores)
 
-                # Generate all the paths names we might have for primary paths.
-                # It should be "ref" but some graphs don't listen
-                ref_names = (["ref", "x", "X", "y", "Y", "m", "M"] +
-                    [str(x) for x in xrange(1, 23)])
-
-                ref_options = []
-                for name in ref_names:
-                    # Put each in a -r option to retain the path
-                    ref_options.append("-r")
-                    ref_options.append(name)
-
-                tasks = []
+        else:
 
-                # Retain only the specified paths (only one should really exist)
-                tasks.append(subprocess.Popen(
-                    ["vg", "mod", "-N"] + ref_options +
-                    ["-t", str(job_cores), options.vg_graph],
-                    stdout=to_index_file))
+            with open(to_index_filename, "w") as to_index_file:
 
-                # TODO: if we merged the primary path back on itself, it's
-                # possible for it to braid with itself. Right now we just ignore
-                # this and let those graphs take a super long time to index.
+                if options.include_pruned:
 
-                # Wait for this second pipeline. We don't parallelize with the
-                # first one so we don't need to use an extra cat step.
-                for task in tasks:
-                    if task.wait() != 0:
-                        raise RuntimeError("Pipeline step returned {}".format(
-                            task.returncode))
+                    print("Pruning {} to {}".format(
+                        graph_filename, to_index_filename))
 
-                # Wait to make sure no weird file-not-being-full bugs happen
-                # TODO: how do I wait on child process output?
-                time.sleep(1)
+                    # Prune out hard bits of the graph
+                    prune_graph(options, "", options.vg_graph, to_index_file,
+                        job_cores)
 
-        time.sleep(1)
+                if options.include_primary:
 
-        # Now we have the combined to-index graph in one vg file. We'll load
-        # it (which deduplicates nodes/edges) and then find kmers.
+                    print(
+                        "Adding primary path to {}".format(to_index_filename))
 
-        tasks = []
-        with open(kmers_filename, "w") as kmers_file:
+                    # We don't parallelize with the pruning so we don't need
+                    # to use an extra cat step.
+                    extract_primary_path(options, "", options.vg_graph,
+                        to_index_file, job_cores)
 
-            tasks = []
+            # Now we have the combined to-index graph in one vg file. We'll
+            # load it (which deduplicates nodes/edges) and then find kmers.
 
             print("Finding kmers in {} to {}".format(
                 to_index_filename, kmers_filename))
 
-            # Deduplicate the graph
-            tasks.append(subprocess.Popen(["vg",
-                "view", "-v", to_index_filename],
-                stdout=subprocess.PIPE))
-            
-            # Make the GCSA2 kmers file
-            tasks.append(subprocess.Popen(["vg",
-                "kmers", "-g", "-B", "-k", str(options.kmer_size),
-                "-H", "1000000000", "-T", "1000000001",
-                "-t", str(job_cores), "-"], stdin=tasks[-1].stdout,
-                stdout=kmers_file))
-                
-            # Did we make it through all the tasks OK?
-            for task in tasks:
-                if task.wait() != 0:
-                    raise RuntimeError("Pipeline step returned {}".format(
-                        task.returncode))
-
-            # Wait to make sure no weird file-not-being-full bugs happen
-            # TODO: how do I wait on child process output?
-            time.sleep(1)
-
-        time.sleep(1)
+            find_kmers(options, "", to_index_filename, kmers_filename,
+                job_cores, deduplicate=True)
+
+            kmer_filenames = [kmers_filename]
 
         # Where do we put the GCSA2 index?
         gcsa_filename = options.out_dir + "/" + graph_filename + ".gcsa"
 
         print("GCSA-indexing {} to {}".format(
-                kmers_filename, gcsa_filename))
+                ", ".join(kmer_filenames), gcsa_filename))
+
+        # Use every kmers file (which may overlap) that isn't empty
+        kmer_options = []
+        for filename in kmer_filenames:
+            if os.path.getsize(filename) > 0:
+                kmer_options += ["-i", filename]
 
         # Make the gcsa2 index. Make sure to use 3 doubling steps to work
         # around <https://github.com/vgteam/vg/issues/301>
-        subprocess.check_call(["vg", "index", "-t", str(job_cores), "-i",
-            kmers_filename, "-g", gcsa_filename, "-X", "3"])
+        subprocess.check_call(["vg", "index", "-t", str(job_cores)] +
+            kmer_options + ["-g", gcsa_filename, "-X", "3"])
 
         # Where do we put the XG index?
         xg_filename = options.out_dir + "/" + graph_filename + ".xg"
@@ -298,6 +263,33 @@ def run_indexing(options, job_cores):
 
         subprocess.check_call(["vg", "index", "-t", str(job_cores), "-x",
             xg_filename, options.vg_graph])
+
+    if options.index_cache is not None:
+        # Save the index for next time. Copy to a temp directory and rename it
+        # into place so nobody sees a partial index. An entry that is already
+        # there has the same key, so it's the same index, and someone may be
+        # copying from it; leave it alone. Failing to cache never fails the
+        # indexing.
+        temp_dir = None
+        try:
+            if os.path.exists(cache_dir):
+                print("Index already cached in {}".format(cache_dir))
+            else:
+                print("Caching index in {}".format(cache_dir))
+                robust_makedirs(options.index_cache)
+                temp_dir = tempfile.mkdtemp(dir=options.index_cache)
+                copy_index_files(options.out_dir, temp_dir, index_files)
+                try:
+                    os.rename(temp_dir, cache_dir)
+                    temp_dir = None
+                except OSError:
+                    # Someone else cached the same index first
+                    print("Index already cached in {}".format(cache_dir))
+        except Exception as e:
+            print("Could not cache index in {}: {}".format(cache_dir, e))
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
     
     # Define a file to keep the compressed index in, so we can send it to
     # the output store.
@@ -305,6 +297,22 @@ def run_indexing(options, job_cores):
         options.out_dir)
 
     
+def copy_index_files(from_dir, to_dir, index_files):
+    """
+    Copy the given index files (or directories) from one directory to another.
+    """
+
+    for index_file in index_files:
+        source = os.path.join(from_dir, index_file)
+        dest = os.path.join(to_dir, index_file)
+
+        if os.path.isdir(source):
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+            shutil.copytree(source, dest)
+        else:
+            shutil.copy2(source, dest)
+
 #def run_alignment(job, options, bin_dir_id, sample, graph_name, region,
 #    index_dir_id, sample_fastq_key, alignment_file_key, stats_file_key):
 def run_alignment(options, job_cores):
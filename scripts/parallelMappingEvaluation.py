@@ -8,17 +8,20 @@ BAM files with reads must have been already downloaded.
 """
 
 import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
-import doctest, re, json, collections, time, timeit
+import doctest, re, json, collections, time, timeit, math, tempfile
 import logging, logging.handlers, SocketServer, struct, socket, threading
+import multiprocessing, multiprocessing.pool
 import string
 import urlparse
 import fnmatch
 
 import dateutil.parser
+import datetime
 
 from toil.job import Job
 
 from toillib import *
+from vglib import *
 
 def parse_args(args):
     """
@@ -68,7 +71,9 @@ def parse_args(args):
     parser.add_argument("--restat", default=False, action="store_true",
         help="recompute and overwrite existing stats files")
     parser.add_argument("--reindex", default=False, action="store_true",
-        help="don't re-use existing indexed graphs")
+        help="don't re-use existing indexed graphs saved under their names")
+    parser.add_argument("--rebuild_index_cache", action="store_true",
+        help="don't re-use indexes built from identical graphs and settings")
     parser.add_argument("--alignments_too_old", default=None, type=str,
         help="recompute alignments older than this date")
     parser.add_argument("--stats_too_old", default=None, type=str,
@@ -80,10 +85,45 @@ def parse_args(args):
         help="use the pruned graph in the index")
     parser.add_argument("--include_primary", action="store_true",
         help="use the primary path in the index")
+    parser.add_argument("--parallel_prune", action="store_true",
+        help="prune and find kmers in each graph component in parallel")
     parser.add_argument("--serialize_downloads", action="store_true",
         help="download and index graphs one at a time")
     parser.add_argument("--min_gam_size", type=int, default=1024, 
         help="minimum size of a legitimate GAM file to accept")
+    parser.add_argument("--gam_json", action="store_true",
+        help="read GAMs for stats through vg view -aj instead of natively")
+    parser.add_argument("--parallel_stats", action="store_true",
+        help="compute stats for each GAM on all of the stats job's cores")
+    parser.add_argument("--pipeline_stats", action="store_true",
+        help="compute stats and upload the GAM while vg map is still running")
+    parser.add_argument("--samples_per_job", type=int, default=1,
+        help="most samples to align in one job, sharing one extracted index")
+    parser.add_argument("--batch_parallel", type=int, default=1,
+        help="samples to align at once in a job, splitting its cores")
+    parser.add_argument("--cache_dir", default=None,
+        help="node-local directory to share extracted indexes between jobs in")
+    parser.add_argument("--cache_size", type=float, default=0,
+        help="size in GB of unused extracted indexes to keep on each node, "
+        "added to the disk requested by each job that uses them")
+    parser.add_argument("--index_compression", default="gzip",
+        choices=sorted(COMPRESSORS.iterkeys()),
+        help="compressor to pack new index tarballs with (readers detect it)")
+    parser.add_argument("--metrics_run", default=None,
+        help="name to save stage timing metrics under (default: start time)")
+    parser.add_argument("--adaptive_scheduling", action="store_true",
+        help="size alignment jobs from FASTQ sizes and earlier run times")
+    parser.add_argument("--max_cores", type=int, default=16,
+        help="most cores to give an alignment job when scheduling adaptively")
+    parser.add_argument("--max_memory", type=int, default=100,
+        help="most memory in GB to give an alignment job when adaptive")
+    parser.add_argument("--target_run_time", type=float, default=3600,
+        help="wall-clock seconds adaptive alignment jobs should aim to take")
+    parser.add_argument("--seconds_per_gb", type=float, default=1800,
+        help="guess at mapping seconds per GB of FASTQ on --max_cores cores, "
+        "for when no earlier run times are available")
+    parser.add_argument("--history_samples", type=int, default=10,
+        help="number of earlier stats files to read run times from")
     
     
     # The command line arguments start with the program name, which we don't
@@ -121,6 +161,363 @@ def count_Ns(sequence):
             
     return n_count
 
+def read_graph_nodes_json(bin_prefix, graph_file):
+    """
+    Yield (node ID, sequence) pairs for all the nodes in the given vg graph, by
+    reading it as JSON through vg view.
+    
+    """
+    
+    # Read the graph in in JSON-line format
+    read_graph = subprocess.Popen(["{}vg".format(bin_prefix), "view", "-j",
+        graph_file], stdout=subprocess.PIPE)
+        
+    for line in read_graph.stdout:
+        # Parse the graph chunk JSON
+        graph_chunk = json.loads(line)
+        
+        for node_dict in graph_chunk.get("node", []):
+            # For each node, yield its sequence with its id. We want to crash
+            # if a node exists for which one or the other isn't defined.
+            yield int(node_dict["id"]), str(node_dict["sequence"])
+        
+    if read_graph.wait() != 0:
+        # Complain if vg dies
+        raise RuntimeError("vg died with error {}".format(
+            read_graph.returncode))
+            
+def get_index_key(options, region, graph_name):
+    """
+    Get the output store key for the index tarball for the given graph.
+    
+    """
+    
+    return "indexes/{}-{}-{}/{}/{}.tar.gz".format(options.index_mode,
+        options.kmer_size, options.edge_max, region, graph_name)
+        
+def get_index_toc_key(options, region, graph_name):
+    """
+    Get the output store key for the table of contents JSON for the index
+    tarball for the given graph, which lives next to the tarball.
+    
+    """
+    
+    return get_index_key(options, region, graph_name) + ".toc"
+
+def get_metrics_key(options, job_type, region, graph_name, sample=None):
+    """
+    Get the output store key for the stage metrics TSV for a job of the given
+    type on the given region, graph, and sample (if any), in this run.
+    
+    """
+    
+    return "metrics/{}/{}/{}/{}/{}.tsv".format(options.metrics_run, job_type,
+        region, graph_name, sample if sample is not None else "all")
+
+def get_graph_hash_key(options, region, graph_name):
+    """
+    Get the output store key for the hash_file digest of the graph in the
+    index tarball for the given graph, which lives next to the tarball.
+    
+    """
+    
+    return get_index_key(options, region, graph_name) + ".graph_sha1"
+
+def get_node_store_key(graph_hash):
+    """
+    Get the output store key for the node sequence store for the graph with
+    the given hash_file digest. Graphs with the same contents share a store,
+    just like they share an index_cache_key.
+    
+    """
+    
+    return "indexes/nodes/{}.nodes".format(graph_hash)
+
+def estimate_mapping_rate(options, out_store, stats_dir, fastq_sizes,
+    done_samples):
+    """
+    Estimate how many wall-clock seconds vg map takes per byte of FASTQ, on
+    --max_cores cores, from the run times saved in the stats files for up to
+    --history_samples of the given already-done samples (whose stats live in
+    stats_dir in the output store). fastq_sizes is a dict of FASTQ size by
+    sample name.
+    
+    Each run time is scaled from the cores it was measured on to --max_cores.
+    Stats that don't say how many cores were used are skipped.
+    
+    Falls back on --seconds_per_gb if no usable run times can be found.
+    
+    """
+    
+    # Total up run times and the FASTQ bytes they were spent on
+    total_time = 0.0
+    total_bytes = 0
+    
+    # Only look at samples we know the FASTQ size of
+    candidates = [sample for sample in done_samples
+        if fastq_sizes.get(sample, 0) > 0]
+    random.shuffle(candidates)
+    
+    for sample in candidates[:options.history_samples]:
+        # Grab each stats file
+        stats_file = tempfile.mkstemp(suffix=".json")[1]
+        try:
+            out_store.read_input_file("{}/{}.json".format(stats_dir, sample),
+                stats_file)
+            with open(stats_file) as stats_handle:
+                stats = json.load(stats_handle)
+            run_time = stats.get("run_time", None)
+            run_cores = stats.get("run_cores", None)
+        except Exception as e:
+            RealTimeLogger.get().warning("Could not get run time for {}: "
+                "{}".format(sample, e))
+            run_time = None
+            run_cores = None
+        finally:
+            os.unlink(stats_file)
+            
+        if run_time is not None and run_cores:
+            # Work out how long it would have taken on all the cores
+            total_time += run_time * run_cores / options.max_cores
+            total_bytes += fastq_sizes[sample]
+            
+    if total_bytes > 0:
+        RealTimeLogger.get().info("Observed {} seconds per GB mapping to "
+            "{}".format(total_time / total_bytes * 1024 ** 3, stats_dir))
+        return total_time / total_bytes
+        
+    return options.seconds_per_gb / 1024 ** 3
+    
+def plan_alignment(options, fastq_size, index_size, seconds_per_byte):
+    """
+    Decide how big a job to ask for to map a FASTQ of the given size against
+    an index tarball of the given size (either of which may be None if
+    unknown), given the estimated seconds vg map takes per FASTQ byte on
+    --max_cores cores.
+    
+    Returns a tuple of the cores to use, the memory and disk to use in GB, and
+    the estimated run time in seconds.
+    
+    Small samples against small graphs get small jobs, so several can be
+    packed onto a node, while big graphs get whole nodes.
+    
+    """
+    
+    if fastq_size is None:
+        # We don't know how much work this is, so plan for the worst.
+        return (options.max_cores, options.max_memory, 50,
+            options.target_run_time)
+    
+    # How long would this take with all the cores?
+    full_time = fastq_size * seconds_per_byte
+    
+    # Halve the cores as long as we would still finish in time.
+    cores = options.max_cores
+    while cores > 1 and full_time * options.max_cores / (cores / 2) <= \
+        options.target_run_time:
+        cores /= 2
+        
+    if index_size is None:
+        # Leave room for the biggest graph
+        memory = options.max_memory
+        index_gb = 10
+    else:
+        # The index is compressed on disk, and vg also needs space to work in.
+        index_gb = float(index_size) / 1024 ** 3
+        memory = min(options.max_memory, int(math.ceil(4 + 8 * index_gb)))
+        
+    # Room for the FASTQ, the GAM (which is about as big), and the extracted
+    # index.
+    disk = int(math.ceil(4 + 3 * float(fastq_size) / 1024 ** 3 + 4 * index_gb))
+    
+    return (cores, memory, disk, full_time * options.max_cores / cores)
+    
+def make_alignment_batches(options, to_align, sample_plans):
+    """
+    Split the given list of (sample, FASTQ key, GAM key, stats key) tuples
+    into batches to align together, of at most --samples_per_job samples. If
+    the given dict of plan_alignment results by sample is set, batches are
+    also cut before their estimated run time would pass --target_run_time.
+    
+    """
+    
+    batches = []
+    # What's the estimated run time of the batch we're filling?
+    batch_time = 0.0
+    
+    for task in to_align:
+        run_time = sample_plans[task[0]][3] if sample_plans is not None else 0
+        
+        if (len(batches) == 0 or
+            len(batches[-1]) >= options.samples_per_job or
+            (len(batches[-1]) > 0 and
+            batch_time + run_time > options.target_run_time)):
+            # Start a new batch
+            batches.append([])
+            batch_time = 0.0
+            
+        batches[-1].append(task)
+        batch_time += run_time
+        
+    return batches
+    
+def size_alignment_batch(options, batch, sample_plans):
+    """
+    Work out the cores, memory in GB, and disk in GB that a job aligning the
+    given batch of samples needs, from the given dict of plan_alignment
+    results by sample (or None, to give it a whole node).
+    
+    """
+    
+    if sample_plans is None:
+        return (16, 100, 50)
+        
+    # Each of the samples we run at once needs its own cores, memory for a
+    # copy of the index, and disk.
+    parallel = max(1, min(options.batch_parallel, len(batch)))
+    plans = [sample_plans[task[0]] for task in batch]
+    
+    return (min(options.max_cores, max(plan[0] for plan in plans) * parallel),
+        min(options.max_memory, max(plan[1] for plan in plans) * parallel),
+        max(plan[2] for plan in plans) * parallel)
+
+def cache_disk(options, disk):
+    """
+    Get the Toil disk request for a job that needs the given disk in GB of its
+    own and also uses the node's DirectoryCache, which can hold up to
+    --cache_size GB of indexes that no job is using.
+    
+    """
+    
+    return "{}G".format(int(math.ceil(disk + options.cache_size)))
+
+def subset_plans(sample_plans, samples):
+    """
+    Get the part of the given dict of plan_alignment results by sample (or
+    None) that is relevant to the given samples.
+    
+    """
+    
+    if sample_plans is None:
+        return None
+        
+    return {sample: sample_plans[sample] for sample in samples}
+    
+def split_by_run_time(samples, sample_plans, parts):
+    """
+    Split the given samples into at most the given number of lists, with about
+    the same total estimated run time in each, from the given dict of
+    plan_alignment results by sample. Longest samples come first in each list.
+    
+    """
+    
+    # Hand each sample, longest first, to the part with the least work so far
+    by_time = sorted(samples, key=lambda sample: sample_plans[sample][3],
+        reverse=True)
+    totals = [0.0] * min(parts, len(samples))
+    split = [[] for _ in totals]
+    
+    for sample in by_time:
+        emptiest = totals.index(min(totals))
+        split[emptiest].append(sample)
+        totals[emptiest] += sample_plans[sample][3]
+        
+    return split
+
+def get_index_cache_key(cache_key, suffix=".tar"):
+    """
+    Get the output store key for the cached index tarball (or the file next to
+    it with the given suffix) with the given index_cache_key. The tarball may
+    be compressed with any of the COMPRESSORS, so it has no compression
+    extension.
+    
+    """
+    
+    return "indexes/cache/{}{}".format(cache_key, suffix)
+    
+def copy_cached_index(job, options, out_store, cache_key, region,
+    graph_name):
+    """
+    Copy the cached index with the given index_cache_key, and its table of
+    contents, to the keys for the given graph's index in the output store.
+    Returns the ID of the index tarball in the file store.
+    
+    If the cache is missing the table of contents, the graph's copy is
+    replaced anyway, so none is left over from some other index: with an empty
+    table of contents, so the whole tarball gets read.
+    
+    """
+    
+    work_dir = job.fileStore.getLocalTempDir()
+    
+    for suffix, key in [
+        (".tar", get_index_key(options, region, graph_name)),
+        (".toc", get_index_toc_key(options, region, graph_name))]:
+        
+        local_file = "{}/index{}".format(work_dir, suffix)
+        
+        if suffix != ".tar" and not out_store.exists(get_index_cache_key(
+            cache_key, suffix)):
+            # The cache doesn't have this file, so make a stand-in.
+            RealTimeLogger.get().warning("Cached index {} has no {}".format(
+                cache_key, suffix))
+                
+            with open(local_file, "w") as toc_file:
+                json.dump({"members": []}, toc_file)
+        else:
+            out_store.read_input_file(get_index_cache_key(cache_key, suffix),
+                local_file)
+            
+        out_store.write_output_file(local_file, key)
+        
+    # Save the tarball to the global file store and keep around the ID.
+    # Will be compatible with read_global_directory
+    return job.fileStore.writeGlobalFile("{}/index.tar".format(work_dir),
+        cleanup=True)
+
+def save_graph_hash(job, options, out_store, region, graph_name, graph_hash):
+    """
+    Save the given hash_file digest of the graph in the given graph's index
+    next to the index in the output store.
+    
+    """
+    
+    hash_file_name = "{}/graph_sha1".format(job.fileStore.getLocalTempDir())
+    with open(hash_file_name, "w") as hash_handle:
+        hash_handle.write(graph_hash)
+    out_store.write_output_file(hash_file_name, get_graph_hash_key(options,
+        region, graph_name))
+
+def get_node_store_dir_id(job, out_store, graph_hash, graph_filename=None):
+    """
+    Get the file store ID of a directory holding the node sequence store (as
+    graph.nodes) for the graph with the given hash_file digest, so jobs can
+    share it through a DirectoryCache like the index.
+    
+    Uses the store saved in the output store if there is one. Otherwise it is
+    made from the given local graph file and saved there, or, if no graph file
+    is given, None is returned.
+    
+    """
+    
+    nodes_dir = "{}/nodes".format(job.fileStore.getLocalTempDir())
+    robust_makedirs(nodes_dir)
+    node_store_file = "{}/graph.nodes".format(nodes_dir)
+    node_store_key = get_node_store_key(graph_hash)
+    
+    if out_store.exists(node_store_key):
+        out_store.read_input_file(node_store_key, node_store_file)
+    elif graph_filename is not None:
+        # Pack up the node sequences, so stats don't have to extract and parse
+        # the graph.
+        NodeSequenceStore.from_graph(graph_filename).save(node_store_file)
+        out_store.write_output_file(node_store_file, node_store_key)
+    else:
+        return None
+        
+    # Only our children use it
+    return write_global_directory(job.fileStore, nodes_dir, cleanup=True)
+
 def run_all_alignments(job, options):
     """
     For each server listed in the server_list tsv, kick off child jobs to
@@ -252,10 +649,14 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
     # Also for statistics
     stats_dir = "stats/{}/{}".format(region, graph_name)
     
+    # Get the sizes and mtimes of all the alignments and stats files at once,
+    # as dicts from file name to (size, mtime) pair.
+    alignment_metadata = out_store.list_metadata(alignment_dir)
+    stats_metadata = out_store.list_metadata(stats_dir)
+    
     # What smaples have been completed? Map from ID to mtime
     completed_samples = {}
-    for filename, mtime in out_store.list_input_directory(stats_dir,
-        with_times=True):
+    for filename, (_, mtime) in stats_metadata.iteritems():
         # See if every file is a stats file
         match = re.match("(.*)\.json$", filename)
     
@@ -263,12 +664,9 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
             # Skip random extra files
             continue
         
-        # Get the size of the corresponding GAM, if it exists
-        gam_size = out_store.get_size("{}/{}.gam".format(alignment_dir,
-            match.group(1)))
-        # And its mtime
-        gam_mtime = out_store.get_mtime("{}/{}.gam".format(alignment_dir,
-            match.group(1)))
+        # Get the size of the corresponding GAM, if it exists, and its mtime
+        gam_size, gam_mtime = alignment_metadata.get("{}.gam".format(
+            match.group(1)), (None, None))
     
         if (gam_size is None or
             gam_size < options.min_gam_size or 
@@ -342,8 +740,7 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
     
     
     # Where will the indexed graph go in the output
-    index_key = "indexes/{}-{}-{}/{}/{}.tar.gz".format(options.index_mode,
-        options.kmer_size, options.edge_max, region, graph_name)
+    index_key = get_index_key(options, region, graph_name)
     
     if (not options.reindex) and out_store.exists(index_key):
         # See if we have an index already available in the output store from a
@@ -360,6 +757,18 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
         # Will be compatible with read_global_directory
         index_dir_id = job.fileStore.writeGlobalFile(tgz_file, cleanup=True)
         
+        # Find the node sequences for the graph in the index, if we know which
+        # graph that is. If not, stats jobs will work them out from the index.
+        node_store_dir_id = None
+        graph_hash_key = get_graph_hash_key(options, region, graph_name)
+        if out_store.exists(graph_hash_key):
+            hash_file_name = "{}/graph_sha1".format(
+                job.fileStore.getLocalTempDir())
+            out_store.read_input_file(graph_hash_key, hash_file_name)
+            with open(hash_file_name) as hash_handle:
+                node_store_dir_id = get_node_store_dir_id(job, out_store,
+                    hash_handle.read().strip())
+        
         RealTimeLogger.get().info("Index for {} retrieved "
             "successfully".format(basename))
         
@@ -371,6 +780,7 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
             
         job.addFollowOnJobFn(recursively_run_samples, options, bin_dir_id, 
             graph_name, region, index_dir_id, samples_to_run,
+            node_store_dir_id=node_store_dir_id,
             cores=1, memory="4G", disk="4G")
                 
         RealTimeLogger.get().info("Done making children for {}".format(basename))
@@ -535,6 +945,42 @@ def index_region_and_run_samples(job, options, bin_dir_id, region, url,
     
     # Download the graph
     job.fileStore.readGlobalFile(graph_id, graph_filename)    
+    
+    # Identify the graph by its contents, for the node sequence store
+    graph_hash = hash_file(graph_filename)
+    
+    # And identify the index by what goes into it, so we can reuse an index
+    # built from the same graph with the same settings under any name.
+    cache_key = index_cache_key(graph_filename, options.kmer_size,
+        options.edge_max, options.index_mode, options.include_pruned,
+        options.include_primary, parallel_prune=options.parallel_prune,
+        vg_binary="{}vg".format(bin_prefix), graph_hash=graph_hash)
+        
+    if (not options.rebuild_index_cache and
+        out_store.exists(get_index_cache_key(cache_key))):
+        
+        RealTimeLogger.get().info("Reusing cached index {} for {}".format(
+            cache_key, graph_filename))
+            
+        # Copy the cached index to where this graph's index belongs, and put
+        # it in the file store.
+        index_dir_id = copy_cached_index(job, options, out_store, cache_key,
+            region, graph_name)
+            
+        # Say which graph is in it, and get its node sequences
+        save_graph_hash(job, options, out_store, region, graph_name,
+            graph_hash)
+        node_store_dir_id = get_node_store_dir_id(job, out_store, graph_hash,
+            graph_filename)
+            
+        RealTimeLogger.get().info("Queueing alignment of {} samples to "
+            "{} {}".format(len(samples_to_run), graph_name, region))
+            
+        job.addChildJobFn(recursively_run_samples, options, bin_dir_id, 
+            graph_name, region, index_dir_id, samples_to_run,
+            node_store_dir_id=node_store_dir_id,
+            cores=1, memory="4G", disk="4G")
+        return
         
     # Now run the indexer.
     # TODO: support both indexing modes
@@ -561,137 +1007,75 @@ def index_region_and_run_samples(job, options, bin_dir_id, region, url,
         kmers_filename = "{}/index.graph".format(
             job.fileStore.getLocalTempDir())
             
-        with open(to_index_filename, "w") as to_index_file:
-            
-            if options.include_pruned:
-            
-                RealTimeLogger.get().info("Pruning {} to {}".format(
-                    graph_filename, to_index_filename))
-                
-                # Prune out hard bits of the graph
-                tasks = []
-                
-                # Prune out complex regions
-                tasks.append(subprocess.Popen(["{}vg".format(bin_prefix), "mod",
-                    "-p", "-l", str(options.kmer_size), "-t", str(job.cores),
-                    "-e", str(options.edge_max), graph_filename],
-                    stdout=subprocess.PIPE))
-                    
-                # Throw out short disconnected chunks
-                tasks.append(subprocess.Popen(["{}vg".format(bin_prefix), "mod",
-                    "-S", "-l", str(options.kmer_size * 2),
-                    "-t", str(job.cores), "-"], stdin=tasks[-1].stdout,
-                    stdout=to_index_file))
-                    
-                # Did we make it through all the tasks OK?
-                for task in tasks:
-                    if task.wait() != 0:
-                        raise RuntimeError("Pipeline step returned {}".format(
-                            task.returncode))
-                            
-                time.sleep(1)
+        if options.include_pruned and options.parallel_prune:
+            # Prune each connected component (and add back its part of the
+            # primary path) and find its kmers on its own, in parallel. This
+            # makes a kmers file per component.
+            RealTimeLogger.get().info("Splitting {} into components".format(
+                graph_filename))
+            components = explode_graph(bin_prefix, graph_filename,
+                "{}/components".format(job.fileStore.getLocalTempDir()))
                 
-            if options.include_primary:
-            
-                # Then append in the primary path. Since we don't knoiw what
-                # "it's called, we retain "ref" and all the 19", "6", etc paths
-                # "from 1KG.
+            RealTimeLogger.get().info("Pruning {} components of {} on {} "
+                "cores".format(len(components), graph_filename, job.cores))
+            kmer_filenames = prune_and_find_kmers_by_component(options,
+                bin_prefix, components, to_index_filename, job.cores)
                 
-                RealTimeLogger.get().info(
-                    "Adding primary path to {}".format(to_index_filename))
+        else:
+        
+            with open(to_index_filename, "w") as to_index_file:
                 
-                # See
-                # https://github.com/vgteam/vg/issues/318#issuecomment-215102199
+                if options.include_pruned:
                 
-                # Generate all the paths names we might have for primary paths.
-                # It should be "ref" but some graphs don't listen
-                ref_names = (["ref", "x", "X", "y", "Y", "m", "M"] +
-                    [str(x) for x in xrange(1, 23)])
+                    RealTimeLogger.get().info("Pruning {} to {}".format(
+                        graph_filename, to_index_filename))
                     
-                ref_options = []
-                for name in ref_names:
-                    # Put each in a -r option to retain the path
-                    ref_options.append("-r")
-                    ref_options.append(name)
-
-                tasks = []
-
-                # Retain only the specified paths (only one should really exist)
-                tasks.append(subprocess.Popen(
-                    ["{}vg".format(bin_prefix), "mod", "-N"] + ref_options + 
-                    ["-t", str(job.cores), graph_filename], 
-                    stdout=to_index_file))
+                    # Prune out hard bits of the graph
+                    prune_graph(options, bin_prefix, graph_filename,
+                        to_index_file, job.cores)
                     
-                # TODO: if we merged the primary path back on itself, it's
-                # possible for it to braid with itself. Right now we just ignore
-                # this and let those graphs take a super long time to index.
+                if options.include_primary:
+                
+                    RealTimeLogger.get().info(
+                        "Adding primary path to {}".format(to_index_filename))
                     
-                # Wait for this second pipeline. We don't parallelize with the
-                # first one so we don't need to use an extra cat step.
-                for task in tasks:
-                    if task.wait() != 0:
-                        raise RuntimeError("Pipeline step returned {}".format(
-                            task.returncode))
-                         
-                # Wait to make sure no weird file-not-being-full bugs happen
-                # TODO: how do I wait on child process output?
-                time.sleep(1)
-            
-        time.sleep(1)
+                    # We don't parallelize with the pruning so we don't need
+                    # to use an extra cat step.
+                    extract_primary_path(options, bin_prefix, graph_filename,
+                        to_index_file, job.cores)
+                
+            # Now we have the combined to-index graph in one vg file. We'll
+            # load it (which deduplicates nodes/edges) and then find kmers.
             
-        # Now we have the combined to-index graph in one vg file. We'll load
-        # it (which deduplicates nodes/edges) and then find kmers.
+            RealTimeLogger.get().info("Finding kmers in {} to {}".format(
+                to_index_filename, kmers_filename))
+                
+            find_kmers(options, bin_prefix, to_index_filename, kmers_filename,
+                job.cores, deduplicate=True)
+                
+            kmer_filenames = [kmers_filename]
             
         # Save the intermediate vg file, in case we want to look at it
         out_store.write_output_file(to_index_filename,
             "debug/{}-{}-{}-{}-{}.vg".format(options.index_mode,
             options.kmer_size, options.edge_max, region, graph_name))
-            
-        with open(kmers_filename, "w") as kmers_file:
-        
-            tasks = []
-            
-            RealTimeLogger.get().info("Finding kmers in {} to {}".format(
-                to_index_filename, kmers_filename))
-            
-            # Deduplicate the graph
-            # Discard warnings about duplicate nodes or edges
-            tasks.append(subprocess.Popen(["{}vg".format(bin_prefix),
-                "view", "-v", to_index_filename],
-                stdout=subprocess.PIPE, stderr=open(os.devnull, 'wb')))
-            
-            # Make the GCSA2 kmers file
-            tasks.append(subprocess.Popen(["{}vg".format(bin_prefix),
-                "kmers", "-g", "-B", "-k", str(options.kmer_size),
-                "-H", "1000000000", "-T", "1000000001",
-                "-t", str(job.cores), "-"], stdin=tasks[-1].stdout,
-                stdout=kmers_file))
-                
-            # Did we make it through all the tasks OK?
-            task_number = 0
-            for task in tasks:
-                if task.wait() != 0:
-                    raise RuntimeError(
-                        "Pipeline step {} returned {}".format(
-                        task_number, task.returncode))
-                task_number += 1
-                        
-            # Wait to make sure no weird file-not-being-full bugs happen
-            # TODO: how do I wait on child process output?
-            time.sleep(1)
-            
-        time.sleep(1)
                         
         # Where do we put the GCSA2 index?
         gcsa_filename = graph_filename + ".gcsa"
         
         RealTimeLogger.get().info("GCSA-indexing {} to {}".format(
-                kmers_filename, gcsa_filename))
+                ", ".join(kmer_filenames), gcsa_filename))
+        
+        # Use every kmers file (which may overlap) that isn't empty
+        kmer_options = []
+        for filename in kmer_filenames:
+            if os.path.getsize(filename) > 0:
+                kmer_options += ["-i", filename]
         
         # Make the gcsa2 index. Make sure to use 3 doubling steps to work
         # around <https://github.com/vgteam/vg/issues/301>
         subprocess.check_call(["{}vg".format(bin_prefix), "index", "-t",
-            str(job.cores), "-i", kmers_filename, "-g", gcsa_filename,
+            str(job.cores)] + kmer_options + ["-g", gcsa_filename,
             "-X", "3", "-Z", "2000"])
             
         # Where do we put the XG index?
@@ -715,12 +1099,13 @@ def index_region_and_run_samples(job, options, bin_dir_id, region, url,
     # cleaned up since only our children use it.
     RealTimeLogger.get().info("Compressing index of {}".format(
         graph_filename))
+    index_dir_toc = "{}/index.toc".format(job.fileStore.getLocalTempDir())
     index_dir_id = write_global_directory(job.fileStore, graph_dir,
-        cleanup=True, tee=index_dir_tgz)
+        cleanup=True, tee=index_dir_tgz, compression=options.index_compression,
+        threads=job.cores, toc=index_dir_toc)
         
     # Where will the indexed graph go in the output
-    index_key = "indexes/{}-{}-{}/{}/{}.tar.gz".format(options.index_mode,
-        options.kmer_size, options.edge_max, region, graph_name)
+    index_key = get_index_key(options, region, graph_name)
         
     # Save it as output
     RealTimeLogger.get().info("Uploading index of {}".format(
@@ -729,6 +1114,25 @@ def index_region_and_run_samples(job, options, bin_dir_id, region, url,
     RealTimeLogger.get().info("Index {} uploaded successfully".format(
         index_key))
         
+    # And its table of contents, so jobs that need only part of it can find it
+    out_store.write_output_file(index_dir_toc, get_index_toc_key(options,
+        region, graph_name))
+        
+    # And which graph it holds, so later runs can find its node sequences
+    save_graph_hash(job, options, out_store, region, graph_name, graph_hash)
+        
+    # Also get the node sequences, so stats jobs can use them without having
+    # to extract and parse the graph.
+    node_store_dir_id = get_node_store_dir_id(job, out_store, graph_hash,
+        graph_filename)
+        
+    # Save the index in the cache too, for the next graph with the same
+    # contents. The tarball goes last, since its existence is what makes a
+    # cache hit.
+    out_store.write_output_file(index_dir_toc, get_index_cache_key(cache_key,
+        ".toc"))
+    out_store.write_output_file(index_dir_tgz, get_index_cache_key(cache_key))
+    RealTimeLogger.get().info("Cached index as {}".format(cache_key))
         
     # Now that we have the index, make the actual alignment children.        
     RealTimeLogger.get().info("Queueing alignment of {} samples to "
@@ -736,12 +1140,14 @@ def index_region_and_run_samples(job, options, bin_dir_id, region, url,
             
     job.addChildJobFn(recursively_run_samples, options, bin_dir_id, 
         graph_name, region, index_dir_id, samples_to_run,
+        node_store_dir_id=node_store_dir_id,
         cores=1, memory="4G", disk="4G")
             
     RealTimeLogger.get().info("Done making children for {}".format(basename))
    
 def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
-    index_dir_id, samples_to_run, num_per_call=10):
+    index_dir_id, samples_to_run, num_per_call=10, sample_metadata=None,
+    sample_plans=None, node_store_dir_id=None):
     """
     Create child jobs to run a few samples from the samples_to_run list, and a
     recursive child job to create a few more.
@@ -756,6 +1162,21 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
     If we get a sample, all we know is that it doesn't have an up to date stats
     file, but it may or may not have an alignment file already.
     
+    sample_metadata, if set, is a dict from sample name to a pair of the (size,
+    mtime) pairs for the sample's GAM and stats files (or None for files that
+    don't exist). If it isn't set, the output store is listed to make it, and
+    the relevant parts of it are passed along to recursive calls, so we don't
+    have to ask about every file separately.
+    
+    sample_plans, if set, is a dict from sample name to plan_alignment result,
+    used to size each sample's alignment job. If it isn't set, and
+    --adaptive_scheduling is on, it is made from the FASTQ sizes and the run
+    times in already-finished stats files, and the samples are reordered to
+    start the longest ones first.
+    
+    node_store_dir_id, if set, is the file store ID of a directory holding the
+    graph's node sequence store, from get_node_store_dir_id.
+    
     """
     
     # Set up the IO stores each time, since we can't unpickle them on Azure for
@@ -776,6 +1197,49 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
     # Also for statistics
     stats_dir = "stats/{}/{}".format(region, graph_name)
     
+    if sample_metadata is None:
+        # Look up the GAM and stats files for all the samples at once
+        alignment_metadata = out_store.list_metadata(alignment_dir)
+        stats_metadata = out_store.list_metadata(stats_dir)
+        
+        sample_metadata = {sample: (
+            alignment_metadata.get("{}.gam".format(sample), None),
+            stats_metadata.get("{}.json".format(sample), None))
+            for sample in samples_to_run}
+            
+        if options.adaptive_scheduling:
+            # Get the FASTQ sizes for the whole region in one go
+            fastq_metadata = sample_store.list_metadata(region_dir)
+            fastq_sizes = {sample: fastq_metadata.get("{}/{}.bam.fq".format(
+                sample, sample), (None, None))[0] for sample in samples_to_run}
+                
+            # Samples with stats we aren't redoing tell us how fast we are
+            done_samples = set(name[:-len(".json")]
+                for name in stats_metadata.iterkeys()
+                if name.endswith(".json")) - set(samples_to_run)
+            for sample in done_samples:
+                fastq_sizes[sample] = fastq_metadata.get(
+                    "{}/{}.bam.fq".format(sample, sample), (None, None))[0]
+                
+            seconds_per_byte = estimate_mapping_rate(options, out_store,
+                stats_dir, fastq_sizes, done_samples)
+            index_size = out_store.get_size(get_index_key(options, region,
+                graph_name))
+                
+            sample_plans = {sample: plan_alignment(options,
+                fastq_sizes[sample], index_size, seconds_per_byte)
+                for sample in samples_to_run}
+                
+            # Start the longest samples first, so they don't hold up the end
+            samples_to_run = sorted(samples_to_run,
+                key=lambda sample: sample_plans[sample][3], reverse=True)
+            samples_to_run_now = samples_to_run[:num_per_call]
+            samples_to_run_later = samples_to_run[num_per_call:]
+    
+    # If we're aligning samples in batches, this holds the (sample, FASTQ key,
+    # GAM key, stats key) tuples to batch up.
+    to_align = []
+    
     for sample in samples_to_run_now:
         # Split out over each sample that needs to be run
         
@@ -786,13 +1250,15 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
         alignment_file_key = "{}/{}.gam".format(alignment_dir, sample)
         stats_file_key = "{}/{}.json".format(stats_dir, sample)
         
-        # How big is the GAM file (or None if it's not made yet):
-        gam_size = out_store.get_size(alignment_file_key)
-        # And when was it made (or None if it's not made yet)?
-        gam_mtime = out_store.get_mtime(alignment_file_key)
+        # Get the metadata for the GAM and stats files
+        gam_metadata, stats_metadata = sample_metadata[sample]
+        
+        # How big is the GAM file, and when was it made (or None if it's not
+        # made yet)?
+        gam_size, gam_mtime = gam_metadata or (None, None)
         
         # And the same for the stats file. We don't care about its size though.
-        stats_mtime = out_store.get_mtime(stats_file_key)
+        _, stats_mtime = stats_metadata or (None, None)
         
         if (options.overwrite or
             gam_mtime is None or
@@ -822,13 +1288,29 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
                 RealTimeLogger.get().info("Queueing overwrite alignment"
                     " of {} to {} {}".format(sample, graph_name, region))
             
+            if options.samples_per_job > 1:
+                # Save it to align in a batch
+                to_align.append((sample, sample_fastq, alignment_file_key,
+                    stats_file_key))
+                continue
+            
+            if sample_plans is not None:
+                # Use a job sized for this sample
+                cores, memory, disk, run_time = sample_plans[sample]
+                RealTimeLogger.get().info("Expecting {} on {} {} to take {} "
+                    "seconds on {} cores".format(sample, graph_name, region,
+                    int(run_time), cores))
+            else:
+                cores, memory, disk = 16, 100, 50
             
             # Go and bang that input fastq against the correct indexed graph.
             # Its output will go to the right place in the output store.
             job.addChildJobFn(run_alignment, options, bin_dir_id, sample,
                 graph_name, region, index_dir_id, sample_fastq,
-                alignment_file_key, stats_file_key, 
-                cores=16, memory="100G", disk="50G")
+                alignment_file_key, stats_file_key,
+                node_store_dir_id=node_store_dir_id,
+                cores=cores, memory="{}G".format(memory),
+                disk=cache_disk(options, disk))
         
         elif (options.restat or
             stats_mtime is None or
@@ -844,7 +1326,9 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
             
             job.addFollowOnJobFn(run_stats, options, bin_dir_id,
                 index_dir_id, alignment_file_key, stats_file_key,
-                run_time=None, cores=2, memory="4G", disk="10G")
+                run_time=None, node_store_dir_id=node_store_dir_id,
+                index_toc_key=get_index_toc_key(options, region, graph_name),
+                cores=2, memory="4G", disk=cache_disk(options, 10))
                     
         else:
             # The stats are up to date and the alignment doesn't need
@@ -853,6 +1337,19 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
             RealTimeLogger.get().warning("SKIPPING sample "
                 "{} on {} {}".format(sample, graph_name, region))
                     
+    for batch in make_alignment_batches(options, to_align, sample_plans):
+        # Make a job for each batch, big enough for its biggest sample
+        cores, memory, disk = size_alignment_batch(options, batch,
+            sample_plans)
+            
+        RealTimeLogger.get().info("Queueing batch of {} alignments to {} "
+            "{}".format(len(batch), graph_name, region))
+        
+        job.addChildJobFn(run_alignment_batch, options, bin_dir_id,
+            graph_name, region, index_dir_id, batch,
+            node_store_dir_id=node_store_dir_id, cores=cores,
+            memory="{}G".format(memory), disk=cache_disk(options, disk))
+                    
     if len(samples_to_run_later) > 0:
         # We need to recurse and run more later.
         RealTimeLogger.get().debug("Postponing queueing {} samples".format(
@@ -862,29 +1359,43 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
             # Just run them all in one batch
             job.addChildJobFn(recursively_run_samples, options, bin_dir_id,
                     graph_name, region, index_dir_id, samples_to_run_later,
-                    num_per_call, cores=1, memory="4G", disk="4G")
+                    num_per_call, {sample: sample_metadata[sample]
+                    for sample in samples_to_run_later},
+                    subset_plans(sample_plans, samples_to_run_later),
+                    node_store_dir_id, cores=1, memory="4G", disk="4G")
         else:
             # Split them up
-        
-            part_size = len(samples_to_run_later) / num_per_call
             
-            RealTimeLogger.get().info("Splitting remainder of {} {} into {} "
-                "parts of {}".format(graph_name, region, num_per_call,
-                part_size))
-            
-            for i in xrange(num_per_call + 1):
-                # Do 1 more part for any remainder
+            if sample_plans is not None:
+                # Balance the parts by how long we expect them to take
+                parts = split_by_run_time(samples_to_run_later, sample_plans,
+                    num_per_call)
+                    
+                RealTimeLogger.get().info("Splitting remainder of {} {} into "
+                    "{} parts by run time".format(graph_name, region,
+                    len(parts)))
+            else:
+                part_size = len(samples_to_run_later) / num_per_call
+                
+                RealTimeLogger.get().info("Splitting remainder of {} {} into "
+                    "{} parts of {}".format(graph_name, region, num_per_call,
+                    part_size))
                 
-                # Grab this bit of the rest
-                part = samples_to_run_later[(i * part_size) :
-                    ((i + 1) * part_size)]
+                # Do 1 more part for any remainder
+                parts = [samples_to_run_later[(i * part_size) :
+                    ((i + 1) * part_size)] for i in xrange(num_per_call + 1)]
+            
+            for part in parts:
                 
                 if len(part) > 0:
                 
                     # Make a job to run it
                     job.addChildJobFn(recursively_run_samples, options,
                         bin_dir_id, graph_name, region, index_dir_id, part,
-                        num_per_call, cores=1, memory="4G", disk="4G")
+                        num_per_call, {sample: sample_metadata[sample]
+                        for sample in part},
+                        subset_plans(sample_plans, part),
+                        node_store_dir_id, cores=1, memory="4G", disk="4G")
         
         
     
@@ -924,7 +1435,8 @@ def save_indexed_graph(job, options, index_dir_id, output_key):
     
    
 def run_alignment(job, options, bin_dir_id, sample, graph_name, region,
-    index_dir_id, sample_fastq_key, alignment_file_key, stats_file_key):
+    index_dir_id, sample_fastq_key, alignment_file_key, stats_file_key,
+    node_store_dir_id=None):
     """
     Align the the given fastq from the input store against the given indexed
     graph (in the file store as a directory) and put the GAM and statistics in
@@ -934,13 +1446,39 @@ def run_alignment(job, options, bin_dir_id, sample, graph_name, region,
     
     """
     
+    # This is just a batch of one
+    run_alignment_batch(job, options, bin_dir_id, graph_name, region,
+        index_dir_id, [(sample, sample_fastq_key, alignment_file_key,
+        stats_file_key)], node_store_dir_id=node_store_dir_id)
+        
+def run_alignment_batch(job, options, bin_dir_id, graph_name, region,
+    index_dir_id, batch, node_store_dir_id=None):
+    """
+    Align each of a batch of samples against the given indexed graph (in the
+    file store as a directory), extracting the index only once. batch is a
+    list of (sample name, FASTQ key in the sample store, GAM output key, stats
+    output key) tuples.
+    
+    node_store_dir_id, if set, is the file store ID of a directory holding the
+    graph's node sequence store, for computing stats as we map.
+    
+    Samples are mapped --batch_parallel at a time, with the job's cores split
+    between them.
+    
+    Assumes that the alignments actually need to be redone.
+    
+    """
+    
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
-    sample_store = IOStore.get(options.sample_store)
     out_store = IOStore.get(options.out_store)
     
-    # How long did the alignment take to run, in seconds?
-    run_time = None
+    # Measure how long the shared setup takes. If there is only one sample,
+    # it all belongs to that sample. Otherwise it's named after the batch's
+    # first sample, so batches on the same graph don't clobber each other.
+    monitor = ResourceMonitor(region=region, graph=graph_name,
+        sample=batch[0][0] if len(batch) == 1 else "batch-{}".format(
+        batch[0][0]))
     
     if bin_dir_id is not None:
         # Download the binaries
@@ -952,60 +1490,179 @@ def run_alignment(job, options, bin_dir_id, sample, graph_name, region,
     else:
         bin_prefix = ""
     
-    # Download the indexed graph to a directory we can use
-    graph_dir = "{}/graph".format(job.fileStore.getLocalTempDir())
-    read_global_directory(job.fileStore, index_dir_id, graph_dir)
+    # Get the indexed graph directory, shared with other jobs on this node
+    directory_cache = DirectoryCache(options.cache_dir,
+        options.cache_size * 1024 ** 3)
+    with monitor.stage("untar"):
+        graph_dir = directory_cache.get(job.fileStore, index_dir_id)
+    
+    # And the node sequences directory, if we get one
+    nodes_dir = None
+    
+    try:
+        # We know what the vg file in there will be named
+        graph_file = "{}/graph.vg".format(graph_dir)
+    
+        # How many samples should we map at once?
+        parallel = max(1, min(options.batch_parallel, len(batch)))
+    
+        # And how many cores does each get?
+        cores = max(1, int(job.cores) / parallel)
+    
+        node_sequences = None
+        if options.pipeline_stats and not options.gam_json:
+            # Get the reference sequences for the stats once for the whole
+            # batch
+            node_sequences, nodes_dir = get_node_sequences(job,
+                directory_cache, node_store_dir_id, graph_file, monitor)
+    
+        if len(batch) > 1:
+            # The setup was shared by the whole batch
+            monitor.save(out_store, get_metrics_key(options, "align", region,
+                graph_name, monitor.tags["sample"]))
+        
+        RealTimeLogger.get().info("Aligning {} samples to {} {}, {} at a time "
+            "on {} cores each".format(len(batch), graph_name, region, parallel,
+            cores))
     
-    # We know what the vg file in there will be named
-    graph_file = "{}/graph.vg".format(graph_dir)
+        def align(task):
+            """
+            Align one sample from the batch. Returns the run time if stats still
+            need to be computed, or None if they were done already.
+        
+            """
+        
+            sample, sample_fastq_key, alignment_file_key, stats_file_key = task
+        
+            if len(batch) > 1:
+                # Measure each sample on its own. If samples are running at the
+                # same time, we can only tell their wall times apart.
+                sample_monitor = ResourceMonitor(wall_only=(parallel > 1),
+                    region=region, graph=graph_name, sample=sample)
+            else:
+                sample_monitor = monitor
+                sample_monitor.tags["sample"] = sample
+        
+            return align_sample(job, options, bin_prefix, graph_file, sample,
+                graph_name, region, sample_fastq_key, alignment_file_key,
+                stats_file_key, cores, sample_monitor,
+                node_sequences=node_sequences)
+    
+        if parallel > 1:
+            # Map several samples at once
+            pool = multiprocessing.pool.ThreadPool(parallel)
+            try:
+                run_times = pool.map(align, batch)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            run_times = [align(task) for task in batch]
+    
+    finally:
+        # Let the directories be evicted once nobody is mapping to them
+        directory_cache.release(graph_dir)
+        if nodes_dir is not None:
+            directory_cache.release(nodes_dir)
     
-    # Also we need the sample fastq
-    fastq_file = "{}/input.fq".format(job.fileStore.getLocalTempDir())
+    for (_, _, alignment_file_key, stats_file_key), run_time in zip(batch,
+        run_times):
+        
+        if run_time is None:
+            # Stats were computed along with the alignment
+            continue
+            
+        RealTimeLogger.get().info("Need to recompute stats for new "
+            "alignment: {}".format(stats_file_key))
+
+        # Add a follow-on to calculate stats. It only needs 2 cores since it's
+        # not really prarllel.
+        job.addFollowOnJobFn(run_stats, options, bin_dir_id, index_dir_id,
+            alignment_file_key, stats_file_key, run_time=run_time,
+            run_cores=cores, node_store_dir_id=node_store_dir_id,
+            index_toc_key=get_index_toc_key(options, region, graph_name),
+            cores=2, memory="4G", disk=cache_disk(options, 10))
+            
+def align_sample(job, options, bin_prefix, graph_file, sample, graph_name,
+    region, sample_fastq_key, alignment_file_key, stats_file_key, cores,
+    monitor, node_sequences=None):
+    """
+    Align the given FASTQ from the sample store to the given extracted graph
+    using the given number of cores, and save the GAM in the output store.
+    Stage timings are recorded in the given ResourceMonitor and saved.
+    
+    If --pipeline_stats is on, also computes the stats (using node_sequences
+    if set) and saves them, and returns None. Otherwise, returns the run time
+    to put in the stats when they are computed.
+    
+    """
+    
+    sample_store = IOStore.get(options.sample_store)
+    out_store = IOStore.get(options.out_store)
+    
+    # Work somewhere no other sample in the job is using
+    work_dir = job.fileStore.getLocalTempDir()
+    
+    # We need the sample fastq
+    fastq_file = "{}/input.fq".format(work_dir)
     RealTimeLogger.get().info("Downloading FASTQ {} to {}".format(
         sample_fastq_key, fastq_file))
-    sample_store.read_input_file(sample_fastq_key, fastq_file)
+    with monitor.stage("download"):
+        sample_store.read_input_file(sample_fastq_key, fastq_file)
     
     # The FASTQ really should not be empty
     assert(os.stat(fastq_file).st_size > 0)
     
+    # Plan out what to run
+    vg_parts = ["{}vg".format(bin_prefix), "map", "-f", fastq_file,
+        "-i", "-M2", "-W", "1000", "-u", "0", "-U", "-t", str(cores),
+        graph_file]
+        
+    if options.index_mode == "rocksdb":
+        vg_parts += ["-d", graph_file + ".index", "-n3", "-k",
+            str(options.kmer_size)]
+    elif options.index_mode == "gcsa-kmer":
+        # Use the new default context size in this case
+        vg_parts += ["-x", graph_file + ".xg", "-g", graph_file + ".gcsa",
+            "-n5", "-k", str(options.kmer_size)]
+    elif options.index_mode == "gcsa-mem":
+        # Don't pass the kmer size, so MEM matching is used
+        vg_parts += ["-x", graph_file + ".xg", "-g", graph_file + ".gcsa",
+            "-n5"]
+    else:
+        raise RuntimeError("invalid indexing mode: " + options.index_mode)
+        
+    if options.pipeline_stats and not options.gam_json:
+        # Stream the GAM to the output store and through the stats while vg is
+        # still mapping, instead of doing it afterwards in another job.
+        run_pipelined_alignment(job, options, vg_parts, graph_file, sample,
+            graph_name, region, alignment_file_key, stats_file_key, cores,
+            monitor, node_sequences=node_sequences)
+        os.unlink(fastq_file)
+        return None
+    
     # And a temp file for our aligner output
-    output_file = "{}/output.gam".format(job.fileStore.getLocalTempDir())
+    output_file = "{}/output.gam".format(work_dir)
     
     # Open the file stream for writing
     with open(output_file, "w") as alignment_file:
     
         # Start the aligner and have it write to the file
         
-        # Plan out what to run
-        vg_parts = ["{}vg".format(bin_prefix), "map", "-f", fastq_file,
-            "-i", "-M2", "-W", "1000", "-u", "0", "-U", "-t", str(job.cores), graph_file]
-            
-        if options.index_mode == "rocksdb":
-            vg_parts += ["-d", graph_file + ".index", "-n3", "-k",
-                str(options.kmer_size)]
-        elif options.index_mode == "gcsa-kmer":
-            # Use the new default context size in this case
-            vg_parts += ["-x", graph_file + ".xg", "-g", graph_file + ".gcsa",
-                "-n5", "-k", str(options.kmer_size)]
-        elif options.index_mode == "gcsa-mem":
-            # Don't pass the kmer size, so MEM matching is used
-            vg_parts += ["-x", graph_file + ".xg", "-g", graph_file + ".gcsa",
-                "-n5"]
-        else:
-            raise RuntimeError("invalid indexing mode: " + options.index_mode)
-        
         RealTimeLogger.get().info(
             "Running VG for {} against {} {}: {}".format(sample, graph_name,
             region, " ".join(vg_parts)))
         
         # Mark when we start the alignment
         start_time = timeit.default_timer()
-        process = subprocess.Popen(vg_parts, stdout=alignment_file)
-            
-        if process.wait() != 0:
-            # Complain if vg dies
-            raise RuntimeError("vg died with error {}".format(
-                process.returncode))
+        
+        with monitor.stage("map"):
+            process = subprocess.Popen(vg_parts, stdout=alignment_file)
+                
+            if process.wait() != 0:
+                # Complain if vg dies
+                raise RuntimeError("vg died with error {}".format(
+                    process.returncode))
                 
         # Mark when it's done
         end_time = timeit.default_timer()
@@ -1015,29 +1672,136 @@ def run_alignment(job, options, bin_dir_id, sample, graph_name, region,
     RealTimeLogger.get().info("Aligned {}".format(output_file))
     
     # Upload the alignment
-    out_store.write_output_file(output_file, alignment_file_key)
+    with monitor.stage("upload"):
+        out_store.write_output_file(output_file, alignment_file_key)
+        
+    # Save how long everything took
+    monitor.save(out_store, get_metrics_key(options, "align", region,
+        graph_name, sample))
+        
+    # Don't fill up the disk when doing a batch
+    os.unlink(fastq_file)
+    os.unlink(output_file)
     
-    RealTimeLogger.get().info("Need to recompute stats for new "
-        "alignment: {}".format(stats_file_key))
-
-    # Add a follow-on to calculate stats. It only needs 2 cores since it's
-    # not really prarllel.
-    job.addFollowOnJobFn(run_stats, options, bin_dir_id, index_dir_id,
-        alignment_file_key, stats_file_key, run_time=run_time,
-        cores=2, memory="4G", disk="10G")
+    return run_time
+    
+def get_node_sequences(job, directory_cache, node_store_dir_id, graph_file,
+    monitor):
+    """
+    Get a NodeSequenceStore for the given graph, from the node store directory
+    with the given file store ID (if not None) through the given
+    DirectoryCache, or from the extracted graph file otherwise.
+    
+    Returns the store and the cached directory it came from (or None). Release
+    the directory from the cache when done with the store.
+    
+    """
+    
+    if node_store_dir_id is None:
+        return NodeSequenceStore.from_graph(graph_file), None
+        
+    with monitor.stage("download"):
+        nodes_dir = directory_cache.get(job.fileStore, node_store_dir_id)
+    return NodeSequenceStore.load("{}/graph.nodes".format(nodes_dir)), nodes_dir
+        
+def run_pipelined_alignment(job, options, vg_parts, graph_file, sample,
+    graph_name, region, alignment_file_key, stats_file_key, cores, monitor,
+    node_sequences=None):
+    """
+    Run the given vg map command line, which uses the given number of cores,
+    and stream the GAM it produces straight to alignment_file_key in the
+    output store while also computing its stats, which are saved under
+    stats_file_key. Never writes the GAM to local disk.
+    
+    graph_file is the extracted graph, used to get reference sequences if
+    node_sequences isn't passed. Stage timings are recorded in the given
+    ResourceMonitor.
+    
+    """
+    
+    out_store = IOStore.get(options.out_store)
+    
+    if node_sequences is None:
+        # We need the reference sequences before we start, so we can count Ns.
+        node_sequences = NodeSequenceStore.from_graph(graph_file)
+    
+    accumulator = AlignmentStatsAccumulator(node_sequences, run_cores=cores)
+    
+    RealTimeLogger.get().info(
+        "Running pipelined VG for {} against {} {}: {}".format(sample,
+        graph_name, region, " ".join(vg_parts)))
+        
+    # Mark when we start the alignment
+    start_time = timeit.default_timer()
+    
+    with monitor.stage("map"):
+        process = subprocess.Popen(vg_parts, stdout=subprocess.PIPE)
+        
+        try:
+            with out_store.write_output_stream(alignment_file_key) as upload:
+                # Everything we parse gets uploaded too
+                tee = TeeStream(process.stdout, upload)
+                
+                for message in iterate_messages(tee):
+                    accumulator.add(parse_alignment(message))
+                    
+                # Send along anything after the last message
+                tee.drain()
+                
+                if process.wait() != 0:
+                    # Complain if vg dies, before the GAM gets saved
+                    raise RuntimeError("vg died with error {}".format(
+                        process.returncode))
+        except:
+            if process.poll() is None:
+                # Don't leave vg running if we can't take its output
+                process.kill()
+                process.wait()
+            raise
+            
+    # Mark when it's done
+    end_time = timeit.default_timer()
+    accumulator.stats["run_time"] = end_time - start_time
+    
+    RealTimeLogger.get().info("Aligned and uploaded {}".format(
+        alignment_file_key))
+    
+    stats = accumulator.finish()
+    
+    # Save the stats as JSON
+    stats_file = "{}/stats.json".format(job.fileStore.getLocalTempDir())
+    with open(stats_file, "w") as stats_handle:
+        json.dump(stats, stats_handle)
+        
+    with monitor.stage("upload"):
+        out_store.write_output_file(stats_file, stats_file_key)
+        
+    # Save how long everything took
+    monitor.save(out_store, get_metrics_key(options, "align", region,
+        graph_name, sample))
             
       
 def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
-    stats_file_key, run_time=None):
+    stats_file_key, run_time=None, run_cores=None, node_store_dir_id=None,
+    index_toc_key=None):
     """
     If the stats aren't done, or if they need to be re-done, retrieve the
     alignment file from the output store under alignment_file_key and compute the
     stats file, saving it under stats_file_key.
     
     Uses index_dir_id to get the graph, and thus the reference sequence that
-    each read is aligned against, for the purpose of discounting Ns.
-    
-    Can take a run time to put in the stats.
+    each read is aligned against, for the purpose of discounting Ns. If
+    node_store_dir_id is set, the node sequence store directory with that file
+    store ID is used instead of the graph, shared with other jobs on the node.
+    If not, a store is made from the graph and saved for later runs by the
+    graph's contents.
+    
+    Only the graph is extracted from the index, and if index_toc_key is set and
+    the index's table of contents is saved there in the output store, the index
+    is only read as far as the graph.
+    
+    Can take a run time to put in the stats, along with the number of cores
+    it was measured on.
 
     Assumes that stats actually do need to be computed, and overwrites any old
     stats.
@@ -1054,6 +1818,12 @@ def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
     
     RealTimeLogger.get().info("Computing stats for {}".format(stats_file_key))
     
+    # Measure how long each part of the job takes. The stats key tells us what
+    # region, graph, and sample we're working on.
+    region, graph_name, sample = re.match("stats/(.*)/(.*)/(.*)\.json$",
+        stats_file_key).groups()
+    monitor = ResourceMonitor(region=region, graph=graph_name, sample=sample)
+    
     if bin_dir_id is not None:
         # Download the binaries
         bin_dir = "{}/bin".format(job.fileStore.getLocalTempDir())
@@ -1064,89 +1834,195 @@ def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
     else:
         bin_prefix = ""
         
-    # Download the indexed graph to a directory we can use
-    graph_dir = "{}/graph".format(job.fileStore.getLocalTempDir())
-    read_global_directory(job.fileStore, index_dir_id, graph_dir)
-    
-    # We know what the vg file in there will be named
-    graph_file = "{}/graph.vg".format(graph_dir)
+    # Directories come from the cache shared by the jobs on this node
+    directory_cache = DirectoryCache(options.cache_dir,
+        options.cache_size * 1024 ** 3)
     
-    # Load the node sequences into memory. This holds node sequence string by
-    # ID.
-    node_sequences = {}
+    # And the node sequences directory, if we get one
+    nodes_dir = None
     
-    # Read the alignments in in JSON-line format
-    read_graph = subprocess.Popen(["{}vg".format(bin_prefix), "view", "-j",
-        graph_file], stdout=subprocess.PIPE)
-        
-    for line in read_graph.stdout:
-        # Parse the graph chunk JSON
-        graph_chunk = json.loads(line)
-        
-        for node_dict in graph_chunk.get("node", []):
-            # For each node, store its sequence under its id. We want to crash
-            # if a node exists for which one or the other isn't defined.
-            node_sequences[node_dict["id"]] = node_dict["sequence"]
+    if node_store_dir_id is not None:
+        # We can just memory-map the node sequences that were saved with the
+        # index, without touching the graph.
+        RealTimeLogger.get().info("Loading node sequences for {}".format(
+            graph_name))
+        with monitor.stage("download"):
+            nodes_dir = directory_cache.get(job.fileStore, node_store_dir_id)
+        node_sequences = NodeSequenceStore.load("{}/graph.nodes".format(
+            nodes_dir))
         
-    if read_graph.wait() != 0:
-        # Complain if vg dies
-        raise RuntimeError("vg died with error {}".format(
-            read_graph.returncode))
+    else:
+        # See if we can tell where the graph is in the index
+        index_toc = None
+        if index_toc_key is not None and out_store.exists(index_toc_key):
+            toc_file = "{}/index.toc".format(job.fileStore.getLocalTempDir())
+            out_store.read_input_file(index_toc_key, toc_file)
+            with open(toc_file) as toc_handle:
+                index_toc = json.load(toc_handle)
+    
+        with monitor.stage("untar"):
+            # Get just the graph from the indexed graph directory, shared with
+            # other jobs on this node
+            graph_dir = directory_cache.get(job.fileStore, index_dir_id,
+                members=["graph.vg"], toc=index_toc)
+        
+        try:
+            # We know what the vg file in there will be named
+            graph_file = "{}/graph.vg".format(graph_dir)
+            
+            # Load the node sequences into memory. This holds node sequence
+            # string by ID.
+            if options.gam_json:
+                node_sequences = NodeSequenceStore.from_sequences(
+                    read_graph_nodes_json(bin_prefix, graph_file))
+            else:
+                node_sequences = NodeSequenceStore.from_graph(graph_file)
+                
+            # Save the node sequences by the graph's contents, and say which
+            # graph the index holds, so later runs can find them.
+            graph_hash = hash_file(graph_file)
+            node_store_file = "{}/graph.nodes".format(
+                job.fileStore.getLocalTempDir())
+            node_sequences.save(node_store_file)
+            out_store.write_output_file(node_store_file, get_node_store_key(
+                graph_hash))
+            save_graph_hash(job, options, out_store, region, graph_name,
+                graph_hash)
+        finally:
+            # We have everything we need out of the graph
+            directory_cache.release(graph_dir)
  
     # Declare local files for everything
     stats_file = "{}/stats.json".format(job.fileStore.getLocalTempDir())
     alignment_file = "{}/output.gam".format(job.fileStore.getLocalTempDir())
     
     # Download the alignment
-    out_store.read_input_file(alignment_file_key, alignment_file)
+    with monitor.stage("download"):
+        out_store.read_input_file(alignment_file_key, alignment_file)
            
-    # Read the alignments in in JSON-line format
-    read_alignment = subprocess.Popen(["{}vg".format(bin_prefix), "view", "-aj",
-        alignment_file], stdout=subprocess.PIPE)
-       
+    if options.gam_json:
+        # Read the alignments in in JSON-line format
+        read_alignment = subprocess.Popen(["{}vg".format(bin_prefix), "view",
+            "-aj", alignment_file], stdout=subprocess.PIPE)
+        alignments = (json.loads(line) for line in read_alignment.stdout)
+    else:
+        # Read the alignments straight out of the binary GAM
+        read_alignment = None
+        alignments = read_alignments(alignment_file)
+        
     # Count up the stats
-    stats = {
-        "total_reads": 0,
-        "total_mapped": 0,
-        "total_multimapped": 0,
-        "total_secondary_visible": 0,
-        "total_sufficiently_unique": 0,
-        "mapped_lengths": collections.Counter(),
-        "unmapped_lengths": collections.Counter(),
-        "aligned_lengths": collections.Counter(),
-        "primary_scores": collections.Counter(),
-        "primary_mapqs": collections.Counter(),
-        "primary_identities": collections.Counter(), # Deprecated; doesn't count deletions in this vg
-        "primary_mismatches": collections.Counter(), # Deprecated; doesn't count deletions
-        "primary_matches_per_column": collections.Counter(),
-        "primary_indels": collections.Counter(),
-        "primary_substitutions": collections.Counter(),
-        "secondary_scores": collections.Counter(),
-        "secondary_mapqs": collections.Counter(),
-        "secondary_identities": collections.Counter(), # Deprecated; doesn't count deletions in this vg
-        "secondary_mismatches": collections.Counter(), # Deprecated; doesn't count deletions
-        "secondary_matches_per_column": collections.Counter(),
-        "secondary_indels": collections.Counter(),
-        "secondary_substitutions": collections.Counter(),
-        "primary_advantage": collections.Counter(),
-        "run_time": run_time
-    }
-        
-    # We need to track the last alignment
-    last_alignment = None
-    # And its matches per column, if it's a primary
-    last_matches_per_column = None
-        
-    for line in read_alignment.stdout:
-        # Parse the alignment JSON
-        alignment = json.loads(line)
+    accumulator = AlignmentStatsAccumulator(node_sequences, run_time=run_time,
+        run_cores=run_cores)
+    
+    try:
+        with monitor.stage("stats"):
+            if (options.parallel_stats and not options.gam_json and
+                job.cores > 1):
+                # Farm out chunks of the GAM to a process per core, and merge
+                # what comes back.
+                RealTimeLogger.get().info("Computing stats with {} "
+                    "processes".format(int(job.cores)))
+                for batch_stats in compute_stats_in_parallel(alignment_file,
+                    node_sequences, int(job.cores)):
+                    
+                    accumulator.merge(batch_stats)
+            else:
+                for alignment in alignments:
+                    accumulator.add(alignment)
+                
+            stats = accumulator.finish()
+    finally:
+        if nodes_dir is not None:
+            # We're done with the node sequences
+            directory_cache.release(nodes_dir)
+    
+    with open(stats_file, "w") as stats_handle:
+        # Save the stats as JSON
+        json.dump(stats, stats_handle)
+        
+    if read_alignment is not None and read_alignment.wait() != 0:
+        # Complain if vg dies
+        raise RuntimeError("vg died with error {}".format(
+            read_alignment.returncode))
+        
+    # Now send the stats to the output store where they belong.
+    with monitor.stage("upload"):
+        out_store.write_output_file(stats_file, stats_file_key)
+        
+    # Save how long everything took
+    monitor.save(out_store, get_metrics_key(options, "stats", region,
+        graph_name, sample))
+    
+        
+class AlignmentStatsAccumulator(object):
+    """
+    Compute mapping statistics over a stream of alignments, each a dict in the
+    format produced by `vg view -aj` (or by vglib.read_alignments).
+    
+    Secondary alignments must come right after their corresponding primary
+    alignments.
+    
+    """
+    
+    def __init__(self, node_sequences, run_time=None, run_cores=None):
+        """
+        Make a new accumulator that counts Ns in reference sequences with the
+        given NodeSequenceStore, for the purpose of discounting them. Records
+        the given run time, and the number of cores vg map had for it, in the
+        stats.
+        
+        """
+        
+        # Keep the node sequences
+        self.node_sequences = node_sequences
+        
+        # Count up the stats
+        self.stats = {
+            "total_reads": 0,
+            "total_mapped": 0,
+            "total_multimapped": 0,
+            "total_secondary_visible": 0,
+            "total_sufficiently_unique": 0,
+            "mapped_lengths": collections.Counter(),
+            "unmapped_lengths": collections.Counter(),
+            "aligned_lengths": collections.Counter(),
+            "primary_scores": collections.Counter(),
+            "primary_mapqs": collections.Counter(),
+            "primary_identities": collections.Counter(), # Deprecated; doesn't count deletions in this vg
+            "primary_mismatches": collections.Counter(), # Deprecated; doesn't count deletions
+            "primary_matches_per_column": collections.Counter(),
+            "primary_indels": collections.Counter(),
+            "primary_substitutions": collections.Counter(),
+            "secondary_scores": collections.Counter(),
+            "secondary_mapqs": collections.Counter(),
+            "secondary_identities": collections.Counter(), # Deprecated; doesn't count deletions in this vg
+            "secondary_mismatches": collections.Counter(), # Deprecated; doesn't count deletions
+            "secondary_matches_per_column": collections.Counter(),
+            "secondary_indels": collections.Counter(),
+            "secondary_substitutions": collections.Counter(),
+            "primary_advantage": collections.Counter(),
+            "run_time": run_time,
+            "run_cores": run_cores
+        }
+        
+        # We need to track the last alignment
+        self.last_alignment = None
+        # And its matches per column, if it's a primary
+        self.last_matches_per_column = None
+        
+    def add(self, alignment):
+        """
+        Add the given alignment dict to the stats.
+        
+        """
+        
         
         if alignment.get("is_secondary", False):
             # It's a multimapping.
             
-            if (last_alignment is None or 
-                last_alignment.get("name") != alignment.get("name") or 
-                last_alignment.get("is_secondary", False)):
+            if (self.last_alignment is None or 
+                self.last_alignment.get("name") != alignment.get("name") or 
+                self.last_alignment.get("is_secondary", False)):
             
                 # This is a secondary alignment without a corresponding primary
                 # alignment (which would have to be right before it in GAM
@@ -1154,24 +2030,24 @@ def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
                 raise RuntimeError("{} secondary alignment comes after "
                     "alignment of {} instead of corresponding primary "
                     "alignment\n".format(alignment.get("name"), 
-                    last_alignment.get("name") if last_alignment is not None 
+                    self.last_alignment.get("name") if self.last_alignment is not None 
                     else "nothing"))
                     
-            if alignment.get("path", {}) == last_alignment.get("path", {}):
+            if alignment.get("path", {}) == self.last_alignment.get("path", {}):
                 # This secondary takes the same path as the primary, so we don't
                 # want to consider it as a separate alignment. It's just there
                 # to even things up for the secondary alignment of the other end
                 # of the read.
                 
                 # Save the alignment for checking for wayward secondaries
-                last_alignment = alignment
+                self.last_alignment = alignment
                 
                 # This was a secondary, so this field is not important
-                last_matches_per_column = None
+                self.last_matches_per_column = None
                 
                 # Don't process it any more, and don't record any score
                 # advantage at all for its primary alignment.
-                continue
+                return
             
         
         # How long is this read?
@@ -1214,29 +2090,21 @@ def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
                 # Figure out what the reference sequence for this mapping should
                 # be
                 
+                # We don't actually build the reference sequence; we just
+                # count the Ns in the right part of the node with the store's
+                # prefix sums. On the reverse strand we start at the offset base
+                # and count from the end, but if offset is 0 we take the whole
+                # thing.
                 position = mapping.get("position", {})
-                if position.has_key("node_id"):
-                    # We actually are mapped to a reference node
-                    ref_sequence = node_sequences[position["node_id"]]
-                    
-                    # Grab the offset
-                    offset = position.get("offset", 0)
-                    
-                    if mapping.get("is_reverse", False):
-                        # We start at the offset base on the reverse strand.
-                        # This means we count from the end.
-                        # But if offset is 0 we take the whole thing.
-                        ref_sequence = reverse_complement(
-                            ref_sequence[0:-offset] if offset != 0
-                            else ref_sequence)
-                    else:
-                        # Just clip so we start at the specified offset
-                        ref_sequence = ref_sequence[offset:]
-                    
-                else:
-                    # We're aligned against no node, and thus an empty reference
-                    # sequence (and thus must be all insertions)
-                    ref_sequence = "" 
+                
+                # Which node are we actually mapped to, if any? If none, we
+                # have an empty reference sequence (and thus must be all
+                # insertions).
+                node_id = position.get("node_id", None)
+                
+                # Grab the offset and strand
+                offset = position.get("offset", 0)
+                is_reverse = mapping.get("is_reverse", False)
                     
                 # Start at the beginning of the reference sequence for the
                 # mapping.
@@ -1257,11 +2125,15 @@ def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
                         (edit_number == len(edits) - 1 and 
                         mapping_number == len(mappings) - 1))
                         
-                    # Count up the Ns in the reference sequence for the edit. We
-                    # get the part of the reference string that should belong to
-                    # this edit.
-                    reference_N_count = count_Ns(ref_sequence[
-                        index_in_ref:index_in_ref + edit.get("from_length", 0)])
+                    # Count up the Ns in the reference sequence for the edit, in
+                    # the part of the reference that should belong to this
+                    # edit.
+                    if node_id is not None:
+                        reference_N_count = self.node_sequences.count_strand_Ns(
+                            node_id, offset, is_reverse, index_in_ref,
+                            index_in_ref + edit.get("from_length", 0))
+                    else:
+                        reference_N_count = 0
                         
                     # Count up the columns, which is the max of the from and to
                     # lengths, but discounting any columns where the reference
@@ -1329,56 +2201,56 @@ def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
                 # multimapped read.
                 
                 # Log its stats as multimapped
-                stats["total_multimapped"] += 1
-                stats["secondary_scores"][score] += 1
-                stats["secondary_mismatches"][mismatches] += 1
-                stats["secondary_indels"][indels] += 1
-                stats["secondary_substitutions"][substitutions] += 1
-                stats["secondary_mapqs"][mapq] += 1
-                stats["secondary_identities"][identity] += 1
-                stats["secondary_matches_per_column"][matches_per_column] += 1
+                self.stats["total_multimapped"] += 1
+                self.stats["secondary_scores"][score] += 1
+                self.stats["secondary_mismatches"][mismatches] += 1
+                self.stats["secondary_indels"][indels] += 1
+                self.stats["secondary_substitutions"][substitutions] += 1
+                self.stats["secondary_mapqs"][mapq] += 1
+                self.stats["secondary_identities"][identity] += 1
+                self.stats["secondary_matches_per_column"][matches_per_column] += 1
                 
-                # We know we have a primary in last_alignment, so we can
+                # We know we have a primary in self.last_alignment, so we can
                 # calculate a score advantage for the primary.
-                score_advantage = (last_alignment.get("score", 0) -
+                score_advantage = (self.last_alignment.get("score", 0) -
                     alignment.get("score", 0))
-                stats["primary_advantage"][score_advantage] += 1
+                self.stats["primary_advantage"][score_advantage] += 1
                 
                 # We saw a secondary alignment
-                stats["total_secondary_visible"] += 1
+                self.stats["total_secondary_visible"] += 1
                 
-                if (last_matches_per_column >= 0.95 and
+                if (self.last_matches_per_column >= 0.95 and
                     matches_per_column < 0.85):
                     # If the last alignment was sufficiently good, and this
                     # secondary is sufficiently bad, then the last alignment is
                     # sufficiently unique.
-                    stats["total_sufficiently_unique"] += 1
+                    self.stats["total_sufficiently_unique"] += 1
                 
             else:
                 # Log its stats as primary. We'll get exactly one of these per
                 # read with any mappings.
-                stats["total_mapped"] += 1
-                stats["primary_scores"][score] += 1
-                stats["primary_mismatches"][mismatches] += 1
-                stats["primary_indels"][indels] += 1
-                stats["primary_substitutions"][substitutions] += 1
-                stats["primary_mapqs"][mapq] += 1
-                stats["primary_identities"][identity] += 1
-                stats["primary_matches_per_column"][matches_per_column] += 1
+                self.stats["total_mapped"] += 1
+                self.stats["primary_scores"][score] += 1
+                self.stats["primary_mismatches"][mismatches] += 1
+                self.stats["primary_indels"][indels] += 1
+                self.stats["primary_substitutions"][substitutions] += 1
+                self.stats["primary_mapqs"][mapq] += 1
+                self.stats["primary_identities"][identity] += 1
+                self.stats["primary_matches_per_column"][matches_per_column] += 1
                 
                 # Record that a read of this length was mapped
-                stats["mapped_lengths"][length] += 1
+                self.stats["mapped_lengths"][length] += 1
                 
                 # And that a read with this many aligned primary bases was found
-                stats["aligned_lengths"][aligned_length] += 1
+                self.stats["aligned_lengths"][aligned_length] += 1
                 
                 # We won't see an unaligned primary alignment for this read, so
                 # count the read
-                stats["total_reads"] += 1
+                self.stats["total_reads"] += 1
                 
-                if (last_alignment is not None and
-                    not last_alignment.get("is_secondary", False) and
-                    last_alignment.has_key("score")):
+                if (self.last_alignment is not None and
+                    not self.last_alignment.get("is_secondary", False) and
+                    self.last_alignment.has_key("score")):
                     # This is a primary alignment, and it comes after another
                     # primary alignment. That other primary alignment has no
                     # secondary at all (not even a duplicate of itself), but it
@@ -1386,27 +2258,27 @@ def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
                     # a secondary of score 0, and an advantage over that
                     # secondary equal to its score.
                     
-                    stats["primary_advantage"][
-                        last_alignment.get("score", 0)] += 1
+                    self.stats["primary_advantage"][
+                        self.last_alignment.get("score", 0)] += 1
                     
                     # We could have seen a secondary for that alignment, but we
                     # didn't.
-                    stats["total_secondary_visible"] += 1
+                    self.stats["total_secondary_visible"] += 1
                     
-                    if last_matches_per_column >= 0.95:
+                    if self.last_matches_per_column >= 0.95:
                         # If the last alignment was sufficiently good, given
                         # that it had no secondary at all, it is sufficiently
                         # unique.
-                        stats["total_sufficiently_unique"] += 1
+                        self.stats["total_sufficiently_unique"] += 1
         
         elif not alignment.get("is_secondary", False):
             # We have an unmapped primary "alignment"
             
             # Count the read by its primary alignment
-            stats["total_reads"] += 1
+            self.stats["total_reads"] += 1
             
             # Record that an unmapped read has this length
-            stats["unmapped_lengths"][length] += 1
+            self.stats["unmapped_lengths"][length] += 1
             
             matches_per_column = None
             
@@ -1415,44 +2287,163 @@ def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
             matches_per_column = None
             
         # Save the alignment for checking for wayward secondaries
-        last_alignment = alignment
-        last_matches_per_column = matches_per_column
-    
-    # Now do the last alignment overall, if it was a primary.
-    if (last_alignment is not None and
-        not last_alignment.get("is_secondary", False) and
-        last_alignment.has_key("score")):
-        # The last alignment is primary. That primary alignment has no secondary
-        # at all (not even a duplicate of itself), but it was aligned (nonzero
-        # score), so we need to pretend it had a secondary of score 0, and an
-        # advantage over that secondary equal to its score.
-        
-        stats["primary_advantage"][
-            last_alignment.get("score", 0)] += 1
-        
-        # We could have seen a secondary for that alignment, but we
-        # didn't.
-        stats["total_secondary_visible"] += 1
-        
-        if last_matches_per_column >= 0.95:
-            # If the last alignment was sufficiently good, given
-            # that it had no secondary at all, it is sufficiently
-            # unique.
-            stats["total_sufficiently_unique"] += 1
+        self.last_alignment = alignment
+        self.last_matches_per_column = matches_per_column
+        
+    def finish(self):
+        """
+        Finish the stats after all the alignments have been added, and return
+        the stats dict, which is ready to be saved as JSON.
+        
+        """
+        
+        # Now do the last alignment overall, if it was a primary.
+        if (self.last_alignment is not None and
+            not self.last_alignment.get("is_secondary", False) and
+            self.last_alignment.has_key("score")):
+            # The last alignment is primary. That primary alignment has no
+            # secondary at all (not even a duplicate of itself), but it was
+            # aligned (nonzero score), so we need to pretend it had a secondary
+            # of score 0, and an advantage over that secondary equal to its
+            # score.
+        
+            self.stats["primary_advantage"][
+                self.last_alignment.get("score", 0)] += 1
+        
+            # We could have seen a secondary for that alignment, but we
+            # didn't.
+            self.stats["total_secondary_visible"] += 1
+        
+            if self.last_matches_per_column >= 0.95:
+                # If the last alignment was sufficiently good, given
+                # that it had no secondary at all, it is sufficiently
+                # unique.
+                self.stats["total_sufficiently_unique"] += 1
                 
-    with open(stats_file, "w") as stats_handle:
-        # Save the stats as JSON
-        json.dump(stats, stats_handle)
+        return self.stats
         
-    if read_alignment.wait() != 0:
-        # Complain if vg dies
-        raise RuntimeError("vg died with error {}".format(
-            read_alignment.returncode))
+    def merge(self, stats):
+        """
+        Add in the given finished stats dict, computed for a different set of
+        reads. Doesn't change our run time or cores.
         
-    # Now send the stats to the output store where they belong.
-    out_store.write_output_file(stats_file, stats_file_key)
+        """
+        
+        for stat_name, value in stats.iteritems():
+            if stat_name in ("run_time", "run_cores"):
+                # Keep our own run time
+                continue
+            
+            if isinstance(value, collections.Counter):
+                # Add up the histograms
+                self.stats[stat_name].update(value)
+            else:
+                # Add up the totals
+                self.stats[stat_name] += value
+                
+# Stats worker processes keep the node sequences here, so they only have to be
+# sent over once.
+stats_node_sequences = None
+
+def set_stats_node_sequences(node_sequences):
+    """
+    Initializer for stats worker processes. Saves the node sequences to look up
+    reference bases in.
     
+    """
+    
+    global stats_node_sequences
+    stats_node_sequences = node_sequences
+    
+def compute_batch_stats(messages):
+    """
+    Compute and return a finished stats dict for the given batch of Alignment
+    message strings, which must come from batch_alignment_messages. Runs in a
+    stats worker process.
+    
+    Merging the stats for all the batches gives the same stats as adding all
+    the alignments to one accumulator, even when a batch boundary falls right
+    after a mapped primary alignment with no secondary.
+    
+    >>> def message(name, score=None, secondary=False):
+    ...     message = bytearray([0x0a, 0x04]) + bytearray("ACGT")
+    ...     message += bytearray([0x1a, len(name)]) + bytearray(name)
+    ...     if score is not None:
+    ...         message += bytearray([0x30, score, 0x81, 0x01])
+    ...         message += bytearray(struct.pack("<d", 1.0))
+    ...     if secondary:
+    ...         # Give it its own path, so it isn't a copy of the primary
+    ...         message += bytearray([0x12, 0x03, 0x0a, 0x01]) + bytearray("x")
+    ...         message += bytearray([0x78, 0x01])
+    ...     return message
+    >>> messages = [message("a", 10), message("b"), message("c", 12),
+    ...     message("c", 8, True), message("d", 5), message("e")]
+    >>> serial = AlignmentStatsAccumulator(None)
+    >>> for m in messages:
+    ...     serial.add(parse_alignment(m))
+    >>> serial_stats = serial.finish()
+    >>> batched = AlignmentStatsAccumulator(None)
+    >>> for batch in batch_alignment_messages(messages, 1):
+    ...     batched.merge(compute_batch_stats(batch))
+    >>> batched.stats == serial_stats
+    True
+    >>> serial_stats["total_secondary_visible"]
+    1
+    
+    """
+    
+    accumulator = AlignmentStatsAccumulator(stats_node_sequences)
+    
+    for message in messages:
+        accumulator.add(parse_alignment(bytearray(message)))
+        
+    return accumulator.finish()
+    
+def compute_stats_in_parallel(alignment_file, node_sequences, processes,
+    batch_size=10000):
+    """
+    Split the given GAM file into batches of about batch_size alignments,
+    keeping secondary alignments with their primaries, and compute stats for
+    them in a pool of the given number of processes.
+    
+    Yields a finished stats dict for each batch, in no particular order.
+    
+    """
+    
+    # Make the pool. Workers are forked, so they get the node sequences without
+    # having to pickle them.
+    pool = multiprocessing.Pool(processes, initializer=set_stats_node_sequences,
+        initargs=(node_sequences,))
         
+    try:
+        # This holds the async results we're waiting on, oldest first. We don't
+        # let too many batches be in flight at once, so we don't read the whole
+        # GAM into memory when the workers fall behind.
+        pending = collections.deque()
+        
+        with open(alignment_file, "rb") as gam_file:
+            for batch in batch_alignment_messages(iterate_messages(gam_file),
+                batch_size):
+                
+                if len(pending) >= processes * 2:
+                    # Wait for the oldest batch before sending more
+                    yield pending.popleft().get()
+                    
+                pending.append(pool.apply_async(compute_batch_stats, (batch,)))
+                
+        while len(pending) > 0:
+            # Collect the stragglers
+            yield pending.popleft().get()
+            
+        pool.close()
+    except:
+        # Don't leave workers running if anything goes wrong
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 def main(args):
     """
     Parses command line arguments and do the work of the program.
@@ -1477,6 +2468,11 @@ def main(args):
             dateutil.parser.parse(options.alignments_too_old)
         assert(options.alignments_too_old.tzinfo != None)
     
+    if options.metrics_run is None:
+        # Name this run's metrics after when it started
+        options.metrics_run = datetime.datetime.utcnow().strftime(
+            "%Y%m%d-%H%M%S")
+    
     RealTimeLogger.start_master()
     
     # Pre-read the input file so we don't try to send file handles over the
@@ -1490,6 +2486,10 @@ def main(args):
     # Run it and see how many jobs fail
     failed_jobs = Job.Runner.startToil(root_job,  options)
     
+    # Put together the metrics from all the jobs that got that far
+    ResourceMonitor.merge(IOStore.get(options.out_store), "metrics/{}".format(
+        options.metrics_run), "metrics/{}.tsv".format(options.metrics_run))
+    
     if failed_jobs > 0:
         raise Exception("{} jobs failed!".format(failed_jobs))
         
@@ -2,11 +2,16 @@
 """
 redoStats.py: rerun stats on a GAM file
 
+Reads the GAM file named on the command line directly, or `vg view -aj` JSON
+alignments from standard input if no file is given.
+
 """
 
 import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
 import doctest, re, json, collections, time, timeit
 
+from vglib import read_alignments
+
 stats = {
     "total_reads": 0,
     "total_mapped": 0,
@@ -24,9 +29,14 @@ stats = {
 
 last_alignment = None
 
-for line in sys.stdin:
-    # Parse the alignment JSON
-    alignment = json.loads(line)
+if len(sys.argv) > 1:
+    # Read the alignments straight out of the binary GAM
+    alignments = read_alignments(sys.argv[1])
+else:
+    # Parse the alignment JSON lines
+    alignments = (json.loads(line) for line in sys.stdin)
+
+for alignment in alignments:
     
     if alignment.has_key("score"):
         # This alignment is aligned.
@@ -14,6 +14,13 @@ import random
 import time
 import traceback
 import stat
+import fcntl
+import hashlib
+import errno
+import multiprocessing.pool
+import subprocess
+import contextlib
+import resource
 
 import dateutil.parser
 import dateutil.tz
@@ -29,6 +36,13 @@ try:
     except ImportError:
         # Versions before 0.30
         from azure.storage.blob import BlobService as BlockBlobService
+    try:
+        # We can only do our own chunked transfers with 0.30+
+        from azure.storage.blob import BlobBlock
+        from azure.common import AzureMissingResourceHttpError
+        have_azure_blocks = True
+    except ImportError:
+        have_azure_blocks = False
     have_azure = True
 except ImportError:
     have_azure = False
@@ -214,9 +228,225 @@ class JSONDatagramHandler(logging.handlers.DatagramHandler):
         
         return length + json_string
         
+class BatchedJSONDatagramHandler(JSONDatagramHandler):
+    """
+    Send logging records over UDP serialized as JSON, packing as many
+    length-prefixed records into each datagram as will fit.
+    
+    Records are buffered and sent from a background thread every interval
+    seconds. Records below WARNING level go through a level-based sampler and a
+    token bucket rate limiter first, and are dropped if sampled out, over the
+    rate limit, or if the buffer is full. The sent and dropped attributes count
+    what happened to records, and a warning about dropped records goes out
+    along with the next batch after any are dropped.
+    
+    A process forked from one using the handler gets the handler but not its
+    sender thread, so the handler notices when it is in a new process and
+    starts over there, with its own buffer, locks, and sender.
+    """
+    
+    def __init__(self, host, port, interval=1.0, rate=100, burst=1000,
+        sample_rates=None, max_buffer=10000, max_datagram=60000):
+        """
+        Make a new handler sending to the given host and port.
+        
+        Sends a batch every interval seconds. Lets through records below WARNING
+        at an average of rate per second, with bursts of up to burst. If
+        sample_rates is set, it is a dict from level number to the fraction of
+        records at that level to keep. Keeps at most max_buffer records waiting,
+        and sends datagrams of at most max_datagram bytes, except for single
+        records that are bigger than that.
+        
+        """
+        
+        JSONDatagramHandler.__init__(self, host, port)
+        
+        self.interval = interval
+        self.rate = rate
+        self.burst = burst
+        self.sample_rates = sample_rates if sample_rates is not None else {}
+        self.max_buffer = max_buffer
+        self.max_datagram = max_datagram
+        
+        # How many tokens does the rate limiter have, and when did it last get
+        # more?
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        
+        self.start_sender()
+        
+    def start_sender(self):
+        """
+        Set up the buffer and counters, and start the background thread that
+        sends batches, for the current process.
+        
+        """
+        
+        # This holds encoded records waiting to go out
+        self.buffer = []
+        
+        # How many records have we sent and dropped?
+        self.sent = 0
+        self.dropped = 0
+        # How many dropped records have we told the master about?
+        self.dropped_reported = 0
+        
+        # Only one thread can send at a time. We don't use the handler lock for
+        # the buffer, since logging holds that while it closes us.
+        self.send_lock = threading.Lock()
+        self.buffer_lock = threading.Lock()
+        
+        # Remember what process the sender belongs to
+        self.pid = os.getpid()
+        
+        # Start sending batches in the background until we're closed
+        self.stopped = threading.Event()
+        self.sender = threading.Thread(target=self.run_sender)
+        self.sender.daemon = True
+        self.sender.start()
+        
+    def check_fork(self):
+        """
+        If we have been forked into a new process, start over in it. The
+        inherited sender thread doesn't exist here, the inherited locks may
+        have been held by it at the fork, and the inherited buffer is the
+        parent's to send.
+        
+        """
+        
+        if os.getpid() != self.pid:
+            self.start_sender()
+        
+    def admit(self, record):
+        """
+        Decide if a record should be sent. Warnings and worse always are.
+        
+        """
+        
+        if record.levelno >= logging.WARNING:
+            return True
+            
+        if random.random() >= self.sample_rates.get(record.levelno, 1.0):
+            # Sampled out
+            return False
+            
+        # Top up the token bucket
+        now = time.time()
+        self.tokens = min(float(self.burst),
+            self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        
+        if self.tokens < 1:
+            # Over the rate limit
+            return False
+            
+        self.tokens -= 1
+        return True
+        
+    def emit(self, record):
+        """
+        Buffer a record to be sent with the next batch. Called with the handler
+        lock held.
+        
+        """
+        
+        try:
+            self.check_fork()
+            
+            if self.admit(record):
+                message = self.makePickle(record)
+                with self.buffer_lock:
+                    if len(self.buffer) < self.max_buffer:
+                        self.buffer.append(message)
+                        return
+            
+            self.dropped += 1
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+            
+    def flush(self):
+        """
+        Send everything buffered so far, in as few datagrams as possible.
+        
+        """
+        
+        self.check_fork()
+        
+        with self.send_lock:
+            with self.buffer_lock:
+                # Grab the waiting records
+                messages = self.buffer
+                self.buffer = []
+                
+            # Drops only happen under the handler lock, so we might miss one
+            # here, but we'll get it next time.
+            dropped = self.dropped
+            if dropped > self.dropped_reported:
+                # Tell the master we've been dropping things
+                messages.append(self.makePickle(logging.makeLogRecord({
+                    "name": "realtime",
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": "Dropped {} log records so far ({} sent)".format(
+                        dropped, self.sent)
+                })))
+                self.dropped_reported = dropped
+            
+            # Pack the records into datagrams
+            datagram = []
+            datagram_size = 0
+            for message in messages:
+                if (datagram_size > 0 and
+                    datagram_size + len(message) > self.max_datagram):
+                    # This one won't fit, so send what we have
+                    self.send("".join(datagram))
+                    datagram = []
+                    datagram_size = 0
+                datagram.append(message)
+                datagram_size += len(message)
+                
+            if datagram_size > 0:
+                self.send("".join(datagram))
+                
+            self.sent += len(messages)
+            
+    def run_sender(self):
+        """
+        Send batches every interval until the handler is closed.
+        
+        """
+        
+        while not self.stopped.is_set():
+            self.stopped.wait(self.interval)
+            try:
+                self.flush()
+            except:
+                # Never let the sender thread die
+                pass
+                
+    def close(self):
+        """
+        Send anything left and stop sending batches.
+        
+        """
+        
+        self.stopped.set()
+        if threading.current_thread() is not self.sender:
+            # Let the sender thread notice
+            self.sender.join()
+        self.flush()
+        JSONDatagramHandler.close(self)
+
 class RealTimeLogger(object):
     """
     All-static class for getting a logger that logs over UDP to the master.
+    
+    Records are sent in batches, with records below WARNING rate-limited to
+    RT_LOGGING_RATE per second (default 100) and sampled according to
+    RT_LOGGING_SAMPLE (like "INFO:0.1,DEBUG:0", default no sampling), if those
+    are set in the environment.
     """
     
     # Also the logger
@@ -239,6 +469,15 @@ class RealTimeLogger(object):
         # Start up the logging server
         cls.logging_server = SocketServer.ThreadingUDPServer(("0.0.0.0", 0),
             LoggingDatagramHandler)
+        # Make sure it can take a whole batch of records at once
+        cls.logging_server.max_packet_size = 65536
+        try:
+            # And that it can hold a lot of batches waiting to be handled,
+            # rather than dropping them. The OS may give us less.
+            cls.logging_server.socket.setsockopt(socket.SOL_SOCKET,
+                socket.SO_RCVBUF, 16 * 1024 * 1024)
+        except socket.error:
+            pass
             
         # Set up a thread to do all the serving in the background and exit when we
         # do
@@ -263,6 +502,19 @@ class RealTimeLogger(object):
         
         cls.logging_server.shutdown()
         cls.server_thread.join()
+        
+    @classmethod
+    def flush(cls):
+        """
+        Send everything logged so far to the master now. Call this before
+        leaving a process that won't shut down logging, like a
+        multiprocessing worker.
+        
+        """
+        
+        if cls.logger is not None:
+            for handler in cls.logger.handlers:
+                handler.flush()
   
     @classmethod
     def get(cls):
@@ -283,13 +535,212 @@ class RealTimeLogger(object):
                 os.environ.has_key("RT_LOGGING_PORT")):
                 # We know where to send messages to, so send them.
             
-                cls.logger.addHandler(JSONDatagramHandler(
+                # Work out how to sample records by level, from a string like
+                # "INFO:0.1,DEBUG:0"
+                sample_rates = {}
+                for part in os.environ.get("RT_LOGGING_SAMPLE", "").split(","):
+                    if part.strip() != "":
+                        level, rate = part.split(":")
+                        sample_rates[logging.getLevelName(
+                            level.strip().upper())] = float(rate)
+                
+                cls.logger.addHandler(BatchedJSONDatagramHandler(
                     os.environ["RT_LOGGING_HOST"],
-                    int(os.environ["RT_LOGGING_PORT"])))
+                    int(os.environ["RT_LOGGING_PORT"]),
+                    rate=float(os.environ.get("RT_LOGGING_RATE", 100)),
+                    sample_rates=sample_rates))
         
         return cls.logger
 
-def write_global_directory(file_store, path, cleanup=False, tee=None):
+# These are the compressors we know how to use for directory tarballs. Each
+# has the magic number its output starts with, a command to compress standard
+# input to standard output using a given number of threads (or None if Python
+# can do it), and commands to decompress that way (first available wins; None
+# means Python can do it).
+COMPRESSORS = {
+    "gzip": {
+        "magic": "\x1f\x8b",
+        "compress": ["pigz", "-c", "-p", "{threads}"],
+        "decompress": [["pigz", "-d", "-c"], None]
+    },
+    "zstd": {
+        "magic": "\x28\xb5\x2f\xfd",
+        "compress": ["zstd", "-q", "-c", "-T{threads}"],
+        "decompress": [["zstd", "-q", "-d", "-c"]]
+    },
+    "lz4": {
+        "magic": "\x04\x22\x4d\x18",
+        "compress": ["lz4", "-q", "-c"],
+        "decompress": [["lz4", "-q", "-d", "-c"]]
+    }
+}
+
+def have_command(command):
+    """
+    Returns true if the given command is available on the PATH.
+    
+    """
+    
+    return any(os.access(os.path.join(directory, command), os.X_OK)
+        for directory in os.environ.get("PATH", "").split(os.pathsep))
+
+def run_pipeline(commands, stdin=None, stdout=None, stderr=None):
+    """
+    Run the given list of commands (each a list of arguments), with each one's
+    standard output piped into the next one's standard input, like a shell
+    pipeline. The first reads from stdin and the last writes to stdout.
+    
+    Waits for every process to exit. Once this returns, everything the last
+    command wrote has been handed to the operating system, so there is no need
+    to sleep before reading it back. Raises a RuntimeError if any step fails.
+    
+    """
+    
+    # Hold all the Popen objects
+    processes = []
+    
+    try:
+        for i, command in enumerate(commands):
+            processes.append(subprocess.Popen(command,
+                stdin=processes[-1].stdout if i > 0 else stdin,
+                stdout=stdout if i == len(commands) - 1 else subprocess.PIPE,
+                stderr=stderr))
+            
+            if i > 0:
+                # Drop our copy of the pipe in, so the previous step will get
+                # SIGPIPE if this one dies, instead of hanging forever.
+                processes[-2].stdout.close()
+    except:
+        # Don't leave anything running if we couldn't start it all
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        raise
+        
+    # Did we make it through all the steps OK?
+    failures = []
+    for i, process in enumerate(processes):
+        if process.wait() != 0:
+            failures.append("step {} ({}) returned {}".format(i,
+                commands[i][0], process.returncode))
+            
+    if len(failures) > 0:
+        raise RuntimeError("Pipeline failed: {}".format(", ".join(failures)))
+
+def copy_in_thread(source, destination, close=False):
+    """
+    Start a thread to copy everything from one file object to another, and
+    return it. If close is true, closes the destination when done.
+    
+    Any exception in the thread is saved as the thread's error attribute.
+    
+    """
+    
+    def copy():
+        try:
+            shutil.copyfileobj(source, destination)
+        except Exception as e:
+            thread.error = e
+        finally:
+            if close:
+                destination.close()
+                
+    thread = threading.Thread(target=copy)
+    thread.error = None
+    thread.daemon = True
+    thread.start()
+    
+    return thread
+
+def get_entry_size(path):
+    """
+    Get the total size in bytes of the file or directory at the given path.
+    
+    """
+    
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+        
+    size = 0
+    for parent, _, file_names in os.walk(path):
+        for file_name in file_names:
+            size += os.path.getsize(os.path.join(parent, file_name))
+            
+    return size
+
+def write_tar_stream(path, file_handle, compression="gzip", threads=1):
+    """
+    Write the contents of the given directory as a tarball to the given file
+    object, compressed with the given compressor from COMPRESSORS, using up to
+    the given number of threads.
+    
+    Uses an external compressor program if it is available, and Python's
+    single-threaded gzip otherwise (or fails, for compressors other than gzip).
+    
+    Top-level files and directories are written smallest first, so readers that
+    want only some of them can usually stop early.
+    
+    Returns a table of contents dict, with a "members" list holding a dict for
+    each top-level file or directory, giving its "name" and the "start" and
+    "end" offsets of its entries in the uncompressed tar stream.
+    
+    """
+    
+    compressor = COMPRESSORS[compression]
+    
+    if have_command(compressor["compress"][0]):
+        # Run the compressor and copy its output to the file
+        command = [part.format(threads=threads)
+            for part in compressor["compress"]]
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        copier = copy_in_thread(process.stdout, file_handle)
+        
+        # Feed it an uncompressed tar stream
+        tar_handle = process.stdin
+        tar_mode = "w|"
+    elif compression == "gzip":
+        # Do it ourselves
+        process = None
+        tar_handle = file_handle
+        tar_mode = "w|gz"
+    else:
+        raise RuntimeError("Cannot compress with {}: {} not found".format(
+            compression, compressor["compress"][0]))
+            
+    # This holds the table of contents entries
+    toc_members = []
+    
+    with tarfile.open(fileobj=tar_handle, mode=tar_mode) as tar:
+        # Open it for streaming-only write (no seeking)
+        
+        # We can't just add the root directory, since then we wouldn't be
+        # able to extract it later with an arbitrary name.
+        
+        for file_name in sorted(os.listdir(path), key=lambda name:
+            (get_entry_size(os.path.join(path, name)), name)):
+            # Add each file in the directory to the tar, with a relative
+            # path, and note where it went.
+            start = tar.offset
+            tar.add(os.path.join(path, file_name), arcname=file_name)
+            toc_members.append({"name": file_name, "start": start,
+                "end": tar.offset})
+            
+    if process is not None:
+        # Let the compressor finish
+        process.stdin.close()
+        copier.join()
+        if process.wait() != 0:
+            raise RuntimeError("Compressor {} failed with code {}".format(
+                command[0], process.returncode))
+        if copier.error is not None:
+            raise copier.error
+            
+    return {"members": toc_members}
+
+def write_global_directory(file_store, path, cleanup=False, tee=None,
+    compression="gzip", threads=1, toc=None):
     """
     Write the given directory into the file store, and return an ID that can be
     used to retrieve it. Writes the files in the directory and subdirectories
@@ -301,73 +752,727 @@ def write_global_directory(file_store, path, cleanup=False, tee=None):
     If cleanup is true, directory will be deleted from the file store when this
     job and its follow-ons finish.
     
-    If tee is passed, a tar.gz of the directory contents will be written to that
-    filename. The file thus created must not be modified after this function is
-    called.
+    If tee is passed, a compressed tarball of the directory contents will be
+    written to that filename. The file thus created must not be modified after
+    this function is called.
+    
+    The tarball is compressed with the given compressor from COMPRESSORS, which
+    may use up to the given number of threads. read_global_directory works out
+    what compressor was used by itself.
+    
+    If toc is passed, the tarball's table of contents (see write_tar_stream)
+    will be written to that filename as JSON, for passing to
+    read_global_directory.
     
     """
     
     if tee is not None:
         with open(tee, "w") as file_handle:
             # We have a stream, so start taring into it
-            with tarfile.open(fileobj=file_handle, mode="w|gz") as tar:
-                # Open it for streaming-only write (no seeking)
-                
-                # We can't just add the root directory, since then we wouldn't be
-                # able to extract it later with an arbitrary name.
-                
-                for file_name in os.listdir(path):
-                    # Add each file in the directory to the tar, with a relative
-                    # path
-                    tar.add(os.path.join(path, file_name), arcname=file_name)
+            contents = write_tar_stream(path, file_handle,
+                compression=compression, threads=threads)
                     
         # Save the file on disk to the file store.
-        return file_store.writeGlobalFile(tee)
+        file_id = file_store.writeGlobalFile(tee)
     else:
     
         with file_store.writeGlobalFileStream(cleanup=cleanup) as (file_handle,
             file_id):
             # We have a stream, so start taring into it
-            # TODO: don't duplicate this code.
-            with tarfile.open(fileobj=file_handle, mode="w|gz") as tar:
-                # Open it for streaming-only write (no seeking)
-                
-                # We can't just add the root directory, since then we wouldn't be
-                # able to extract it later with an arbitrary name.
+            contents = write_tar_stream(path, file_handle,
+                compression=compression, threads=threads)
                 
-                for file_name in os.listdir(path):
-                    # Add each file in the directory to the tar, with a relative
-                    # path
-                    tar.add(os.path.join(path, file_name), arcname=file_name)
+    if toc is not None:
+        # Save the table of contents
+        with open(toc, "w") as toc_file:
+            json.dump(contents, toc_file)
                     
-            # Spit back the ID to use to retrieve it
-            return file_id
+    # Spit back the ID to use to retrieve it
+    return file_id
+            
+class PrefixedStream(object):
+    """
+    A read-only file-like object that gives some bytes we already read from a
+    stream, and then the rest of the stream.
+    
+    """
+    
+    def __init__(self, prefix, stream):
+        """
+        Make a new PrefixedStream that reads the given string and then the given
+        stream.
+        
+        """
+        
+        self.prefix = prefix
+        self.stream = stream
+        
+    def read(self, size=-1):
+        """
+        Read up to the given number of bytes, or everything if size is negative.
+        
+        """
+        
+        if self.prefix == "":
+            return self.stream.read(size)
+            
+        if size < 0:
+            data = self.prefix + self.stream.read()
+        elif size <= len(self.prefix):
+            data = self.prefix[:size]
+        else:
+            data = self.prefix + self.stream.read(size - len(self.prefix))
+        
+        self.prefix = self.prefix[len(data):]
+        return data
+            
+class TeeStream(object):
+    """
+    A read-only file-like object that reads from a stream, and also writes
+    everything it reads to another file-like object.
+    
+    """
+    
+    def __init__(self, stream, copy_to):
+        """
+        Make a new TeeStream that reads the given stream and writes what it
+        reads to copy_to.
+        
+        """
+        
+        self.stream = stream
+        self.copy_to = copy_to
+        
+    def read(self, size=-1):
+        """
+        Read up to the given number of bytes, or everything if size is negative.
+        
+        """
+        
+        data = self.stream.read(size)
+        self.copy_to.write(data)
+        return data
+        
+    def drain(self, block_size=1024 * 1024):
+        """
+        Read (and copy) everything left in the stream.
+        
+        """
+        
+        while len(self.read(block_size)) > 0:
+            pass
+            
+class BlockWriter(object):
+    """
+    A write-only file-like object that cuts everything written to it into
+    blocks of a fixed size, and calls a function on a pool of threads to save
+    each one.
+    
+    """
+    
+    def __init__(self, block_size, put_block, threads):
+        """
+        Make a new BlockWriter that makes blocks of block_size bytes (except
+        the last) and calls put_block with the number and contents of each
+        block, on the given number of threads.
+        
+        """
+        
+        self.block_size = block_size
+        self.put_block = put_block
+        
+        self.pool = multiprocessing.pool.ThreadPool(threads)
+        
+        # This holds AsyncResults for blocks being saved. We keep it short so
+        # we don't keep too many blocks in memory.
+        self.pending = collections.deque()
+        self.max_pending = threads * 2
+        
+        # This holds data written but not yet sent out in a block
+        self.buffer = []
+        self.buffered = 0
+        
+        # How many blocks have we sent out?
+        self.block_count = 0
+        
+    def send_block(self, size):
+        """
+        Send the first size bytes of the buffer off to be saved as a block.
+        
+        """
+        
+        data = "".join(self.buffer)
+        block = data[:size]
+        self.buffer = [data[size:]]
+        self.buffered = len(data) - len(block)
+        
+        while len(self.pending) >= self.max_pending:
+            # Wait for a block to finish (and raise its error, if any)
+            self.pending.popleft().get()
+            
+        self.pending.append(self.pool.apply_async(self.put_block,
+            (self.block_count, block)))
+        self.block_count += 1
+        
+    def write(self, data):
+        """
+        Write the given string.
+        
+        """
+        
+        self.buffer.append(data)
+        self.buffered += len(data)
+        
+        while self.buffered >= self.block_size:
+            self.send_block(self.block_size)
+            
+    def close(self):
+        """
+        Send any partial last block, wait for all the blocks to be saved, and
+        return how many blocks there were.
+        
+        """
+        
+        if self.buffered > 0:
+            self.send_block(self.buffered)
+            
+        while len(self.pending) > 0:
+            self.pending.popleft().get()
+            
+        self.pool.close()
+        self.pool.join()
+        
+        return self.block_count
+        
+    def abort(self):
+        """
+        Give up on saving blocks.
+        
+        """
+        
+        self.pool.terminate()
+        self.pool.join()
+            
+def read_tar_stream(file_handle, path, members=None, toc=None):
+    """
+    Extract a compressed tarball from the given file object into the given
+    directory. Detects the compressor from the tarball's magic number, and uses
+    an external decompressor program when one is available.
+    
+    If members is not None, extracts only the top-level files and directories
+    with those names. If a table of contents from write_tar_stream is also
+    given, stops reading as soon as all of them are extracted.
+    
+    """
+    
+    # Where in the uncompressed stream can we stop? None means the end.
+    stop_offset = None
+    
+    if members is not None and toc is not None:
+        # Where does each member we want end?
+        ends = dict(((member["name"], member["end"])
+            for member in toc["members"] if member["name"] in members))
+            
+        if len(ends) == len(set(members)):
+            # We only need to read up to the end of the last member we want
+            stop_offset = max(ends.values() + [0])
+        else:
+            # The table of contents doesn't know about something we want, so
+            # we have to look through the whole stream for it.
+            RealTimeLogger.get().warning("Members {} not in table of "
+                "contents; reading whole tarball".format(
+                sorted(set(members) - set(ends.iterkeys()))))
+    
+    # Look at the start of the stream
+    magic = file_handle.read(4)
+    stream = PrefixedStream(magic, file_handle)
+    
+    # Work out what decompressor command to use, or None to do it ourselves
+    command = None
+    
+    for name, compressor in COMPRESSORS.iteritems():
+        if magic.startswith(compressor["magic"]):
+            # We know what this is
+            for option in compressor["decompress"]:
+                if option is None or have_command(option[0]):
+                    # We can use this
+                    command = option
+                    break
+            else:
+                raise RuntimeError("Cannot decompress {} tarball: {} not "
+                    "found".format(name, compressor["decompress"][0][0]))
+            break
+            
+    if command is not None:
+        # Send the stream through the decompressor
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        copier = copy_in_thread(stream, process.stdin, close=True)
+        tar_handle = process.stdout
+    else:
+        # Let Python work it out
+        process = None
+        tar_handle = stream
+    
+    # Did we stop before the end?
+    stopped_early = False
+    
+    with tarfile.open(fileobj=tar_handle, mode="r|*") as tar:
+        # Open it for streaming-only read (no seeking)
+        
+        if members is None:
+            # We need to extract the whole thing into that new directory
+            tar.extractall(path)
+        else:
+            for tarinfo in tar:
+                if stop_offset is not None and tarinfo.offset >= stop_offset:
+                    # Everything we want is out already
+                    stopped_early = True
+                    break
+                    
+                if tarinfo.name.split("/", 1)[0] in members:
+                    # We want this one
+                    tar.extract(tarinfo, path)
+        
+    if process is not None:
+        if stopped_early:
+            # Don't bother decompressing the rest
+            process.kill()
+            process.wait()
+            copier.join()
+        else:
+            # Make sure the decompressor is done and happy
+            process.stdout.read()
+            copier.join()
+            if process.wait() != 0:
+                raise RuntimeError("Decompressor {} failed with code {}".format(
+                    command[0], process.returncode))
+            if copier.error is not None:
+                raise copier.error
 
 @backoff        
-def read_global_directory(file_store, directory_id, path):
+def read_global_directory(file_store, directory_id, path, members=None,
+    toc=None):
     """
     Reads a directory with the given tar file id from the global file store and
     recreates it at the given path.
     
-    The given path, if it exists, must be a directory.
+    The given path, if it exists, must be a directory.
+    
+    If members is not None, only the top-level files and directories in the
+    directory with those names are recreated. Passing the table of contents
+    saved by write_global_directory as toc lets the reader stop as soon as it
+    has them.
+    
+    Do not use to extract untrusted directories, since they could sneakily plant
+    files anywhere on the filesystem.
+    
+    """
+    
+    # Make the path
+    robust_makedirs(path)
+    
+    with file_store.readGlobalFileStream(directory_id) as file_handle:
+        # We need to pull files out of this tar stream
+        read_tar_stream(file_handle, path, members=members, toc=toc)
+            
+
+class DirectoryCache(object):
+    """
+    A size-bounded, least-recently-used cache of directories from the global
+    file store (as written by write_global_directory), kept on the local disk
+    of a node and shared by all the jobs that run there.
+    
+    Each directory is extracted once per node, no matter how many jobs want it
+    at the same time. Cached directories are read-only: don't modify them.
+    
+    Uses flock() locks on files in the cache directory, so all the jobs on a
+    node need to be using the same local filesystem for it.
+    
+    Directories nobody is using are kept up to the maximum size, which no
+    job's disk request covers unless the job adds it in. So by default only
+    directories that are in use are kept.
+    
+    """
+    
+    # Lock files for directories that this process is using, and how many
+    # times each has been gotten and not yet released, by cache directory and
+    # cache key. We hold a shared lock on each of these until it is released,
+    # so nobody evicts a directory out from under us.
+    held_locks = {}
+    
+    def __init__(self, cache_dir=None, max_size=0):
+        """
+        Make a new DirectoryCache that keeps directories in the given local
+        directory (or a default one in the system temp directory) and tries to
+        keep them to the given total size in bytes.
+        
+        """
+        
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(),
+                "toillib-directory-cache")
+                
+        # Locks are held by cache directory, so spell it the same way each time
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        
+        robust_makedirs(self.cache_dir)
+        
+    def get(self, file_store, directory_id, members=None, toc=None):
+        """
+        Get the local path of the directory with the given ID in the given
+        global file store, extracting it into the cache if needed.
+        
+        If members is not None, gets a copy of the directory with just those
+        top-level files and directories, using the given table of contents if
+        any (see read_global_directory).
+        
+        Call release() with the path when done with it.
+        
+        """
+        
+        # Work out the cache key for the directory (and the part of it we want)
+        key_source = str(directory_id)
+        if members is not None:
+            key_source += "\0" + "\0".join(sorted(members))
+        key = hashlib.sha1(key_source).hexdigest()
+        
+        # This is where the directory will be
+        path = os.path.join(self.cache_dir, key)
+        # And this marks it as completely extracted, holds its size, and has an
+        # mtime of the last time it was used.
+        marker = path + ".complete"
+        
+        if self.held_locks.has_key((self.cache_dir, key)):
+            # We're already using it, so it's there.
+            self.held_locks[(self.cache_dir, key)][1] += 1
+            os.utime(marker, None)
+            return path
+        
+        while True:
+            # Lock the entry so only one job extracts it
+            lock_file = open(path + ".lock", "a")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            
+            temp_path = None
+            try:
+                if os.path.exists(marker):
+                    RealTimeLogger.get().info("Using cached directory "
+                        "{}".format(path))
+                        
+                    # Mark it used
+                    os.utime(marker, None)
+                else:
+                    RealTimeLogger.get().info("Extracting {} to cache at "
+                        "{}".format(directory_id, path))
+                        
+                    if os.path.exists(path):
+                        # Clean up after an extraction that died
+                        shutil.rmtree(path)
+                    
+                    # Extract to a temp directory and move it into place
+                    temp_path = tempfile.mkdtemp(dir=self.cache_dir)
+                    read_global_directory(file_store, directory_id, temp_path,
+                        members=members, toc=toc)
+                    os.rename(temp_path, path)
+                    temp_path = None
+                    
+                    # Work out how big it is
+                    size = get_entry_size(path)
+                            
+                    # Write the marker atomically
+                    temp_handle, temp_marker = tempfile.mkstemp(
+                        dir=self.cache_dir)
+                    os.write(temp_handle, str(size))
+                    os.close(temp_handle)
+                    os.rename(temp_marker, marker)
+            except:
+                if temp_path is not None:
+                    # Don't leave a partial extraction behind
+                    shutil.rmtree(temp_path, ignore_errors=True)
+                # Don't keep the entry locked if we couldn't get it
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+                raise
+                
+            # Downgrade to a shared lock and keep it, so the directory stays
+            # while we use it, but other jobs can use it too.
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            
+            if os.path.exists(marker):
+                break
+                
+            # flock() drops the exclusive lock before taking the shared one, so
+            # someone evicted the directory in between. Go get it again.
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+            
+        self.held_locks[(self.cache_dir, key)] = [lock_file, 1]
+        
+        # Make room for anything else we might want to cache
+        self.evict()
+        
+        return path
+        
+    def release(self, path):
+        """
+        Say that we are done with the given directory path from get(), so it
+        can be evicted once nobody else on the node is using it either.
+        
+        """
+        
+        key = (self.cache_dir, os.path.basename(path))
+        
+        held = self.held_locks[key]
+        held[1] -= 1
+        if held[1] == 0:
+            # Nobody in this process is using it anymore
+            fcntl.flock(held[0], fcntl.LOCK_UN)
+            held[0].close()
+            del self.held_locks[key]
+            
+            # It may be over the size limit now that we're not using it
+            self.evict()
+        
+    def evict(self):
+        """
+        Delete least recently used directories that no job is using, until the
+        cache fits in its maximum size.
+        
+        """
+        
+        # Only one job evicts at a time
+        with open(os.path.join(self.cache_dir, "evict.lock"), "a") as \
+            evict_lock:
+            
+            fcntl.flock(evict_lock, fcntl.LOCK_EX)
+            
+            # Find all the complete entries as (last use, size, key)
+            entries = []
+            for file_name in os.listdir(self.cache_dir):
+                if not file_name.endswith(".complete"):
+                    continue
+                marker = os.path.join(self.cache_dir, file_name)
+                try:
+                    with open(marker) as marker_file:
+                        size = int(marker_file.read())
+                    entries.append((os.path.getmtime(marker), size,
+                        file_name[:-len(".complete")]))
+                except (OSError, IOError, ValueError):
+                    # Someone else is messing with it
+                    continue
+                    
+            total_size = sum((size for _, size, _ in entries))
+            
+            for _, size, key in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                    
+                if self.held_locks.has_key((self.cache_dir, key)):
+                    # We're using this one
+                    continue
+                    
+                path = os.path.join(self.cache_dir, key)
+                
+                with open(path + ".lock", "a") as lock_file:
+                    try:
+                        # See if anyone is using it
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError as e:
+                        if e.errno in (errno.EAGAIN, errno.EACCES):
+                            # Someone is using it
+                            continue
+                        raise
+                        
+                    RealTimeLogger.get().info("Evicting cached directory "
+                        "{}".format(path))
+                    
+                    # Un-mark and delete it
+                    os.unlink(path + ".complete")
+                    shutil.rmtree(path, ignore_errors=True)
+                    total_size -= size
+                    
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class ResourceMonitor(object):
+    """
+    Measures named stages of a job: wall time, CPU time, peak RSS, and bytes
+    read and written. Each stage is logged through RealTimeLogger as it
+    finishes, and all of them can be saved to an IOStore as a TSV.
+    
+    CPU time and I/O include child processes that have finished. Peak RSS is
+    the high-water mark so far of the job process or any finished child, since
+    that's all the OS tells us. So when several things run at once in the same
+    process, only their wall times can be told apart; use wall_only for those.
     
-    Do not use to extract untrusted directories, since they could sneakily plant
-    files anywhere on the filesystem.
+    Use like:
     
-    """
+        monitor = ResourceMonitor(region="brca1", graph="cactus")
+        with monitor.stage("download"):
+            ...
+        monitor.save(out_store, "metrics/run/brca1/cactus.tsv")
     
-    # Make the path
-    robust_makedirs(path)
+    """
     
-    with file_store.readGlobalFileStream(directory_id) as file_handle:
-        # We need to pull files out of this tar stream
+    # These are the measurement columns in the TSV, after the stage name and
+    # the tags.
+    columns = ["wall_seconds", "cpu_seconds", "max_rss_kb", "bytes_read",
+        "bytes_written"]
     
-        with tarfile.open(fileobj=file_handle, mode="r|*") as tar:
-            # Open it for streaming-only read (no seeking)
+    def __init__(self, wall_only=False, **tags):
+        """
+        Make a new ResourceMonitor that labels all its stages with the given
+        tags (like region, graph, and sample names).
+        
+        If wall_only is set, only measures wall time, and records the other
+        columns as "shared", because they would include other work going on in
+        the process at the same time.
+        
+        """
+        
+        self.wall_only = wall_only
+        self.tags = tags
+        
+        # This holds a list of measurements for each stage done so far, with
+        # the stage name first.
+        self.records = []
+        
+    @staticmethod
+    def measure():
+        """
+        Return the current wall clock time, total CPU time, peak RSS in KB, and
+        bytes read and written, for this process and its finished children.
+        
+        """
+        
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        
+        cpu_time = (self_usage.ru_utime + self_usage.ru_stime +
+            child_usage.ru_utime + child_usage.ru_stime)
+        max_rss = max(self_usage.ru_maxrss, child_usage.ru_maxrss)
+        
+        # Get the I/O counters, if the OS has them
+        io_counts = collections.defaultdict(int)
+        try:
+            with open("/proc/self/io") as io_file:
+                for line in io_file:
+                    name, value = line.split(":")
+                    io_counts[name] = int(value)
+        except IOError:
+            pass
             
-            # We need to extract the whole thing into that new directory
-            tar.extractall(path)
+        return (time.time(), cpu_time, max_rss, io_counts["rchar"],
+            io_counts["wchar"])
+        
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager that measures the stage with the given name, if it
+        finishes successfully.
+        
+        """
+        
+        if self.wall_only:
+            start = time.time()
+            
+            yield
+            
+            wall_time = time.time() - start
+            
+            self.records.append([name, wall_time] +
+                ["shared"] * (len(self.columns) - 1))
+                
+            RealTimeLogger.get().info("Stage {} ({}): {:.2f}s wall (other "
+                "resources shared with concurrent work)".format(name,
+                ", ".join("{}={}".format(tag, value) for tag, value in
+                sorted(self.tags.iteritems())), wall_time))
+            return
+        
+        before = self.measure()
+        
+        yield
+        
+        after = self.measure()
+        
+        # Work out the differences, except for peak RSS
+        wall_time, cpu_time, _, bytes_read, bytes_written = [
+            end - start for start, end in zip(before, after)]
+        max_rss = after[2]
+        
+        self.records.append([name, wall_time, cpu_time, max_rss, bytes_read,
+            bytes_written])
+            
+        RealTimeLogger.get().info("Stage {} ({}): {:.2f}s wall, {:.2f}s CPU, "
+            "{} KB peak RSS, {} bytes read, {} bytes written".format(name,
+            ", ".join("{}={}".format(tag, value) for tag, value in
+            sorted(self.tags.iteritems())), wall_time, cpu_time, max_rss,
+            bytes_read, bytes_written))
+            
+    def save(self, out_store, key):
+        """
+        Save all the stages measured so far to the given key in the given
+        IOStore as a TSV, with a header line starting with "#".
+        
+        """
+        
+        tag_names = sorted(self.tags.iterkeys())
+        
+        (handle, tsv_path) = tempfile.mkstemp(suffix=".tsv")
+        
+        with os.fdopen(handle, "w") as tsv_file:
+            tsv_file.write("\t".join(["#stage"] + tag_names +
+                self.columns) + "\n")
+                
+            for record in self.records:
+                tsv_file.write("\t".join([record[0]] +
+                    [str(self.tags[tag]) for tag in tag_names] +
+                    [str(value) for value in record[1:]]) + "\n")
+                    
+        try:
+            out_store.write_output_file(tsv_path, key)
+        finally:
+            os.unlink(tsv_path)
             
+    @staticmethod
+    def merge(out_store, prefix, key):
+        """
+        Concatenate all the TSVs saved by ResourceMonitors under the given
+        prefix in the given IOStore, and save the result under the given key,
+        with just one header line. All the TSVs should have the same tags.
+        
+        """
+        
+        (handle, tsv_path) = tempfile.mkstemp(suffix=".tsv")
+        os.close(handle)
+        (handle, merged_path) = tempfile.mkstemp(suffix=".tsv")
+        
+        # Have we written the header yet?
+        have_header = False
+        
+        try:
+            with os.fdopen(handle, "w") as merged_file:
+                for name in out_store.list_input_directory(prefix,
+                    recursive=True):
+                    # Grab each TSV
+                    out_store.read_input_file("{}/{}".format(prefix, name),
+                        tsv_path)
+                        
+                    with open(tsv_path) as tsv_file:
+                        for line in tsv_file:
+                            if line.startswith("#"):
+                                if have_header:
+                                    # Only keep one header
+                                    continue
+                                have_header = True
+                            merged_file.write(line)
+                            
+            out_store.write_output_file(merged_path, key)
+        finally:
+            for path in [tsv_path, merged_path]:
+                if os.path.exists(path):
+                    os.unlink(path)
 
 class IOStore(object):
     """
@@ -453,6 +1558,26 @@ class IOStore(object):
         
         raise NotImplementedError()
         
+    @contextlib.contextmanager
+    def write_output_stream(self, output_path):
+        """
+        Context manager that gives a writable file object, and saves everything
+        written to it at the given output path, like write_output_file, once
+        the with block finishes. Nothing is saved if the block raises an error.
+        
+        """
+        
+        # Default implementation: spool to a temp file and save that
+        (handle, temp_path) = tempfile.mkstemp()
+        
+        try:
+            with os.fdopen(handle, "w") as stream:
+                yield stream
+            
+            self.write_output_file(temp_path, output_path)
+        finally:
+            os.unlink(temp_path)
+        
     def exists(self, path):
         """
         Returns true if the given input or output file exists in the store
@@ -480,6 +1605,19 @@ class IOStore(object):
         
         raise NotImplementedError()
         
+    def list_metadata(self, input_path):
+        """
+        Returns a dict from the relative name of every file under the given
+        input path, recursively, to a (size in bytes, modification time) pair,
+        with modification times as datetime objects in the GMT timezone.
+        
+        Lets you look at many files for the price of one listing, instead of
+        asking about them one at a time with exists, get_size, and get_mtime.
+        
+        """
+        
+        raise NotImplementedError()
+        
     @staticmethod
     def absolute(store_string):
         """
@@ -768,6 +1906,44 @@ class FileIOStore(IOStore):
         # Give it ordinary, not-secret permissions
         os.chmod(real_output_path, 0644)
         
+    @contextlib.contextmanager
+    def write_output_stream(self, output_path):
+        """
+        Stream output to a temp file in the filesystem, and move it into place
+        when done.
+        """
+        
+        # What's the real output path to write to?
+        real_output_path = os.path.join(self.path_prefix, output_path)
+
+        # What directory should this go in?
+        parent_dir = os.path.split(real_output_path)[0]
+            
+        if parent_dir != "":
+            # Make sure the directory it goes in exists.
+            robust_makedirs(parent_dir)
+        
+        # Make a temporary file
+        temp_handle, temp_path = tempfile.mkstemp(dir=self.path_prefix)
+        
+        try:
+            with os.fdopen(temp_handle, "w") as stream:
+                yield stream
+        except:
+            # Don't leave the partial file around
+            os.unlink(temp_path)
+            raise
+        
+        if os.path.exists(real_output_path):
+            # At least try to get existing files out of the way first.
+            os.unlink(real_output_path)
+            
+        # Rename the temp file to the right place, atomically
+        os.rename(temp_path, real_output_path)
+        
+        # Give it ordinary, not-secret permissions
+        os.chmod(real_output_path, 0644)
+        
     def exists(self, path):
         """
         Returns true if the given input or output file exists in the file system
@@ -809,13 +1985,51 @@ class FileIOStore(IOStore):
             
         # Return the size in bytes of the backing file
         return os.stat(os.path.join(self.path_prefix, path)).st_size
+        
+    def list_metadata(self, input_path):
+        """
+        Returns a dict from the relative name of every file under the given
+        input path, recursively, to a (size in bytes, modification time) pair.
+        
+        """
+        
+        # This holds the (size, mtime) pairs by relative name
+        metadata = {}
+        
+        real_path = os.path.join(self.path_prefix, input_path)
+        
+        for directory, _, filenames in os.walk(real_path):
+            # For every directory under the path
+            for filename in filenames:
+                # Look at each file
+                full_path = os.path.join(directory, filename)
+                file_stats = os.stat(full_path)
+                
+                # Convert its mtime to datetime
+                mtime_datetime = datetime.datetime.utcfromtimestamp(
+                    file_stats.st_mtime).replace(tzinfo=dateutil.tz.tzutc())
+                    
+                metadata[os.path.relpath(full_path, real_path)] = (
+                    file_stats.st_size, mtime_datetime)
+        
+        return metadata
 
 class AzureIOStore(IOStore):
     """
     A class that lets you get input from and send output to Azure Storage.
     
+    Files bigger than transfer_block_size are moved in blocks of that size, on
+    transfer_threads threads at once. Each block is retried on its own, and
+    partly-finished transfers pick up where they left off when retried.
+    
     """
     
+    # How many bytes should go in each block of a chunked transfer?
+    transfer_block_size = 16 * 1024 * 1024
+    
+    # How many blocks should we move at once?
+    transfer_threads = 8
+    
     def __init__(self, account_name, container_name, name_prefix=""):
         """
         Make a new AzureIOStore that reads from and writes to the given
@@ -848,6 +2062,9 @@ class AzureIOStore(IOStore):
         # This will hold out Azure blob store connection
         self.connection = None
         
+        # This will hold a connection for each transfer thread
+        self.thread_state = threading.local()
+        
     def __getstate__(self):
         """
         Return the state to use for pickling. We don't want to try and pickle
@@ -868,6 +2085,7 @@ class AzureIOStore(IOStore):
         self.name_prefix = state[3]
         
         self.connection = None
+        self.thread_state = threading.local()
         
     def __connect(self):
         """
@@ -882,11 +2100,99 @@ class AzureIOStore(IOStore):
             # Connect to the blob service where we keep everything
             self.connection = BlockBlobService(
                 account_name=self.account_name, account_key=self.account_key)
+                
+    def __thread_connection(self):
+        """
+        Get an Azure connection for the current transfer thread, since we can't
+        count on sharing one between threads.
+        """
+        
+        if not hasattr(self.thread_state, "connection"):
+            # Connect to the blob service for just this thread
+            self.thread_state.connection = BlockBlobService(
+                account_name=self.account_name, account_key=self.account_key)
+                
+        return self.thread_state.connection
+        
+    def __block_ranges(self, size):
+        """
+        Return a list of (start, end) byte ranges, with exclusive ends, for the
+        blocks of a chunked transfer of the given number of bytes.
+        """
+        
+        return [(start, min(start + self.transfer_block_size, size))
+            for start in xrange(0, size, self.transfer_block_size)]
+            
+    def __run_transfers(self, function, tasks):
+        """
+        Call the given function on each of the given tasks, on our transfer
+        threads. Raises any exception that a call raises.
+        """
+        
+        pool = multiprocessing.pool.ThreadPool(self.transfer_threads)
+        
+        try:
+            for _ in pool.imap_unordered(function, tasks):
+                # Just wait for everything to finish
+                pass
+        finally:
+            pool.close()
+            pool.join()
+        
+    @backoff
+    def __download_block(self, blob_name, etag, start, end, local_path):
+        """
+        Download the bytes from start to end (exclusive) of the given blob, as
+        long as it still has the given etag, into the same place in the given
+        local file, which must be big enough already.
+        """
+        
+        blob = self.__thread_connection().get_blob_to_bytes(
+            self.container_name, blob_name, start_range=start,
+            end_range=end - 1, if_match=etag)
+            
+        if len(blob.content) != end - start:
+            raise RuntimeError("Got {} bytes instead of {} from {}".format(
+                len(blob.content), end - start, blob_name))
+            
+        with open(local_path, "r+b") as local_file:
+            # Put the block where it goes
+            local_file.seek(start)
+            local_file.write(blob.content)
+            
+    @backoff
+    def __upload_block(self, blob_name, block_id, start, end, local_path):
+        """
+        Upload the bytes from start to end (exclusive) of the given local file
+        as an uncommitted block with the given ID in the given blob.
+        """
+        
+        with open(local_path, "rb") as local_file:
+            # Grab the block
+            local_file.seek(start)
+            data = local_file.read(end - start)
+            
+        self.__thread_connection().put_block(self.container_name, blob_name,
+            data, block_id)
+            
+    @backoff
+    def __put_block_data(self, blob_name, block_id, data):
+        """
+        Upload the given string as an uncommitted block with the given ID in
+        the given blob.
+        """
+        
+        self.__thread_connection().put_block(self.container_name, blob_name,
+            data, block_id)
             
     @backoff        
     def read_input_file(self, input_path, local_path):
         """
         Get input from Azure.
+        
+        Big blobs are downloaded in parallel blocks to a ".partial" file next
+        to local_path, with the finished blocks listed in a ".partial.blocks"
+        journal, so that a retry only fetches the blocks that are missing.
         """
         
         self.__connect()
@@ -894,11 +2200,87 @@ class AzureIOStore(IOStore):
         
         RealTimeLogger.get().debug("Loading {} from AzureIOStore".format(
             input_path))
+            
+        blob_name = self.name_prefix + input_path
+        
+        if have_azure_blocks:
+            # See how big the blob is and what version we are getting
+            properties = self.connection.get_blob_properties(
+                self.container_name, blob_name).properties
+            size = properties.content_length
+            etag = properties.etag
+        
+        if not have_azure_blocks or size <= self.transfer_block_size:
+            # Download the blob in one go. This is known to be synchronous,
+            # although it can call a callback during the process.
+            self.connection.get_blob_to_path(self.container_name,
+                blob_name, local_path)
+            return
+            
+        # Where do we put the blocks, and note which ones we have?
+        partial_path = local_path + ".partial"
+        journal_path = local_path + ".partial.blocks"
+        
+        # This holds the start offsets of the blocks we already have
+        done_blocks = set()
+        
+        if os.path.exists(partial_path) and os.path.exists(journal_path):
+            # We may be resuming a download
+            with open(journal_path) as journal:
+                lines = journal.read().split("\n")
+                
+            if (lines[0] == etag and
+                os.path.getsize(partial_path) == size):
+                # It was a download of this version of the blob. Use the
+                # blocks that made it. The last line may be incomplete.
+                done_blocks = set(int(line) for line in lines[1:-1])
+                
+                RealTimeLogger.get().info("Resuming download of {} with {} "
+                    "blocks done".format(input_path, len(done_blocks)))
+            else:
+                # Start over
+                os.unlink(journal_path)
+        
+        if not os.path.exists(journal_path):
+            # Make a file of the right size to fill in
+            with open(partial_path, "wb") as partial_file:
+                partial_file.truncate(size)
+                
+            # And start a journal for this version of the blob
+            with open(journal_path, "w") as journal:
+                journal.write(etag + "\n")
+        
+        # Which blocks still need downloading?
+        to_download = [(start, end) for start, end in self.__block_ranges(size)
+            if start not in done_blocks]
+            
+        RealTimeLogger.get().debug("Downloading {} blocks of {} on {} "
+            "threads".format(len(to_download), input_path,
+            self.transfer_threads))
+            
+        with open(journal_path, "a") as journal:
+            # Only one thread can write to the journal at a time
+            journal_lock = threading.Lock()
+            
+            def download(block_range):
+                start, end = block_range
+                self.__download_block(blob_name, etag, start, end,
+                    partial_path)
+                    
+                with journal_lock:
+                    # Record that we have this block
+                    journal.write("{}\n".format(start))
+                    journal.flush()
+                    
+            self.__run_transfers(download, to_download)
+            
+        if os.path.exists(local_path):
+            # Get the existing file out of the way
+            os.unlink(local_path)
         
-        # Download the blob. This is known to be synchronous, although it can
-        # call a callback during the process.
-        self.connection.get_blob_to_path(self.container_name,
-            self.name_prefix + input_path, local_path)
+        # Put the finished file in place
+        os.rename(partial_path, local_path)
+        os.unlink(journal_path)
             
     def list_input_directory(self, input_path, recursive=False,
         with_times=False):
@@ -1006,12 +2388,112 @@ class AzureIOStore(IOStore):
             # The container probably already exists
             pass
         
-        # Upload the blob (synchronously)
-        # TODO: catch no container error here, make the container, and retry
-        self.connection.put_block_blob_from_path(self.container_name,
-            self.name_prefix + output_path, local_path)
-    
-    @backoff        
+        blob_name = self.name_prefix + output_path
+        
+        # How big is the file?
+        size = os.path.getsize(local_path)
+        
+        if not have_azure_blocks or size <= self.transfer_block_size:
+            # Upload the blob (synchronously)
+            # TODO: catch no container error here, make the container, and
+            # retry
+            self.connection.put_block_blob_from_path(self.container_name,
+                blob_name, local_path)
+            return
+            
+        # Name the blocks after this version of the file, so if we're retrying
+        # we can tell which uncommitted blocks are ours and still good.
+        version = hashlib.sha1("{}:{}:{}".format(os.path.abspath(local_path),
+            size, os.path.getmtime(local_path))).hexdigest()[:16]
+        blocks = [("{}-{:08d}".format(version, i), start, end)
+            for i, (start, end) in enumerate(self.__block_ranges(size))]
+            
+        # This holds the IDs and sizes of blocks already uploaded
+        uploaded_blocks = {}
+        
+        try:
+            # See what blocks are already waiting to be committed
+            block_list = self.connection.get_block_list(self.container_name,
+                blob_name, block_list_type="uncommitted")
+            for block in block_list.uncommitted_blocks:
+                uploaded_blocks[block.id] = block.size
+        except AzureMissingResourceHttpError:
+            # Nothing uploaded yet
+            pass
+            
+        # Which blocks still need uploading?
+        to_upload = [(block_id, start, end) for block_id, start, end in blocks
+            if uploaded_blocks.get(block_id, None) != end - start]
+            
+        RealTimeLogger.get().debug("Uploading {}/{} blocks of {} on {} "
+            "threads".format(len(to_upload), len(blocks), output_path,
+            self.transfer_threads))
+            
+        def upload(block):
+            block_id, start, end = block
+            self.__upload_block(blob_name, block_id, start, end, local_path)
+            
+        self.__run_transfers(upload, to_upload)
+        
+        # Put all the blocks together into the blob
+        self.connection.put_block_list(self.container_name, blob_name,
+            [BlobBlock(id=block_id) for block_id, _, _ in blocks])
+
+    @contextlib.contextmanager
+    def write_output_stream(self, output_path):
+        """
+        Stream output to Azure as it is written, as blocks uploaded in parallel,
+        and commit them all to the blob when done. Will create the container if
+        necessary.
+        """
+
+        if not have_azure_blocks:
+            # We can't do blocks, so spool to disk instead.
+            with super(AzureIOStore, self).write_output_stream(
+                output_path) as stream:
+                yield stream
+            return
+
+        self.__connect()
+
+        RealTimeLogger.get().debug("Streaming {} to AzureIOStore".format(
+            output_path))
+
+        try:
+            # Make the container
+            self.connection.create_container(self.container_name)
+        except azure.WindowsAzureConflictError:
+            # The container probably already exists
+            pass
+
+        blob_name = self.name_prefix + output_path
+
+        # We can't know what the stream will contain in advance, so give the
+        # blocks for this attempt their own random name.
+        version = "{:016x}".format(random.getrandbits(64))
+
+        def block_id(i):
+            return "{}-{:08d}".format(version, i)
+
+        def put_block(i, data):
+            self.__put_block_data(blob_name, block_id(i), data)
+
+        writer = BlockWriter(self.transfer_block_size, put_block,
+            self.transfer_threads)
+
+        try:
+            yield writer
+            block_count = writer.close()
+        except:
+            # Uncommitted blocks will be cleaned up by Azure eventually
+            writer.abort()
+            raise
+
+        # Put all the blocks together into the blob
+        self.connection.put_block_list(self.container_name, blob_name,
+            [BlobBlock(id=block_id(i)) for i in xrange(block_count)])
+
+    @backoff
     def exists(self, path):
         """
         Returns true if the given input or output file exists in Azure already.
@@ -1123,6 +2605,64 @@ class AzureIOStore(IOStore):
                 break 
         
         return None
+        
+    @backoff
+    def list_metadata(self, input_path):
+        """
+        Returns a dict from the relative name of every blob under the given fake
+        directory, recursively, to a (size in bytes, modification time) pair.
+        Uses one list_blobs call per page of results.
+        
+        """
+        
+        self.__connect()
+        
+        RealTimeLogger.get().info("Getting metadata for {} from "
+            "AzureIOStore".format(input_path))
+        
+        # Work out what the directory name to list is
+        fake_directory = self.name_prefix + input_path
+        
+        if fake_directory != "" and not fake_directory.endswith("/"):
+            # We have a nonempty prefix, and we need to end it with a slash
+            fake_directory += "/"
+            
+        # This holds the (size, mtime) pairs by relative name
+        metadata = {}
+        
+        marker = None
+        
+        while True:
+        
+            # Get the results from Azure.
+            result = self.connection.list_blobs(self.container_name, 
+                prefix=fake_directory, marker=marker)
+                
+            for blob in result:
+                # Look at each blob
+                mtime = blob.properties.last_modified
+                    
+                if isinstance(mtime, datetime.datetime):
+                    # Make sure we're getting proper localized datetimes
+                    # from the new Azure Storage API.
+                    assert(mtime.tzinfo is not None and
+                        mtime.tzinfo.utcoffset(mtime) is not None)
+                else:
+                    # Convert mtime from a string as in the old API.
+                    mtime = dateutil.parser.parse(mtime).replace(
+                        tzinfo=dateutil.tz.tzutc())
+                        
+                # Drop the common prefix and remember the blob
+                metadata[blob.name[len(fake_directory):]] = (
+                    blob.properties.content_length, mtime)
+                
+            # Save the marker
+            marker = result.next_marker
+                
+            if not marker:
+                break 
+        
+        return metadata
 
 
 
@@ -150,15 +150,10 @@ def compute_cutoff(vcf_file, options):
                 
         return sorted(quals)[int(options.min_qual * len(quals))]
         
-def main(args):
-    options = parse_args(args)
-
-    if options.in_vcf == "-":
-        vcf_file = [line for line in sys.stdin]
-    else:
-        with open(options.in_vcf) as f:
-            vcf_file = [line for line in f]
-    
+def filter_vcf_lines(vcf_file, options):
+    """ yield the header lines and the passing records of a vcf, given as a
+    list of lines (as it's read twice if using a percentile)
+    """
     cutoff = compute_cutoff(vcf_file, options)
     max_cutoff = sys.maxint if options.max_depth is None else options.max_depth - cutoff
     sys.stderr.write("Cutoff = ({}, {})\n".format(cutoff, max_cutoff))
@@ -166,7 +161,7 @@ def main(args):
     buf = None, None, None, None # chrom , start, qual ,line
     for line in vcf_file:
         if line[0] == "#":
-            sys.stdout.write(line)
+            yield line
         elif not trivial_gt(line, options):
             toks = line.split("\t")
             chrom, start = toks[0], int(toks[1])
@@ -187,7 +182,7 @@ def main(args):
             # new coordinate, write and clear buffer
             if not options.dedupe or (chrom, start) != (buf[0], buf[1]):
                 if buf[0] != None:
-                    sys.stdout.write(buf[3])
+                    yield buf[3]
                     buf = None, None, None, None
 
             # update buffer
@@ -198,7 +193,19 @@ def main(args):
 
     # write buffer
     if buf[0] != None:
-        sys.stdout.write(buf[3])
+        yield buf[3]
+        
+def main(args):
+    options = parse_args(args)
+
+    if options.in_vcf == "-":
+        vcf_file = [line for line in sys.stdin]
+    else:
+        with open(options.in_vcf) as f:
+            vcf_file = [line for line in f]
+
+    for line in filter_vcf_lines(vcf_file, options):
+        sys.stdout.write(line)
 	 
 if __name__ == "__main__" :
     sys.exit(main(sys.argv))
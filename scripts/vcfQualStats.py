@@ -8,6 +8,7 @@
 
 
 import argparse, sys, os, os.path, random, subprocess, shutil, bisect, math
+import gzip, multiprocessing
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description=__doc__, 
@@ -30,44 +31,90 @@ def get_qual_from_line(line, options):
     # quality 
     return float(line.split("\t")[5])
 
-def vcf_qual_stats(vcf_path, bed_path = None, ignore_keywords = []):
-    """ count up snps indels and others for each quality value, and return 
-a table with the cumulative results.  note quality is expected to be a number
-in 5th column of vcf """
-
-    cmd = "bcftools view {}".format(vcf_path)
-    if bed_path is not None:
-        assert vcf_path[-3:] == ".gz" # gotta be indexed
-        cmd += " -R {}".format(bed_path)
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                         stderr=sys.stderr, bufsize=-1)
-    output, _ = p.communicate()
-    assert p.wait() == 0
-    vcf_file = [line + "\n" for line in output.split("\n")]
+def read_bed_regions(bed_path):
+    """ load a bed file into a dict mapping each contig to a sorted list of 
+non-overlapping, 0-based, half-open (start, end) intervals """
+    intervals = dict()
+    with open(bed_path) as bed_file:
+        for line in bed_file:
+            if len(line.strip()) == 0 or line.startswith("#") or \
+               line.startswith("track") or line.startswith("browser"):
+                continue
+            toks = line.split()
+            intervals.setdefault(toks[0], []).append((int(toks[1]), int(toks[2])))
+
+    # merge overlapping intervals so each position is only counted once
+    regions = dict()
+    for contig, contig_intervals in intervals.items():
+        merged = []
+        for start, end in sorted(contig_intervals):
+            if len(merged) > 0 and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        regions[contig] = ([x[0] for x in merged], [x[1] for x in merged])
+    return regions
+
+def overlaps_bed_regions(regions, contig, start, end):
+    """ check if 0-based, half-open interval overlaps the regions from read_bed_regions """
+    if contig not in regions:
+        return False
+    starts, ends = regions[contig]
+    # first interval ending after the start (merged intervals have sorted ends too)
+    i = bisect.bisect_right(ends, start)
+    return i < len(starts) and starts[i] < end
+
+def open_vcf(vcf_path):
+    """ open a vcf for streaming through line by line.  bgzipped vcfs are just
+multi-member gzip files, which the gzip module reads one block at a time """
+    if vcf_path == "-":
+        return sys.stdin
+    elif vcf_path.endswith(".gz"):
+        return gzip.open(vcf_path, "rb")
+    else:
+        return open(vcf_path)
+
+def vcf_qual_counts(vcf_path, regions = None, ignore_keywords = []):
+    """ stream through a vcf, counting snps indels and others for each quality value,
+only looking at records in the regions (from read_bed_regions) if given """
 
     # map quality score --> (snp count, indel count, other count)
     counts = dict()
-    
-    for line in vcf_file:
-        if len(line) > 1 and line[0] != "#" and all(x not in line for x in ignore_keywords):
-            toks = line.split("\t")
-            ref = toks[3]
-            alts = toks[4].split(",")
-            qual = get_qual_from_line(line, None)
-            if qual not in counts:
-                counts[qual] = [0, 0, 0]
-            # count any site where no length change as snp
-            # (rely on normalization to help divide these up)
-            if all(len(alt) == len(ref) for alt in alts):
-                counts[qual][0] += 1
-            # and aynthing else an indel
-            elif any(len(alt) != len(ref) for alt in alts):
-                counts[qual][1] += 1
-            # deprecated for now
-            else:
-                counts[qual][2] += 1
-                    
-    # make cumulative table qual, snps, indels, others
+
+    vcf_file = open_vcf(vcf_path)
+    try:
+        for line in vcf_file:
+            if len(line) > 1 and line[0] != "#" and all(x not in line for x in ignore_keywords):
+                toks = line.split("\t", 6)
+                ref = toks[3]
+                # like bcftools view -R, keep records whose reference allele overlaps the bed
+                pos = int(toks[1])
+                if regions is not None and not overlaps_bed_regions(regions, toks[0], pos - 1,
+                                                                    pos - 1 + len(ref)):
+                    continue
+                alts = toks[4].split(",")
+                qual = float(toks[5])
+                if qual not in counts:
+                    counts[qual] = [0, 0, 0]
+                # count any site where no length change as snp
+                # (rely on normalization to help divide these up)
+                if all(len(alt) == len(ref) for alt in alts):
+                    counts[qual][0] += 1
+                # and aynthing else an indel
+                elif any(len(alt) != len(ref) for alt in alts):
+                    counts[qual][1] += 1
+                # deprecated for now
+                else:
+                    counts[qual][2] += 1
+    finally:
+        if vcf_file is not sys.stdin:
+            vcf_file.close()
+
+    return counts
+
+def cumulative_qual_table(counts):
+    """ make cumulative table qual, snps, indels, others from vcf_qual_counts,
+from highest quality to lowest """
     qvals = sorted(counts.keys())
     qvals.reverse()
     table = []
@@ -78,6 +125,35 @@ in 5th column of vcf """
 
     return table
 
+def vcf_qual_stats(vcf_path, bed_path = None, ignore_keywords = []):
+    """ count up snps indels and others for each quality value, and return 
+a table with the cumulative results.  note quality is expected to be a number
+in 5th column of vcf.  the vcf is read in one streaming pass, and records
+are filtered against the bed (by reference allele overlap) in memory, so no index is needed """
+
+    regions = read_bed_regions(bed_path) if bed_path is not None else None
+    return cumulative_qual_table(vcf_qual_counts(vcf_path, regions, ignore_keywords))
+
+def vcf_qual_stats_star(args):
+    """ unpack arguments for vcf_qual_stats, for use with Pool.map """
+    return vcf_qual_stats(*args)
+
+def vcf_qual_stats_parallel(arg_list, processes = None):
+    """ run vcf_qual_stats for each (vcf_path, bed_path, ignore_keywords) tuple in 
+the list at the same time, one process each (but no more than processes, if given), and
+return the tables in order """
+    if processes is None:
+        processes = len(arg_list)
+    processes = min(processes, len(arg_list))
+    if processes < 2:
+        return [vcf_qual_stats(*args) for args in arg_list]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(vcf_qual_stats_star, arg_list, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
 def balance_tables(fn_table, fp_table, tp_table):
     """ need to make one table """
 
@@ -0,0 +1,908 @@
+"""
+vglib.py: useful extras for reading vg's binary formats directly from Python.
+
+Includes a reader for vg's gzip-compressed, length-delimited protobuf streams
+(as used for GAM alignment files), which produces alignment records shaped like
+the JSON that `vg view -aj` would print, without the subprocess or the JSON.
+
+Only the fields we actually look at are decoded; everything else is skipped.
+
+Also includes a compact, memory-mappable store for the node sequences of a vg
+graph, and the vg command pipelines we use to prune graphs and find kmers for
+GCSA2 indexing.
+"""
+
+
+import struct, zlib, json, hashlib, os, glob, shutil, multiprocessing.pool
+
+from toillib import run_pipeline, robust_makedirs
+
+# We need numpy for the node sequence store
+try:
+    import numpy
+    have_numpy = True
+except ImportError:
+    have_numpy = False
+
+class VGFormatError(RuntimeError):
+    """
+    Represents a problem with the contents of a vg binary stream file.
+    """
+
+# How much compressed data should we read from a stream at a time?
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Protobuf wire types we know how to skip or decode
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+# Field tables for the parts of vg.proto we need. Each maps a protobuf field
+# number to a (JSON field name, type, sub-table, repeated) tuple. Types are
+# "int", "bool", "double", "string", and "message" (which uses the sub-table).
+# Fields not listed here are skipped.
+
+EDIT_FIELDS = {
+    1: ("from_length", "int", None, False),
+    2: ("to_length", "int", None, False),
+    3: ("sequence", "string", None, False)
+}
+
+POSITION_FIELDS = {
+    1: ("node_id", "int", None, False),
+    2: ("offset", "int", None, False),
+    4: ("is_reverse", "bool", None, False)
+}
+
+MAPPING_FIELDS = {
+    1: ("position", "message", POSITION_FIELDS, False),
+    2: ("edit", "message", EDIT_FIELDS, True),
+    3: ("is_reverse", "bool", None, False)
+}
+
+PATH_FIELDS = {
+    1: ("name", "string", None, False),
+    2: ("mapping", "message", MAPPING_FIELDS, True)
+}
+
+# We leave out the quality string and all the fragment and locus information,
+# since stats never look at them.
+ALIGNMENT_FIELDS = {
+    1: ("sequence", "string", None, False),
+    2: ("path", "message", PATH_FIELDS, False),
+    3: ("name", "string", None, False),
+    5: ("mapping_quality", "int", None, False),
+    6: ("score", "int", None, False),
+    15: ("is_secondary", "bool", None, False),
+    16: ("identity", "double", None, False)
+}
+
+NODE_FIELDS = {
+    1: ("sequence", "string", None, False),
+    3: ("id", "int", None, False)
+}
+
+# We only care about the nodes in a graph chunk; edges and paths are skipped.
+GRAPH_FIELDS = {
+    1: ("node", "message", NODE_FIELDS, True)
+}
+
+def decode_varint(buffer, index):
+    """
+    Decode a protobuf base-128 varint from the given bytearray, starting at the
+    given index.
+
+    Returns the unsigned value and the index just after the varint.
+
+    >>> decode_varint(bytearray([0xac, 0x02]), 0)
+    (300, 2)
+
+    """
+
+    result = 0
+    shift = 0
+
+    while True:
+        byte = buffer[index]
+        index += 1
+        result |= (byte & 0x7f) << shift
+
+        if not (byte & 0x80):
+            # This was the last byte of the varint
+            return result, index
+
+        shift += 7
+
+        if shift >= 64:
+            raise VGFormatError("Varint too long at index {}".format(index))
+
+def to_signed(value):
+    """
+    Reinterpret an unsigned 64-bit varint value as a two's complement int64 (or
+    int32, which protobuf sign-extends to 64 bits on the wire).
+
+    >>> to_signed(2 ** 64 - 1)
+    -1
+
+    """
+
+    if value >= 2 ** 63:
+        value -= 2 ** 64
+    return int(value)
+
+def parse_message(buffer, start, end, fields):
+    """
+    Parse the protobuf message occupying the given range of the given bytearray,
+    using the given field table. Returns a dict like the one you would get from
+    loading vg's JSON for the message: fields that are unset (or that have their
+    default values, under proto3) are not present at all.
+
+    >>> sorted(parse_message(bytearray([0x08, 0x05, 0x10, 0x05]), 0, 4,
+    ...     EDIT_FIELDS).items())
+    [('from_length', 5), ('to_length', 5)]
+
+    """
+
+    # This holds the parsed fields
+    parsed = {}
+
+    index = start
+    while index < end:
+        # Parse the tag, which is field number and wire type
+        tag, index = decode_varint(buffer, index)
+        field_number = tag >> 3
+        wire_type = tag & 0x7
+
+        # Find out what we know about the field
+        field_info = fields.get(field_number, None)
+
+        if wire_type == WIRE_VARINT:
+            value, index = decode_varint(buffer, index)
+
+            if field_info is not None:
+                if field_info[1] == "bool":
+                    parsed[field_info[0]] = bool(value)
+                else:
+                    parsed[field_info[0]] = to_signed(value)
+
+        elif wire_type == WIRE_FIXED64:
+            if field_info is not None and field_info[1] == "double":
+                parsed[field_info[0]] = struct.unpack("<d",
+                    str(buffer[index:index + 8]))[0]
+            index += 8
+
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length, index = decode_varint(buffer, index)
+
+            if field_info is not None:
+                if field_info[1] == "message":
+                    value = parse_message(buffer, index, index + length,
+                        field_info[2])
+                else:
+                    value = str(buffer[index:index + length])
+
+                if field_info[3]:
+                    # Repeated fields become lists
+                    parsed.setdefault(field_info[0], []).append(value)
+                else:
+                    parsed[field_info[0]] = value
+
+            index += length
+
+        elif wire_type == WIRE_FIXED32:
+            index += 4
+
+        else:
+            # Groups are deprecated and vg doesn't use them
+            raise VGFormatError("Unsupported wire type {} for field {}".format(
+                wire_type, field_number))
+
+    if index != end:
+        raise VGFormatError("Message overran its length")
+
+    return parsed
+
+def decompress_stream(stream, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Yield blocks of decompressed data from the given gzip-compressed file
+    object. Handles files made of several concatenated gzip members, the way vg
+    writes them, and doesn't need to seek, so it works on pipes.
+
+    If the data doesn't start with the gzip magic number, it is passed through
+    uncompressed.
+
+    """
+
+    # Grab the first block so we can sniff the format
+    data = stream.read(block_size)
+
+    if not data.startswith("\x1f\x8b"):
+        # Not gzipped at all
+        while data:
+            yield data
+            data = stream.read(block_size)
+        return
+
+    # We need to decompress. Use a decompressor that expects a gzip header.
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    while data:
+        while data:
+            # Decompress all of this block
+            yield decompressor.decompress(data)
+
+            # Anything left over belongs to the next gzip member
+            data = decompressor.unused_data
+            if data:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        data = stream.read(block_size)
+
+    # Get anything still buffered in the decompressor
+    yield decompressor.flush()
+
+def iterate_messages(stream, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Given a file object for a vg stream file (like a GAM), yield each protobuf
+    message in it, as a bytearray.
+
+    The stream is gzip-compressed, and consists of groups of messages. Each
+    group is a varint count of messages, followed by that many messages, each
+    preceded by its varint length.
+
+    """
+
+    # We decode out of this buffer
+    buffer = bytearray()
+    # And this is where we are in it
+    index = 0
+
+    # This gets the decompressed data
+    blocks = decompress_stream(stream, block_size)
+
+    def fill(needed):
+        """
+        Make sure we have at least the given number of bytes available, unless
+        we run out of input. Returns the new buffer and index, since we may
+        have thrown away the data we already used.
+        """
+
+        new_buffer = buffer
+        new_index = index
+
+        while len(new_buffer) - new_index < needed:
+            block = next(blocks, None)
+            if block is None:
+                # We ran out of data
+                break
+
+            if new_index > 0:
+                # Throw out the part we already parsed
+                new_buffer = new_buffer[new_index:]
+                new_index = 0
+
+            new_buffer.extend(block)
+
+        return new_buffer, new_index
+
+    while True:
+        # Varints are at most 10 bytes long, so make sure we have that much if
+        # we can.
+        buffer, index = fill(10)
+        if index >= len(buffer):
+            # We finished the file at a group boundary
+            return
+
+        try:
+            # How many messages are in this group?
+            count, index = decode_varint(buffer, index)
+
+            for _ in xrange(count):
+                buffer, index = fill(10)
+                # How long is this message?
+                length, index = decode_varint(buffer, index)
+
+                buffer, index = fill(length)
+                if len(buffer) - index < length:
+                    raise VGFormatError("Stream ends in the middle of a "
+                        "message")
+
+                yield buffer[index:index + length]
+                index += length
+
+        except IndexError:
+            # We tried to read a varint off the end of the data
+            raise VGFormatError("Stream ends in the middle of a varint")
+
+def parse_alignment(message):
+    """
+    Parse an Alignment message from a bytearray into a dict like what `vg view
+    -aj` produces, but with only the fields we use for stats.
+
+    """
+
+    return parse_message(message, 0, len(message), ALIGNMENT_FIELDS)
+
+def read_alignments(gam_filename, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Yield each alignment in the given GAM file as a dict, in the same order as
+    they appear in the file.
+
+    """
+
+    with open(gam_filename, "rb") as gam_file:
+        for message in iterate_messages(gam_file, block_size):
+            yield parse_alignment(message)
+
+def read_varint_fields(message, field_numbers):
+    """
+    Return a dict from field number to value for the top-level varint fields
+    with the given numbers that are present in the given message bytearray,
+    without parsing the whole thing.
+
+    >>> read_varint_fields(bytearray([0x30, 0x0a, 0x1a, 0x01, 0x72]), [6, 15])
+    {6: 10}
+
+    """
+
+    found = {}
+
+    index = 0
+    end = len(message)
+    while index < end:
+        tag, index = decode_varint(message, index)
+        field_number = tag >> 3
+        wire_type = tag & 0x7
+
+        if wire_type == WIRE_VARINT:
+            value, index = decode_varint(message, index)
+            if field_number in field_numbers:
+                found[field_number] = value
+        elif wire_type == WIRE_FIXED64:
+            index += 8
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length, index = decode_varint(message, index)
+            index += length
+        elif wire_type == WIRE_FIXED32:
+            index += 4
+        else:
+            raise VGFormatError("Unsupported wire type {} for field {}".format(
+                wire_type, field_number))
+
+    return found
+
+def is_mapped_primary_message(message):
+    """
+    Return True if the given Alignment message bytearray is a primary alignment
+    with a score (which is what makes the stats count it as mapped), without
+    parsing the whole thing.
+
+    """
+
+    fields = read_varint_fields(message, [6, 15])
+    return fields.has_key(6) and not fields.get(15, False)
+
+def batch_alignment_messages(messages, batch_size):
+    """
+    Group the given Alignment message bytearrays into lists of about batch_size
+    messages each, as strings for sending to other processes.
+
+    Batches only ever start with a mapped primary alignment. The stats only
+    decide what to count for a mapped primary with no secondary when they see
+    the next mapped primary (or the end of the reads), so this way each batch
+    can have its stats computed on its own and the totals come out the same.
+
+    >>> mapped = bytearray([0x30, 0x0a])
+    >>> unmapped = bytearray([0x1a, 0x01, 0x72])
+    >>> secondary = bytearray([0x30, 0x05, 0x78, 0x01])
+    >>> [len(batch) for batch in batch_alignment_messages([mapped, unmapped,
+    ...     mapped, secondary, unmapped, mapped], 1)]
+    [2, 3, 1]
+
+    """
+
+    batch = []
+
+    for message in messages:
+        if len(batch) >= batch_size and is_mapped_primary_message(message):
+            # This batch is full, and this message can start a new one.
+            yield batch
+            batch = []
+
+        batch.append(str(message))
+
+    if len(batch) > 0:
+        yield batch
+
+def read_graph_nodes(graph_filename, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Yield (node ID, sequence) pairs for all the nodes in the given vg graph
+    file.
+
+    """
+
+    with open(graph_filename, "rb") as graph_file:
+        for message in iterate_messages(graph_file, block_size):
+            # Each message is a graph chunk
+            graph_chunk = parse_message(message, 0, len(message),
+                GRAPH_FIELDS)
+
+            for node_dict in graph_chunk.get("node", []):
+                # We want to crash if a node exists for which the ID or
+                # sequence isn't defined.
+                yield node_dict["id"], node_dict["sequence"]
+
+def hash_file(filename, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Get the SHA1 hex digest of the contents of the given file.
+
+    """
+
+    file_hash = hashlib.sha1()
+    with open(filename, "rb") as hashed_file:
+        while True:
+            block = hashed_file.read(block_size)
+            if len(block) == 0:
+                break
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+def index_cache_key(graph_filename, kmer_size, edge_max, index_mode,
+    include_pruned, include_primary, parallel_prune=False, vg_binary="vg",
+    graph_hash=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Get a hex string identifying the index that would be built for the given
+    vg graph file with the given indexing parameters by the given vg binary
+    (a path, or a command to look for on the PATH). The same graph contents,
+    parameters, and vg always give the same key, no matter where the graph
+    came from, and indexes built by some other vg are never reused.
+
+    The "gcsa-kmer" and "gcsa-mem" modes build the same index (they only map
+    differently), so they share keys. Indexes of graphs pruned a component at
+    a time (parallel_prune) are kept apart from ones pruned all at once.
+
+    If the graph's hash_file digest is already known, it can be passed as
+    graph_hash to save reading the graph again.
+
+    """
+
+    if graph_hash is None:
+        graph_hash = hash_file(graph_filename, block_size)
+
+    if os.path.dirname(vg_binary) == "":
+        # Find the vg that would actually run
+        for directory in os.environ.get("PATH", "").split(os.pathsep):
+            if os.access(os.path.join(directory, vg_binary), os.X_OK):
+                vg_binary = os.path.join(directory, vg_binary)
+                break
+        else:
+            raise RuntimeError("Cannot find {} on the PATH".format(vg_binary))
+
+    if index_mode.startswith("gcsa-"):
+        index_mode = "gcsa"
+
+    # Hash the graph itself and the vg that indexes it with everything that
+    # affects the index
+    parameters = [graph_hash, int(kmer_size),
+        int(edge_max), index_mode, bool(include_pruned), bool(include_primary),
+        hash_file(vg_binary, block_size)]
+    if parallel_prune and include_pruned:
+        # Only added when it applies, so other keys stay the same as before
+        parameters.append("parallel_prune")
+
+    return hashlib.sha1(json.dumps(parameters)).hexdigest()
+
+def prune_graph(options, bin_prefix, graph_filename, output_file, threads):
+    """
+    Prune the complex regions and then the short disconnected pieces out of
+    the given vg graph file, writing the result to the given open file object.
+    Uses --kmer_size and --edge_max from the given options.
+
+    """
+
+    run_pipeline([
+        # Prune out complex regions
+        ["{}vg".format(bin_prefix), "mod", "-p", "-l", str(options.kmer_size),
+        "-t", str(threads), "-e", str(options.edge_max), graph_filename],
+        # Throw out short disconnected chunks
+        ["{}vg".format(bin_prefix), "mod", "-S", "-l",
+        str(options.kmer_size * 2), "-t", str(threads), "-"]],
+        stdout=output_file)
+
+def extract_primary_path(options, bin_prefix, graph_filename, output_file,
+    threads):
+    """
+    Write just the primary path of the given vg graph file to the given open
+    file object, as a graph.
+
+    Since we don't know what it's called, we retain "ref" and all the "19",
+    "6", etc. paths from 1KG.
+
+    """
+
+    # See
+    # https://github.com/vgteam/vg/issues/318#issuecomment-215102199
+
+    # Generate all the paths names we might have for primary paths.
+    # It should be "ref" but some graphs don't listen
+    ref_names = (["ref", "x", "X", "y", "Y", "m", "M"] +
+        [str(x) for x in xrange(1, 23)])
+
+    ref_options = []
+    for name in ref_names:
+        # Put each in a -r option to retain the path
+        ref_options.append("-r")
+        ref_options.append(name)
+
+    # TODO: if we merged the primary path back on itself, it's possible for it
+    # to braid with itself. Right now we just ignore this and let those graphs
+    # take a super long time to index.
+
+    # Retain only the specified paths (only one should really exist)
+    run_pipeline([["{}vg".format(bin_prefix), "mod", "-N"] + ref_options +
+        ["-t", str(threads), graph_filename]], stdout=output_file)
+
+def find_kmers(options, bin_prefix, graph_filename, kmers_filename, threads,
+    deduplicate=False):
+    """
+    Make the GCSA2 kmers file for the given vg graph file. If deduplicate is
+    set, the graph is first loaded and saved by vg, to get rid of duplicate
+    nodes and edges from concatenated graphs.
+
+    """
+
+    commands = []
+
+    if deduplicate:
+        # Deduplicate the graph
+        commands.append(["{}vg".format(bin_prefix), "view", "-v",
+            graph_filename])
+        graph_filename = "-"
+
+    # Make the GCSA2 kmers file
+    commands.append(["{}vg".format(bin_prefix), "kmers", "-g", "-B", "-k",
+        str(options.kmer_size), "-H", "1000000000", "-T", "1000000001",
+        "-t", str(threads), graph_filename])
+
+    with open(kmers_filename, "w") as kmers_file:
+        # Discard warnings about duplicate nodes or edges
+        with open(os.devnull, "wb") as devnull:
+            run_pipeline(commands, stdout=kmers_file,
+                stderr=devnull if deduplicate else None)
+
+def explode_graph(bin_prefix, graph_filename, component_dir):
+    """
+    Split the given vg graph into its connected components, as vg files in the
+    given directory (which is created). Returns the component file names,
+    biggest first, so no big component is left until the end.
+
+    Nothing connects the components, so no kmers can cross between them, and
+    paths follow edges, so each bit of the primary path is in just one
+    component.
+
+    """
+
+    robust_makedirs(component_dir)
+    run_pipeline([["{}vg".format(bin_prefix), "explode", graph_filename,
+        component_dir]])
+
+    return sorted(glob.glob("{}/*.vg".format(component_dir)),
+        key=os.path.getsize, reverse=True)
+
+def prune_and_find_kmers_by_component(options, bin_prefix, components,
+    to_index_filename, threads):
+    """
+    Prune each of the given component vg files and find its GCSA2 kmers, on
+    the given number of threads at once. If --include_primary is set in the
+    given options, each component's part of the primary path is merged back
+    into its pruned graph before finding kmers, just like the primary path is
+    merged with the whole pruned graph when not splitting.
+
+    Writes all the pruned components (with their primary paths) to
+    to_index_filename, for debugging. Returns a list of kmers file names that
+    together cover everything to index.
+
+    """
+
+    def process_component(component):
+        """
+        Prune the given component file, add its primary path if wanted, and
+        find its kmers. Returns the graph file indexed and the kmers file name.
+
+        """
+
+        to_index_part = component + ".to_index"
+        with open(to_index_part, "w") as to_index_file:
+            prune_graph(options, bin_prefix, component, to_index_file, 1)
+
+            if options.include_primary:
+                # Kmers can run between pruned nodes and primary path edges
+                # that pruning removed, so the two have to be indexed together.
+                extract_primary_path(options, bin_prefix, component,
+                    to_index_file, 1)
+
+        kmers_filename = component + ".kmers"
+        if os.path.getsize(to_index_part) > 0:
+            # If we added the primary path, deduplicate the nodes and edges it
+            # shares with the pruned graph.
+            find_kmers(options, bin_prefix, to_index_part, kmers_filename, 1,
+                deduplicate=options.include_primary)
+        else:
+            # Everything was pruned away
+            open(kmers_filename, "w").close()
+
+        return to_index_part, kmers_filename
+
+    pool = multiprocessing.pool.ThreadPool(max(1, int(threads)))
+    try:
+        results = pool.map(process_component, components, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(to_index_filename, "w") as to_index_file:
+        # Concatenate all the graphs we indexed
+        for graph_part, _ in results:
+            with open(graph_part) as part_file:
+                shutil.copyfileobj(part_file, to_index_file)
+
+    return [kmers_filename for _, kmers_filename in results]
+
+class NodeSequenceStore(object):
+    """
+    Holds the sequences of all the nodes in a graph, packed into one contiguous
+    buffer, with a numpy index of where each node starts. Also holds a running
+    count of N bases along the buffer, so Ns in any piece of a node can be
+    counted in constant time.
+
+    Can be saved to a file, and loaded back with the arrays memory-mapped, so
+    that the store doesn't need to be built or read into memory in every job
+    that uses it.
+
+    Acts like a read-only dict of node sequence strings by node ID.
+
+    """
+
+    # This goes at the start of every saved store file
+    MAGIC = "VGNODES1"
+
+    # These are the arrays we keep, and the dtypes we save them with. IDs are
+    # sorted, and offsets has an extra entry for the end of the last node.
+    # n_prefix[i] is the number of Ns in sequences[:i].
+    ARRAY_DTYPES = [
+        ("ids", "<i8"),
+        ("offsets", "<i8"),
+        ("sequences", "u1"),
+        ("n_prefix", "<u4")
+    ]
+
+    def __init__(self, ids, offsets, sequences, n_prefix):
+        """
+        Make a new store around the given numpy arrays. Use from_graph,
+        from_sequences, or load instead of calling this directly.
+
+        """
+
+        # Make sure numpy actually loaded
+        assert(have_numpy)
+
+        self.ids = ids
+        self.offsets = offsets
+        self.sequences = sequences
+        self.n_prefix = n_prefix
+
+        # Node IDs are compact (as vg ids -s leaves them) if we can find each
+        # node's index by subtraction. Otherwise we binary search the sorted
+        # IDs, so we don't need a lookup table that would pull the whole
+        # (possibly memory-mapped) array into Python objects.
+        self.compact = (len(self.ids) == 0 or
+            int(self.ids[-1]) - int(self.ids[0]) + 1 == len(self.ids))
+
+        # Remember the first ID for the subtraction
+        self.min_id = int(self.ids[0]) if len(self.ids) > 0 else 0
+
+    @classmethod
+    def from_sequences(cls, node_sequences):
+        """
+        Build a store from an iterable of (node ID, sequence) pairs. Later
+        sequences for the same ID replace earlier ones.
+
+        """
+
+        assert(have_numpy)
+
+        # Deduplicate and sort by ID
+        sequence_by_id = dict(node_sequences)
+        sorted_ids = sorted(sequence_by_id.iterkeys())
+
+        # Pack all the sequences together
+        sequences = numpy.fromstring("".join(
+            (sequence_by_id[node_id] for node_id in sorted_ids)),
+            dtype=numpy.uint8)
+
+        # Work out where each node starts
+        offsets = numpy.zeros(len(sorted_ids) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(sequence_by_id[node_id]) for node_id in sorted_ids],
+            out=offsets[1:])
+
+        # Count up Ns
+        n_prefix = numpy.zeros(len(sequences) + 1, dtype=numpy.uint32)
+        numpy.cumsum(sequences == ord("N"), out=n_prefix[1:])
+
+        return cls(numpy.array(sorted_ids, dtype=numpy.int64), offsets,
+            sequences, n_prefix)
+
+    @classmethod
+    def from_graph(cls, graph_filename):
+        """
+        Build a store from all the nodes in the given vg graph file.
+
+        """
+
+        return cls.from_sequences(read_graph_nodes(graph_filename))
+
+    def save(self, filename):
+        """
+        Save the store to the given file, in a format that load can
+        memory-map.
+
+        The file is the magic string, a little-endian 8-byte header length, a
+        JSON header saying where each array is, and then the arrays themselves,
+        each starting on an 8-byte boundary.
+
+        """
+
+        # Work out where everything goes. Start with a guess at the header size
+        # that is sure to be big enough, and pad the header out to it.
+        header_space = 4096
+        position = len(self.MAGIC) + 8 + header_space
+
+        header = {}
+        for name, dtype in self.ARRAY_DTYPES:
+            array = getattr(self, name)
+            header[name] = {
+                "dtype": dtype,
+                "offset": position,
+                "length": len(array)
+            }
+            # Advance to the next 8-byte boundary after this array
+            position += len(array) * numpy.dtype(dtype).itemsize
+            position += (8 - position % 8) % 8
+
+        header_string = json.dumps(header)
+        assert(len(header_string) <= header_space)
+
+        with open(filename, "wb") as out_file:
+            out_file.write(self.MAGIC)
+            out_file.write(struct.pack("<Q", header_space))
+            out_file.write(header_string.ljust(header_space))
+
+            for name, dtype in self.ARRAY_DTYPES:
+                # Pad up to where the array goes, and write it
+                out_file.write("\0" * (header[name]["offset"] -
+                    out_file.tell()))
+                out_file.write(numpy.ascontiguousarray(getattr(self, name),
+                    dtype=dtype).tostring())
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a store saved with save, memory-mapping its arrays.
+
+        """
+
+        assert(have_numpy)
+
+        with open(filename, "rb") as in_file:
+            if in_file.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise VGFormatError("{} is not a node sequence store".format(
+                    filename))
+
+            header_space = struct.unpack("<Q", in_file.read(8))[0]
+            header = json.loads(in_file.read(header_space))
+
+        arrays = []
+        for name, dtype in cls.ARRAY_DTYPES:
+            if header[name]["length"] == 0:
+                # Can't memory-map nothing
+                arrays.append(numpy.zeros(0, dtype=dtype))
+            else:
+                arrays.append(numpy.memmap(filename, dtype=dtype, mode="r",
+                    offset=header[name]["offset"],
+                    shape=(header[name]["length"],)))
+
+        return cls(*arrays)
+
+    def _index(self, node_id):
+        """
+        Get the index of the given node in our arrays, or raise KeyError if we
+        don't have it.
+
+        """
+
+        if not self.compact:
+            index = int(numpy.searchsorted(self.ids, node_id))
+            if index >= len(self.ids) or self.ids[index] != node_id:
+                raise KeyError(node_id)
+            return index
+
+        index = node_id - self.min_id
+        if index < 0 or index >= len(self.ids):
+            raise KeyError(node_id)
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, node_id):
+        try:
+            self._index(node_id)
+            return True
+        except KeyError:
+            return False
+
+    def __getitem__(self, node_id):
+        """
+        Get the sequence string for the given node.
+
+        """
+
+        index = self._index(node_id)
+        return self.sequences[self.offsets[index]:
+            self.offsets[index + 1]].tostring()
+
+    def length(self, node_id):
+        """
+        Get the length of the given node's sequence.
+
+        """
+
+        index = self._index(node_id)
+        return int(self.offsets[index + 1] - self.offsets[index])
+
+    def count_Ns(self, node_id, start, end):
+        """
+        Count the N bases in the given node's sequence from start to end, in
+        constant time. Clips start and end to the node like a slice would.
+
+        """
+
+        index = self._index(node_id)
+        node_start = int(self.offsets[index])
+        node_length = int(self.offsets[index + 1]) - node_start
+
+        # Clip like a slice
+        start = max(0, min(start, node_length))
+        end = max(start, min(end, node_length))
+
+        return int(self.n_prefix[node_start + end] -
+            self.n_prefix[node_start + start])
+
+    def count_strand_Ns(self, node_id, offset, is_reverse, start, end):
+        """
+        Count the N bases from start to end along the reference sequence seen
+        by a vg Mapping to the given node, at the given offset and on the given
+        strand, without building that sequence.
+
+        On the forward strand the mapping sees the node sequence from offset
+        on. On the reverse strand it sees the reverse complement of the node
+        sequence with the last offset bases removed, so positions along it
+        count backward from there. Complementing doesn't change which bases
+        are Ns.
+
+        """
+
+        if not is_reverse:
+            return self.count_Ns(node_id, offset + start, offset + end)
+
+        # How much of the node does the reverse strand mapping see?
+        available = max(0, self.length(node_id) - offset)
+
+        # Clip like a slice of the reverse complement would
+        start = max(0, min(start, available))
+        end = max(start, min(end, available))
+
+        # And flip the range back onto the forward strand
+        return self.count_Ns(node_id, available - end, available - start)